@@ -1,8 +1,7 @@
 # Octoprint plugin name: Swapper3D, File: Swap_utils.py, Author: BigBrain3D, License: AGPLv3 
 
 import random
-import time
-from .Swapper3D_utils import perform_command, send_plugin_message, load_insert, unload_insert, Deploy_Wiper, Stow_Wiper
+from .Swapper3D_utils import perform_command, load_insert, unload_insert, Stow_Wiper
 
 # def SendStartGcodeToPrinter(plugin):
     #fill this in with the initial gcode required
@@ -26,17 +25,25 @@ from .Swapper3D_utils import perform_command, send_plugin_message, load_insert,
 # 8) octoprint executes the requested command
 def PreparePrinterForSwap(plugin, currentZofPrinter, HomeAxis, EchoCommand):
     # Get the min_z_height from the settings
-    min_z_height = plugin._settings.get(["zHeight"])
-    x_pos = plugin._settings.get(["xPos"])
-    y_pos = plugin._settings.get(["yPos"])
-    yBreakStringPosition = plugin._settings.get(["yBreakStringPosition"])
-    yBreakStringSpeed = plugin._settings.get(["yBreakStringSpeed"])
-    BreakString = plugin._settings.get(["BreakString"])
+    settings = plugin.settings_snapshot
+    min_z_height = settings.zHeight
+    x_pos = settings.xPos
+    y_pos = settings.yPos
+    yBreakStringPosition = settings.yBreakStringPosition
+    yBreakStringSpeed = settings.yBreakStringSpeed
+    BreakString = settings.BreakString
     
     
     
+    # The first echo is sent once the moves queued before the tool change are done, that ends the drain phase of the swap trace
+    drain_token, drained = plugin.echo_waiter.expect()
+    drained.add_done_callback(lambda _: plugin.swap_tracer.mark("drain"))
+
     # Initialize the gcode_commands list. Add "G28 XYZ" if HomeAxis is True.
-    gcode_commands = ["M84 X S999", # Keep the X-axis stepper motors enabled indefinitely
+    gcode_commands = ["M400",
+                      f"M118 E1 {drain_token}",
+                      f"M117 E1 {drain_token}",
+                      "M84 X S999", # Keep the X-axis stepper motors enabled indefinitely
                       "M107"] # Turn off cooling fan
     
     if BreakString:
@@ -53,10 +60,10 @@ def PreparePrinterForSwap(plugin, currentZofPrinter, HomeAxis, EchoCommand):
         gcode_commands.append("G28 XYZ")  # Home all axis if HomeAxis is set to True
    
     # Send message with currentZofPrinter and min_z_height values
-    send_plugin_message(plugin, f"Swapper3D_utils.PreparePrinterForSwap.currentZofPrinter: {currentZofPrinter}, min_z_height: {min_z_height}")
+    plugin.log.debug("Swapper3D_utils.PreparePrinterForSwap.currentZofPrinter: %s, min_z_height: %s", currentZofPrinter, min_z_height)
     
     # Check if the Z movement is necessary
-    if int(currentZofPrinter) < int(min_z_height):
+    if float(currentZofPrinter) < min_z_height:
         gcode_commands.append(f"G1 Z{min_z_height}")  # Move Z only the needed amount
         
     # Move to the specific X and Y coordinates
@@ -70,7 +77,7 @@ def PreparePrinterForSwap(plugin, currentZofPrinter, HomeAxis, EchoCommand):
         f"M117 E1 {EchoCommand}"   # Echo command updated works with virtual printer
     ])
 
-    send_plugin_message(plugin, f"Sending commands to printer to Prepare Printer For Swap")
+    plugin.log.debug("Sending commands to printer to Prepare Printer For Swap")
 
     # Send the G-code commands to prepare for swap
     plugin._printer.commands(gcode_commands)
@@ -79,89 +86,75 @@ def PreparePrinterForSwap(plugin, currentZofPrinter, HomeAxis, EchoCommand):
 # Function to turn on bore alignment
 def bore_align_on(plugin):
     command = "borealignon"
-    send_plugin_message(plugin, f"Sending command to turn on bore alignment")
+    plugin.log.debug("Sending command to turn on bore alignment")
     return perform_command(plugin, command)
 
 # Function to turn off bore alignment
 def bore_align_off(plugin):
     command = "borealignoff"
     plugin._printer.commands("@resume")
-    send_plugin_message(plugin, f"Sending command to turn off bore alignment")
+    plugin.log.debug("Sending command to turn off bore alignment")
     return perform_command(plugin, command)
     
     
 def swap(plugin):
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swap_utils.swap: In Swap!"))
-    NozzleWipe = plugin._settings.get(["NozzleWipe"])
-    xMinPositionForWipe = int(plugin._settings.get(["xMinPositionForWipe"]))
-    xMaxPositionForWipe = int(plugin._settings.get(["xMaxPositionForWipe"]))
-    randomXpositionForWipe = random.randint(xMinPositionForWipe,xMaxPositionForWipe)
-    DelayAfterExtruderMovedToWipeLocationBeforeDeployingWiper = int(plugin._settings.get(["DelayAfterExtruderMovedToWipeLocationBeforeDeployingWiper"]))
-    xPositionAfterWipe = int(plugin._settings.get(["xPositionAfterWipe"]))
-    yBreakStringSpeed = plugin._settings.get(["yBreakStringSpeed"])
-    ExtraExtrusionAfterSwap = plugin._settings.get(["ExtraExtrusionAfterSwap"])
-    RetractionDistanceAfterSwap = plugin._settings.get(["RetractionDistanceAfterSwap"])
+    plugin.log.debug("Swap_utils.swap: In Swap!")
+    settings = plugin.settings_snapshot
+    randomXpositionForWipe = random.randint(settings.xMinPositionForWipe, settings.xMaxPositionForWipe)
     
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"randomXpositionForWipe:{randomXpositionForWipe}"))
+    plugin.log.debug("randomXpositionForWipe:%s", randomXpositionForWipe)
 
     #if the current_extruder is not None then unload first
     if plugin.insertLoaded:
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="There is a currently loaded insert. Attempting to unload Insert."))
+        plugin.log.info("There is a currently loaded insert. Attempting to unload Insert.")
 
-        unload_result = unload_insert(plugin)
+        success, error = unload_insert(plugin)
+        plugin.swap_tracer.mark("unload")
+        if not success:
+            #loading now would put a second insert on top of the one that is still in the hotend
+            plugin.log.error("Swap to insert %s stopped, the loaded insert was not unloaded, the print stays paused: %s", int(plugin.next_extruder) + 1, error)
+            plugin.SwapInProcess = False
+            plugin.swap_tracer.end_swap(error)
+            return False, error
 
 
     #Load the next insert
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swap_utils.swap.next_extruder:{plugin.next_extruder}"))
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"1.Aug23.Swap_utils.swap.next_extruder:Aug 23->about to initiate load"))
-    load_insert(plugin, plugin.next_extruder)
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"4.Aug23.Swap_utils.swap.next_extruder:Past initiate load"))
+    plugin.log.debug("Swap_utils.swap.next_extruder:%s", plugin.next_extruder)
+    plugin.log.debug("1.Aug23.Swap_utils.swap.next_extruder:Aug 23->about to initiate load")
+    success, error = load_insert(plugin, plugin.next_extruder)
+    plugin.swap_tracer.mark("load")
+    if not success:
+        #no tool change and no resume without an insert, the print stays paused until the insert is loaded by hand
+        plugin.log.error("Swap to insert %s stopped, the print stays paused: %s", int(plugin.next_extruder) + 1, error)
+        plugin.SwapInProcess = False
+        plugin.swap_tracer.end_swap(error)
+        return False, error
+    plugin.log.debug("4.Aug23.Swap_utils.swap.next_extruder:Past initiate load")
                           
     #if the wipe procedure is ON
     #move extruder to RANDOM X-axis wipe location
     #deploy the wiper to RANDOM angle
-    if NozzleWipe:
-        gcode_commands = [f"G1 X{randomXpositionForWipe} F6000",
-                           "G4"]
-        plugin._printer.commands(gcode_commands)
-        
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swap_utils.swap:Waiting for random X move"))
-        time.sleep(DelayAfterExtruderMovedToWipeLocationBeforeDeployingWiper/1000) #Delay after moving extruder to wipe location
-        
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swap_utils.swap:Waiting to deloy wiper"))
-        #deploy the wiper
-        Deploy_Wiper(plugin)
+    #the wiper is deployed once the printer reports the move done, see WIPE_RECIPE in swap_recipes.py
+    #the recipe has no steps when NozzleWipe is off
+    plugin.swap_programs["wipe"].run(plugin, wipe_x=randomXpositionForWipe)
+    plugin.swap_tracer.mark("wipe")
         
     #change tool
     #send WAIT for temp heat up
-    #signal temp heat up complete with M117/M118
-    gcode_commands =[f"T{plugin.next_extruder}",
-                     f"M109 S{plugin.currentTargetTemp}", #Wait for heat to stabilize
-                     "G4",
-                     "G92 E0; reset the extruder position",
-                     "G4",
-                     f"G1 E{ExtraExtrusionAfterSwap} F300",
-                     "G4",
-                     "G92 E0; reset the extruder position",
-                     "G4",
-                     f"G1 E-{RetractionDistanceAfterSwap} F2100",
-                     "G92 E0; reset the extruder position",
-                     "G4",
-                     f"G1 X{xPositionAfterWipe} F{yBreakStringSpeed}", #move extruder off the wipe pad (this is the actual "wipe")
-                     "G4",
-                     "M118 E1 StowWiper",   # Echo command updated works with i3
-                     "M117 E1 StowWiper"]  # Echo command updated works with virtual printer
-    #insert the tool command here so that the filament is switched
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Tool change sent by Swap_utils.swap()"))
-    plugin._printer.commands(gcode_commands)
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Aug23.Swap_utils.swap.next_extruder:Printer moves executed. Must be after OK."))
-
-    
-    #set the LCD display to show the currently loaded insert
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swap_utils.Swap: Setting LCD message: InsertNumber{int(plugin.next_extruder) + 1}"))
-    command = f"InsertNumber{int(plugin.next_extruder) + 1}"
-    perform_command(plugin, command)
-    
+    #the StowWiper echo after the wipe stows the wiper and resumes the print, see RESUME_RECIPE in swap_recipes.py
+    #then set the LCD display to show the currently loaded insert
+    #the echo after the M109 ends the reheat phase of the swap trace
+    #with NozzleWipe off the print resumes as soon as the tool change is queued, the reheat is not part of the swap
+    plugin.log.debug("Tool change sent by Swap_utils.swap()")
+    reheat_token, reheated = plugin.echo_waiter.expect()
+    if settings.NozzleWipe:
+        reheated.add_done_callback(lambda _: plugin.swap_tracer.mark("reheat"))
+    plugin.swap_programs["resume"].run(plugin,
+                                       next_extruder=plugin.next_extruder,
+                                       target_temperature=plugin.currentTargetTemp,
+                                       reheat_token=reheat_token,
+                                       insert_number=int(plugin.next_extruder) + 1)
+    plugin.log.debug("Aug23.Swap_utils.swap.next_extruder:Printer moves executed. Must be after OK.")
 
     plugin.current_extruder = plugin.next_extruder  # current_extruder becomes next_extruder
     plugin.next_extruder = None
@@ -175,10 +168,12 @@ def swap(plugin):
     #nothing to unload
     if not plugin.InitialLoadComplete:
         plugin.InitialLoadComplete = True
+    plugin.journal_swap_state()
+    plugin.wear_counters.count_swap()
         
     
         
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="*****Swap_utils.swap().Swap complete*****"))
+    plugin.log.info("*****Swap_utils.swap().Swap complete*****")
  
         
     return True, str("")
\ No newline at end of file
@@ -1,26 +1,24 @@
 # Octoprint plugin name: Swapper3D, File: Swapper3D_utils.py, Author: BigBrain3D, License: AGPLv3 
 # Import required libraries
+import os
 import serial
 import serial.tools.list_ports
+import threading
 import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from .frame_codec import FrameReader, decode_frame, encode_frame, parity_bit
+from .serial_engine import attach_serial_engine
+from .swap_trace import command_span_name
 
 def parity_of(input_string):
     """
     Function to calculate parity bit for a given string.
+    The bits are counted with the lookup table in frame_codec.
 
     :param input_string: String value to calculate parity for
     :return: Parity bit (0 or 1)
     """
-    count = 0
-    for ch in input_string:
-        value = ord(ch)
-        while value:
-            count += 1
-            value = value & (value - 1)
-    return ~count & 1  # returns 1 for odd parity, 0 for even parity
-
-def send_plugin_message(plugin, message):
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=message))
+    return parity_bit(input_string.encode('latin-1'))  # returns 1 for an even number of set bits, 0 for odd
 
 def check_parity(plugin, message):
     received_parity_bit = int(message[-1])  # extract the last character from the message
@@ -28,335 +26,234 @@ def check_parity(plugin, message):
     calculated_parity_bit = parity_of(message_without_parity_bit)
     
     if received_parity_bit != calculated_parity_bit:
-        send_plugin_message(plugin, f"Parity check failed for message: {message_without_parity_bit}")
+        plugin.log.error("Parity check failed for message: %s", message_without_parity_bit)
         return False
     else:
-        #send_plugin_message(plugin, f"Parity check passed for message: {message_without_parity_bit}")
+        #plugin.log.info("Parity check passed for message: %s", message_without_parity_bit)
         return True
 
+# The Arduino Uno only buffers 64 received bytes, a batch must never be larger than that or frames get dropped
+SWAPPER_RX_BUFFER_SIZE = 64
+
 # Write a message with parity to the serial connection
-def write_message_with_parity(plugin, message):
-    parity_bit = parity_of(message)
-    send_plugin_message(plugin, f"Parity bit for '{message}': {parity_bit}")
-    plugin.serial_conn.write((message + str(parity_bit) + '\n').encode())
-
-# Read a response from the serial connection and check its parity
-def read_and_check_response(plugin):
-    response = plugin.serial_conn.readline().decode('utf-8')
-    print(f"Raw response: {repr(response)}")
-    
-    # Check if the response is a complete line
-    if not response.endswith('\n'):
-        print("Incomplete response received, ignoring.")
-        return None, None
-
-    response = response.strip()
-
-    # Check if the response is not empty before attempting to check the parity
-    if response:
-        received_parity_bit = int(response[-1])  # extract the last character from the message
-        message_without_parity_bit = response[:-1]
-        calculated_parity_bit = parity_of(message_without_parity_bit)
-
-        if received_parity_bit != calculated_parity_bit:
-            send_plugin_message(plugin, f"Parity check failed for message: {response}")
-            return False, None
-        else:
-            return True, message_without_parity_bit
+# the write is queued on the serial engine, which owns the port, and adds the parity bit itself
+# message can also be a list of commands, they are then written as one framed batch and a list of futures is returned
+def write_message_with_parity(plugin, message, WaitForOk=False):
+    if isinstance(message, (list, tuple)):
+        return plugin.serial_engine.submit_batch(message)
+    return plugin.serial_engine.submit(message, WaitForOk)
+
+def get_command_timeout(plugin):
+    # seconds to wait for "<command>_ok" before giving up, from the settings page
+    return plugin.settings_snapshot.commandTimeout
+
+def wait_for_ok(plugin, command, future, timeout):
+    try:
+        success, error = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        error = f"Timed out after {timeout}s waiting for '{command}_ok'"
+        plugin.serial_engine.cancel(future, error)
+        plugin.log.error("2C.Command '%s' failed. %s", command, error)
+        return False, error
+
+    if success:
+        latency = getattr(future, 'latency', 0)
+        plugin.log.debug("2B.Command '%s' succeeded in %.0fms.", command, latency * 1000)
+        plugin.swap_tracer.record(command_span_name(command), latency)
+        plugin.wear_counters.count_command(command)
     else:
-        send_plugin_message(plugin, "Received empty response")
-        return None, None
+        # Log if the parity check failed and return an error
+        plugin.log.error("2C.Command '%s' failed.", command)
+    return success, error
 
+# Abstract the common operations of swap_to_insert and unload_insert into one function
+# The serial engine owns the port: it writes the command and its reader thread resolves our future
+# when the matching "<command>_ok" arrives, so callers never read from the port themselves.
+# There is no fixed sleep anymore, we return as soon as the ok is read.
+# timeout: seconds to wait for the ok, None uses the commandTimeout setting
+# command can also be a list of steps that may be batched, see perform_command_batch()
+def perform_command(plugin, command, WaitForOk=True, timeout=None):
+    if isinstance(command, (list, tuple)):
+        step_results = perform_command_batch(plugin, command, timeout)
+        for step, success, error in step_results:
+            if not success:
+                return False, f"Step '{step}' failed: {error}"
+        return True, None
 
+    if plugin.serial_engine is None:
+        plugin.log.error("2C.Command '%s' failed. Swapper3D is disconnected", command)
+        return False, "Swapper3D is disconnected"
 
-# Abstract the common operations of swap_to_insert and unload_insert into one function
-def perform_command(plugin, command, WaitForOk=True):
     # Send the command with parity to the Swapper3D device
-    write_message_with_parity(plugin, command)
-    time.sleep(1)
+    future = write_message_with_parity(plugin, command, WaitForOk)
 
     if not WaitForOk:
         # Log that we are sending the command without waiting for an "ok" response
-        send_plugin_message(plugin, f"2A.Sending command {command} to Swapper3D. NOT waiting for OK")
+        plugin.log.debug("2A.Sending command %s to Swapper3D. NOT waiting for OK", command)
         return True, None
 
-    # Construct the expected response string, which should match the command followed by "_ok"
-    expected_response_prefix = f"{command}_ok"
-    
-    while True:
-        # Read and check the response from the device
-        check_response, response_without_parity = read_and_check_response(plugin)
-
-        # Debugging the full original response (including the parity bit)
-        # send_plugin_message(plugin, f"Full Response: [{response_without_parity}]")
-
-        # If the response is empty, continue reading until a valid response is received
-        if check_response is None:
-            continue
-        elif check_response:
-            # Log the actual response received and compare it to the expected response
-            # comparison_result = "same" if response_without_parity == expected_response_prefix else "not the same"
-            
-            # Log the character-by-character comparison
-            response_chars = ' '.join(f"[{ord(c)}]" for c in response_without_parity)
-            # expected_chars = ' '.join(f"[{ord(c)}]" for c in expected_response_prefix)
-
-            # debug_message = (
-                # f"Received: [{response_without_parity}] "
-                # f"compared to Expected: [{expected_response_prefix}] - {comparison_result}\n"
-                # f"Response chars: {response_chars}\n"
-                # f"Expected chars: {expected_chars}"
-            # )
-            # send_plugin_message(plugin, debug_message)
-            
-            send_plugin_message(plugin, response_chars)
-
-            # If the response matches the expected command-specific 'ok', log success and return
-            if response_without_parity == expected_response_prefix:
-                send_plugin_message(plugin, f"2B.Command '{command}' succeeded.")
-                return True, None
-        else:
-            # Log if the parity check failed and return an error
-            send_plugin_message(plugin, f"2C.Command '{command}' failed.")
-            return False, "Parity check did not pass."
-
-
-
+    if timeout is None:
+        timeout = get_command_timeout(plugin)
+
+    return wait_for_ok(plugin, command, future, timeout)
+
+# Send several steps that the caller knows can run back to back on the Swapper3D (nothing has to happen on the
+# printer in between) as framed batches, so the link turnaround is paid once per batch instead of once per step.
+# The firmware still executes and acks every step in order; each step gets its own timeout.
+# Steps after a failed step are not waited for and are reported as skipped.
+# Returns a per-step status list: [(command, success, error), ...]
+def perform_command_batch(plugin, commands, timeout=None):
+    if timeout is None:
+        timeout = get_command_timeout(plugin)
+
+    if not plugin.settings_snapshot.BatchSwapperCommands:
+        step_results = []
+        for command in commands:
+            success, error = perform_command(plugin, command, True, timeout)
+            step_results.append((command, success, error))
+            if not success:
+                step_results.extend((skipped, False, "Skipped after a failed step") for skipped in commands[len(step_results):])
+                break
+        return step_results
+
+    if plugin.serial_engine is None:
+        plugin.log.error("2C.Batch %s failed. Swapper3D is disconnected", commands)
+        return [(command, False, "Swapper3D is disconnected") for command in commands]
+
+    # split into chunks that fit into the firmware receive buffer, each frame is the command + parity bit + newline
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for command in commands:
+        frame_size = len(command) + 2
+        if chunk and chunk_size + frame_size > SWAPPER_RX_BUFFER_SIZE:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(command)
+        chunk_size += frame_size
+    if chunk:
+        chunks.append(chunk)
+
+    step_results = []
+    for chunk in chunks:
+        plugin.log.debug("2A.Sending batch %s to Swapper3D", chunk)
+        futures = write_message_with_parity(plugin, chunk)
+        failed = False
+        for command, future in zip(chunk, futures):
+            if failed:
+                plugin.serial_engine.cancel(future, "Skipped after a failed step")
+                step_results.append((command, False, "Skipped after a failed step"))
+                continue
+            success, error = wait_for_ok(plugin, command, future, timeout)
+            step_results.append((command, success, error))
+            failed = not success
+        if failed:
+            step_results.extend((command, False, "Skipped after a failed step") for command in commands[len(step_results):])
+            break
+
+    return step_results
 
 
 
 def retrieveFirmwareVersion(plugin):
     command = "RetrieveCurrentFirmwareVersion"
-    send_plugin_message(plugin, "Sending command to RetrieveCurrentFirmwareVersion")
+    plugin.log.debug("Sending command to RetrieveCurrentFirmwareVersion")
     return perform_command(plugin, command)
 
+# returns (success, error) like perform_command, the insert only counts as loaded when the Swapper3D acked the load
 def load_insert(plugin, insert_number):
     # Check the printer is connected
     if not plugin._printer.is_operational():
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Printer must be connected to Swap!"))
-        return "Printer not connected" 
+        plugin.log.warning("Printer must be connected to Swap!")
+        return False, "Printer not connected"
 
     command = f"load_insert{insert_number}"
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Sending command to load_insert insert {insert_number}"))
+    plugin.log.debug("Sending command to load_insert insert %s", insert_number)
 
-    
-    if perform_command(plugin, command):
+    success, error = perform_command(plugin, command)
+    if success:
         #updated Aug 17th 2024 makes the "Currently loaded insert" text box in the Swapper3D tab show the same number as the sticker on the tool holder wheel.
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"3.Aug23.Swapper3D_utils.load_insert: OK received? Successfully loaded insert: {str(int(insert_number) + 1)}"))
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="currentlyLoadedInsert", message=str(int(insert_number) + 1))) 
+        plugin.log.debug("3.Aug23.Swapper3D_utils.load_insert: OK received? Successfully loaded insert: %s", int(insert_number) + 1)
+        plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="currentlyLoadedInsert", message=str(int(insert_number) + 1))) 
 
         
         plugin.insertLoaded = True
+        plugin.journal_swap_state()
     else:
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Failed to load"))
+        plugin.log.error("Failed to load insert %s: %s", int(insert_number) + 1, error)
 
-    return True #"OK" updated Aug 23rd 2024
+    return success, error
 
-def unload_insert(plugin):
+# program_name: "unload_filament" also unloads the filament on the printer (M702) while the insert is stowed
+# returns (success, error) like load_insert, the insert only counts as unloaded when the required steps succeeded
+def unload_insert(plugin, program_name="unload"):
     # Check the printer is connected
     if not plugin._printer.is_operational():
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Printer must be connected to Swap!"))
-        return "Printer not connected" 
-
-    UnloadSuccess = True # set to true here and False if there is an error somewhere in this method
-
-    # Get the settings
-    filamentSwitcherType = plugin._settings.get(["filamentSwitcherType"])
-    extrudeSpeedPulldown = plugin._settings.get(["extrudeSpeedPulldown"])
-    extrudeLengthLockingHeight = plugin._settings.get(["extrudeLengthLockingHeight"])
-    extrudeLengthCuttingHeight = plugin._settings.get(["extrudeLengthCuttingHeight"])
-    StockExtruderMaxFeedrate = plugin._settings.get(["StockExtruderMaxFeedrate"])
-    SwapExtruderMaxFeedrate = plugin._settings.get(["SwapExtruderMaxFeedrate"])
-    StockExtruderMaxAcceleration = plugin._settings.get(["StockExtruderMaxAcceleration"])
-    SwapExtruderMaxAcceleration = plugin._settings.get(["SwapExtruderMaxAcceleration"])
-    msDelayAfterExtrude = plugin._settings.get(["msDelayAfterExtrude"])
-    msDelayPerDegreeMovedDuringSwapPulldown = plugin._settings.get(["msDelayPerDegreeMovedDuringSwapPulldown"])
-    retractLengthAfterCut = plugin._settings.get(["retractLengthAfterCut"])
-    retractSpeed = plugin._settings.get(["retractSpeed"])
-    
-    
-    # palette settings
-    extrudeSpeedPaletteCuts = plugin._settings.get(["extrudeSpeedPaletteCuts"])
-    numPaletteCuts = plugin._settings.get(["numPaletteCuts"])
-    lengthAdditionalCut = plugin._settings.get(["lengthAdditionalCut"])
-    delayAfterCut = int(plugin._settings.get(["delayAfterCut"]))
-
-    # Check if msDelayAfterExtrude is not None
-    if msDelayAfterExtrude is not None:
-        # Convert msDelayAfterExtrude to float
-        delayAfterExtrude = float(msDelayAfterExtrude)
-
-        # Send a message to the plugin with the delay time
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Delaying for {msDelayAfterExtrude} milliseconds before extruding..."))
-    else:
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="msDelayAfterExtrude setting is not defined."))
-        return
+        plugin.log.warning("Printer must be connected to Swap!")
+        return False, "Printer not connected"
 
     # begin unload sequence
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Executing unload"))
-        
-    gcode_commands = ["M302 P1 ;allow cold extrusion",
-                      f"M203 E{SwapExtruderMaxFeedrate}",
-                      f"M201 E{SwapExtruderMaxAcceleration}"]
-    plugin._printer.commands(gcode_commands)
-            
-    perform_command(plugin, "unload_connect")
-    
-    #pulldown to locking height
-    # Extrude filament at the same time as the pulldown 
-    #all these commands are sent to the printer at the same time
-    #octoprint moves on but the printer tries to execute the commands
-    #the first command is a delay/sleep/pause, which allow the Swapper3D to get a head start on the pulldown
-    gcode_commands = [f"G4 P{delayAfterExtrude}",
-                      "G92 E0 ;reset extrusion distance",
-                      f"G1 E{extrudeLengthLockingHeight} F{extrudeSpeedPulldown}"]
-    plugin._printer.commands(gcode_commands)
-  
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"msDelayPerDegreeMovedDuringSwapPulldown: {msDelayPerDegreeMovedDuringSwapPulldown}"))
-    perform_command(plugin, f"unload_pulldown_lockingheight{msDelayPerDegreeMovedDuringSwapPulldown}")
-    
-    # pulldown to cutting height
-    # Extrude filament at the same time as the pulldown 
-    gcode_commands = [f"G4 P{delayAfterExtrude}",
-                      "G92 E0 ;reset extrusion distance",
-                      f"G1 E{extrudeLengthCuttingHeight} F{extrudeSpeedPulldown}"]
-    plugin._printer.commands(gcode_commands)
-   
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"msDelayPerDegreeMovedDuringSwapPulldown: {msDelayPerDegreeMovedDuringSwapPulldown}"))
-    perform_command(plugin, f"unload_pulldown_cuttingheight{msDelayPerDegreeMovedDuringSwapPulldown}")
-    
-
-    
-    # whether it's Palette or MMU it always needs to cut and stow the insert
-    #perform_command(plugin, "unload_deploycutter") #commented out on Sep 2nd updated so that command now takes an angle
-#cut cycle
-    perform_command(plugin, "cutter_open")
-    perform_command(plugin, "unload_deploycutter120")
-    perform_command(plugin, "cutter_cut")
-
-      
-
-    # palette multi cuts
-    if filamentSwitcherType == "Palette":
-        # move the tool arm out of the way a little so it's very quick
-        perform_command(plugin, "unload_AvoidBin") #why is there a delay after this before the extrude?? In the firmware there is zero(0)ms delay so it should be instant.
-        
-        intNumPaletteCuts  = int(numPaletteCuts)
-
-        # start palette cut loop
-        for _ in range(intNumPaletteCuts):
-#open
-            perform_command(plugin, "cutter_open")
-
-            # extrude
-            gcode_commands = ["G92 E0 ;reset extrusion distance", 
-                             f"G1 E{lengthAdditionalCut} F{extrudeSpeedPaletteCuts}"]
-            plugin._printer.commands(gcode_commands)
-
-            time.sleep(delayAfterCut/1000)
-
-            # cut
-#cut           
-            perform_command(plugin, "cutter_cut")
-        # end palette cut loop
-
-#cut cycle
-    # perform_command(plugin, "cutter_open")
-    # perform_command(plugin, "unload_deploycutter123")
-    # perform_command(plugin, "cutter_cut")
-    
-    # retract filament
-    # Send the G-code commands to prepare for swap
- #break any string connection between insert and main filament strand
-    gcode_commands = ["G92 E0 ;reset extrusion distance"
-                     ,f"G1 E-10 F300"]
-    plugin._printer.commands(gcode_commands)
-    gcode_commands = ["G92 E0 ;reset extrusion distance"
-                     ,f"G1 E{retractLengthAfterCut} F{retractSpeed}"]
-    plugin._printer.commands(gcode_commands)
-
-#wait for the retract to complete    
-    #RetractDelay = int(lengthAdditionalCut)/(int(extrudeSpeedPaletteCuts)/60) + (10/(300/600))
-    #plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"RetractDelay(sec): {RetractDelay}"))
-    time.sleep(3) #seconds
-#open
-    perform_command(plugin, "cutter_open")
-    
-#stow cutter
-    perform_command(plugin, "unload_stowCutter", True) #must be true. Failing to wait can cause an OK in the wrong spot
-
-#used to retract filament here Sep 2nd 2023
-
-    
-    
-    #commented out because the cutter guard is under the hotend for a long time and there is concern it could melt
-    # perform_command(plugin, "unload_stowInsert", True)
-    # perform_command(plugin, "unload_stowCutter")
+    # the unload recipe was compiled with the current settings, see swap_recipes.py
+    plugin.log.info("Executing unload")
+    UnloadSuccess, results = plugin.swap_programs[program_name].run(plugin)
 
-    perform_command(plugin, "unload_stowInsert", True)
-
-
-    if filamentSwitcherType == "Palette":
-        perform_command(plugin, "unload_dumpWaste")  # Palette only.
-
-#open
-    #perform_command(plugin, "cutter_open") #commented out because it's wrecking the end effector
-    
-    # set the feedrate and acceleration back to Stock
-    gcode_commands = ["M302 S170 ;disable cold extrusion",
-                      f"M203 E{StockExtruderMaxFeedrate}",
-                      f"M201 E{StockExtruderMaxAcceleration}"]
-    plugin._printer.commands(gcode_commands)
-
-    
-    perform_command(plugin, "unloaded_message", False)#added Aug 16th 2024, reset the LCD message to "Ready to Swap!" and Insert "EMPTY"
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"UnloadSuccess: {UnloadSuccess}"))
+    plugin.log.debug("UnloadSuccess: %s", UnloadSuccess)
 
+    error = None
     if UnloadSuccess:        
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="currentlyLoadedInsert", message="Empty"))
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swapped to insert: Empty"))
+        plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="currentlyLoadedInsert", message="Empty"))
+        plugin.log.info("Swapped to insert: Empty")
 
         plugin.insertLoaded = False
+        plugin.journal_swap_state()
     else:
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Failed to Unload"))
+        error = "; ".join(f"{name}: {step_error}" for name, (success, step_error) in results.items() if not success)
+        plugin.log.error("Failed to Unload: %s", error)
 
     #rehome the ToolRotate servo #added Sep 3rd 2024 to try and address the repeatability issue of the TR servo
     perform_command(plugin, "hometoolrotate", False)
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Homed ToolRotate - after unload"))
+    plugin.log.debug("Homed ToolRotate - after unload")
 
 
-    return True
+    return UnloadSuccess, error
 
 def get_firmware_version(plugin):
     version_parts = []
     for command in ["readmajor", "readminor", "readpatch"]:
         result, error = perform_command(plugin, command)
         if result:
-            version_part = plugin.serial_conn.readline().decode('utf-8').strip()[:-1]
+            # the version part follows the ok as its own frame, the serial engine hands it over as unsolicited
+            version_part = plugin.serial_engine.read_unsolicited(timeout=10)
+            if version_part is None:
+                return None, f"No firmware version received for command '{command}'"
             version_parts.append(version_part)
         else:
-            send_plugin_message(plugin, f"Failed to get part of firmware version with command '{command}': {error}")
+            plugin.log.error("Failed to get part of firmware version with command '%s': %s", command, error)
             return None, error
 
     return '.'.join(version_parts), None
 
 def unload_filament(plugin):
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="unload_filament called"))
+    plugin.log.debug("unload_filament called")
 
     if plugin.insertLoaded:
-        unload_insert(plugin)
+        # the M702 goes to the printer as part of the unload, once the retract is done, see swap_recipes.py
+        unload_insert(plugin, "unload_filament")
     else:
-        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="No insert in QuickSwap-Hotend. Unload Skipped."))
-    
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="sending M702 C back to queue"))
-    gcode_commands = [f"M702 C ;Sent by Swapper3D_utils.unload_filament()"]
-    plugin._printer.commands(gcode_commands)
-    
-    #plugin.SwapInProcess = False #cannot set to false here or it will cause an infinite loop
+        plugin.log.warning("No insert in QuickSwap-Hotend. Unload Skipped.")
+        plugin.log.debug("sending M702 C back to queue")
+        gcode_commands = [f"M702 C ;Sent by Swapper3D_utils.unload_filament()"]
+        plugin._printer.commands(gcode_commands)
+
+    #the M702 has passed the queuing hook by now, so this does not intercept it again
+    #the print only resumes once the cutter and the insert are stowed
+    plugin.SwapInProcess = False
+    plugin._printer.commands("@resume")
     return True
     
 def Deploy_Wiper(plugin):
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Swapper3D_utils.Deploy_Wiper()"))
+    plugin.log.debug("Swapper3D_utils.Deploy_Wiper()")
     perform_command(plugin, "wiper_deploy", True)
     return True
     
@@ -365,7 +262,7 @@ def Stow_Wiper(plugin):
     perform_command(plugin, "wiper_stow", True)
     
     #Restore the fan to its original speed
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Swapper3D_utils.Stow_Wiper: Printer resumed. Setting fan speed to: {plugin.current_fan_speed}"))
+    plugin.log.debug("Swapper3D_utils.Stow_Wiper: Printer resumed. Setting fan speed to: %s", plugin.current_fan_speed)
     gcode_commands = [f"M106 S{plugin.current_fan_speed} ;restore fan speed",
                       "@resume"]
     plugin._printer.commands(gcode_commands)
@@ -373,75 +270,227 @@ def Stow_Wiper(plugin):
     
     plugin.SwapInProcess = False
     plugin.extrusionSinceLastSwap = 0
+    plugin.journal_swap_state()
+    plugin.swap_tracer.end_swap()
     
     #rehome the ToolRotate servo #added Sep 3rd 2024 to try and address the repeatability issue of the TR servo
     perform_command(plugin, "hometoolrotate", False)
-    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Homed ToolRotate - after wiper stowed"))
+    plugin.log.debug("Homed ToolRotate - after wiper stowed")
 
     
     return True
     
-def try_handshake(plugin):
+def get_candidate_ports(plugin, ports=None):
+    # Ports given by the caller, or the serialPortOverride setting (e.g. the pty of simulator.py), are used as they are.
+    if ports:
+        return list(ports)
+    override = plugin.settings_snapshot.serialPortOverride
+    if override:
+        return [override]
+
     # Identify the available Arduino ports. The list only includes ports with 'Arduino Uno' in their description.
     # This avoids connecting to other devices and interfering with the printer connection.
+    # The last port that completed a handshake is tried first, even if its description changed.
+    # serialPort and baudrate are written by try_handshake itself, not by the settings page, so they are read from
+    # the settings and not from the settings snapshot.
     arduino_ports = [port.device for port in serial.tools.list_ports.comports() if 'Arduino Uno' in port.description]
+    last_port = plugin._settings.get(["serialPort"])
+    if last_port and os.path.exists(last_port):
+        if last_port in arduino_ports:
+            arduino_ports.remove(last_port)
+        arduino_ports.insert(0, last_port)
+    return arduino_ports
+
+# Baud rates the plugin can negotiate, fastest first. 9600 is what every firmware starts with.
+SUPPORTED_BAUDRATES = [115200, 57600, 38400, 19200, 9600]
+DEFAULT_BAUDRATE = 9600
+
+def get_handshake_baudrates(plugin):
+    # the rate stored by the last negotiation is tried first, old firmware always answers at 9600
+    try:
+        stored = int(plugin._settings.get(["baudrate"]))
+    except (TypeError, ValueError):
+        stored = DEFAULT_BAUDRATE
+    if stored == DEFAULT_BAUDRATE:
+        return [DEFAULT_BAUDRATE]
+    return [stored, DEFAULT_BAUDRATE]
+
+def read_frame(ser, reader, timeout, expected=None):
+    # synchronous read of one valid frame, only used before the serial engine owns the port
+    # with expected set, other frames (e.g. late answers to repeated handshakes) are skipped
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            continue
+        for frame in reader.feed(data):
+            valid, message = decode_frame(frame)
+            if valid and (expected is None or message == expected):
+                return message
+    return None
+
+# Handshake with one port. Opening the port resets the Arduino, instead of sleeping until it has booted
+# the handshake frame is repeated until a reply with valid parity arrives or the deadline passes.
+# Each rate in baudrates gets a few seconds (enough for the bootloader), the last one gets the rest of the time.
+# Returns the open serial connection, or None. Gives up early when another port already won (found is set).
+def probe_port(plugin, port, baudrates, deadline, found):
+    handshake_frame = encode_frame('octoprint')
+    retry_interval = 0.5
+    try:
+        plugin.log.debug("Trying to connect to port %s...", port)
+        ser = serial.Serial(port, baudrates[0], timeout=0.1)
+    except serial.SerialException as e:
+        # If there is an error in connecting to the serial port, catch and log the exception
+        plugin.log.debug("Failed to connect to %s: %s", port, e)
+        return None
+
+    try:
+        for index, baudrate in enumerate(baudrates):
+            # changing the rate of an open port does not reset the Arduino
+            ser.baudrate = baudrate
+            reader = FrameReader()
+            baudrate_deadline = deadline if index == len(baudrates) - 1 else min(deadline, time.monotonic() + 3)
+            next_write = 0
+            while time.monotonic() < baudrate_deadline and not found.is_set():
+                now = time.monotonic()
+                if now >= next_write:
+                    ser.write(handshake_frame)
+                    next_write = now + retry_interval
+
+                data = ser.read(ser.in_waiting or 1)
+                if not data:
+                    continue
+
+                for frame in reader.feed(data):
+                    valid, response_message = decode_frame(frame)
+                    if valid:
+                        plugin.log.debug("Received: %s (%s baud)", response_message, baudrate)
+                        return ser
+                    plugin.log.debug("Parity check failed for message: %s", frame.decode('ascii', 'replace'))
+    except serial.SerialException as e:
+        plugin.log.debug("Failed to connect to %s: %s", port, e)
+
+    ser.close()
+    return None
+
+# Raise the link speed after a handshake. Protocol:
+#   host -> "setbaud<rate>" at the current rate
+#   firmware -> "setbaud<rate>_ok" at the current rate, then switches and remembers the rate for its next boot.
+#               If it does not receive a valid frame at the new rate within 1 second it switches back.
+#   host switches too and repeats the handshake at the new rate to confirm.
+# Firmware that does not know setbaud never answers it, the link then simply stays at the current rate.
+def negotiate_baudrate(plugin, ser):
+    max_baudrate = plugin.settings_snapshot.maxBaudrate
+
+    current = ser.baudrate
+    for baudrate in SUPPORTED_BAUDRATES:
+        if baudrate > max_baudrate or baudrate <= current:
+            continue
+
+        reader = FrameReader()
+        ser.reset_input_buffer()
+        ser.write(encode_frame(f"setbaud{baudrate}"))
+        if read_frame(ser, reader, 0.5, f"setbaud{baudrate}_ok") is None:
+            plugin.log.warning("Swapper3D firmware does not support a faster link, staying at %s baud", current)
+            break
+
+        ser.baudrate = baudrate
+        ser.write(encode_frame('octoprint'))
+        if read_frame(ser, FrameReader(), 0.5) is not None:
+            plugin.log.info("Swapper3D link switched to %s baud", baudrate)
+            return baudrate
+
+        # the firmware switches back after 1 second without a valid frame, confirm at the old rate and try slower
+        plugin.log.warning("No reply at %s baud, falling back to %s baud", baudrate, current)
+        ser.baudrate = current
+        time.sleep(1)
+        ser.reset_input_buffer()
+        ser.write(encode_frame('octoprint'))
+        if read_frame(ser, FrameReader(), 1) is None:
+            return None
+
+    return ser.baudrate
+
+# All candidate ports are probed at the same time and the first one that answers the handshake wins.
+# ports: optional list of port names to probe instead of looking for an 'Arduino Uno'
+def try_handshake(plugin, ports=None):
+    arduino_ports = get_candidate_ports(plugin, ports)
 
     # If no Arduino ports are found, return an error message.
     if not arduino_ports:
         return None, "No Swapper3D found. Are you sure the USB is plugged between the Swapper3D and Octoprint?"
 
-    # Try to connect to each Arduino port found
-    for port in arduino_ports:
-        try:
-            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Trying to connect to port {port}..."))
-            ser = serial.Serial(port, 9600, timeout=10)  # Increased the timeout to 10 seconds to account for slower Raspberry Pi responses.
-            time.sleep(3)  # Allow some time for the connection to stabilize.
-
-            connection_attempts = 3  # Allow 3 connection attempts
-            while connection_attempts > 0:
-                plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Sending handshake message 'octoprint'..."))
-                message = 'octoprint'
-                parity_bit = parity_of(message)
-                plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Parity bit for 'octoprint': {parity_bit}"))
-                ser.write((message + str(parity_bit) + '\n').encode())
-                time.sleep(3)
-
-                read_attempts = 3  # Try to read the response up to 3 times with a 3-second delay between reads
-                while read_attempts > 0:
-                    time.sleep(3)  # Wait 3 seconds before trying to read the response
-                    response = ser.readline().decode('utf-8').strip()
-                    plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Received: {response}"))
-
-                    if response:
-                        # Split the received message and parity bit
-                        response_message, response_parity_bit = response[:-1], response[-1]
-
-                        # Calculate and check the parity of the received message
-                        if parity_of(response_message) == int(response_parity_bit):
-                            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Handshake successful!"))
-                            plugin._settings.set(["serialPort"], port)
-                            plugin._settings.set(["baudrate"], ser.baudrate)
-                            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Connected"))
-                            time.sleep(3)
-                            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Ready to Swap!"))
-                            return ser, None
-                        else:
-                            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Parity check failed for message: {response_message}"))
-                    else:
-                        plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="No response received"))
-                    
-                    read_attempts -= 1  # Decrement the number of read attempts
-
-                # After 3 read attempts, decrement the connection attempts
-                connection_attempts -= 1
-
-            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message="Handshake failed, closing connection."))
-            ser.close()
-            return None, f"Failed to handshake with the device on port {port}. No valid response received after 3 read attempts"
-        
-        # If there is an error in connecting to the serial port, catch and log the exception
-        except serial.SerialException as e:
-            plugin._plugin_manager.send_plugin_message(plugin._identifier, dict(type="log", message=f"Failed to connect to {port}: {e}"))
-    
-    # If no ports are successfully connected, return a failure message.
-    return None, "Failed to connect to any port"
+    baudrates = get_handshake_baudrates(plugin)
+    deadline = time.monotonic() + 10  # 10 seconds is plenty for the Arduino to boot, also on a slow Raspberry Pi
+    found = threading.Event()
+    lock = threading.Lock()
+    winner = []
+
+    def probe(port):
+        ser = probe_port(plugin, port, baudrates, deadline, found)
+        if ser is None:
+            return
+        with lock:
+            if winner:
+                ser.close()  # another port answered first
+                return
+            winner.append((port, ser))
+            found.set()
+
+    plugin.log.debug("Sending handshake message 'octoprint'...")
+    threads = [threading.Thread(target=probe, args=(port,), name=f"Swapper3D-handshake-{port}", daemon=True) for port in arduino_ports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not winner:
+        plugin.log.error("Handshake failed, closing connection.")
+        # If no ports are successfully connected, return a failure message.
+        return None, f"Failed to handshake with the Swapper3D on {', '.join(arduino_ports)}. No valid response received"
+
+    port, ser = winner[0]
+    plugin.log.info("Handshake successful!")
+
+    if negotiate_baudrate(plugin, ser) is None:
+        ser.close()
+        return None, f"Lost the Swapper3D on {port} while changing the baud rate"
+    # remember the port and rate so the next connect (e.g. after a reboot) tries them first
+    plugin._settings.set(["serialPort"], port)
+    plugin._settings.set(["baudrate"], ser.baudrate)
+    plugin._settings.save()
+    plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Connected"))
+    return ser, None
+
+# Handshake, hand the port to the serial engine and home ToolRotate.
+# Runs in the background from on_after_startup and the connect REST command so that neither
+# OctoPrint's startup nor the Flask worker waits for the Swapper3D.
+def connect_swapper(plugin, ports=None):
+    if not plugin.connect_lock.acquire(blocking=False):
+        plugin.log.warning("Already connecting.")
+        return False
+
+    try:
+        plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Connecting..."))
+        success, error = try_handshake(plugin, ports)
+        if not success:
+            plugin.log.error("Handshake failed: %s", error)
+            plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Disconnected"))
+            return False
+
+        attach_serial_engine(plugin, success)
+        plugin.link_watchdog.link_up()
+        plugin.message_channel.send_plugin_message(plugin._identifier, dict(type="connectionState", message="Ready to Swap!"))
+
+        #Home the TR servo on the Swapper3D
+        #rehome the ToolRotate servo #added Sep 3rd 2024 to try and address the repeatability issue of the TR servo
+        perform_command(plugin, "hometoolrotate", False)
+        plugin.log.debug("Homed ToolRotate - after connect from try handshake")
+        return True
+    finally:
+        plugin.connect_lock.release()
+
+def connect_swapper_in_background(plugin, ports=None):
+    thread = threading.Thread(target=connect_swapper, args=(plugin, ports), name="Swapper3D-connect", daemon=True)
+    thread.start()
+    return thread
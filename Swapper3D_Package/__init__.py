@@ -1,25 +1,57 @@
 # Octoprint plugin name: Swapper3D, File: __init__.py, Author: BigBrain3D, License: AGPLv3
 import os
 import time
+import traceback
 import octoprint.plugin
+from flask import jsonify
 import serial
 import threading
 from .commands import handle_command
 from .gcode_injector import inject_gcode
 from .default_settings import get_default_settings
 from .Swap_utils import PreparePrinterForSwap, bore_align_on, bore_align_off, swap
-from .Swapper3D_utils import load_insert, unload_insert, unload_filament, Stow_Wiper, try_handshake, perform_command 
+from .Swapper3D_utils import load_insert, unload_insert, unload_filament, Stow_Wiper, connect_swapper_in_background, perform_command 
+from .link_watchdog import LinkWatchdog
+from .message_channel import MessageChannel
+from .swapper_log import SwapperLog
+from .settings_snapshot import build_settings_snapshot, validate_settings_update
+from .swap_plan import SwapPlanCursor, get_swap_plan, SKIP_MIN_EXTRUSION
+from .swap_time_estimator import SwapCostModel, create_estimator_factory
+from .step_scheduler import EchoWaiter
+from .printer_echoes import match_received_line
+from .gcode_parsing import param_float, param_str
+from .printer_state import PrinterStateTracker
+from .motion_model import MotionClock, MotionModel
+from .swap_recipes import compile_recipes
+from .swap_trace import SwapTracer
+from .device_executor import DeviceExecutor
+from .swap_journal import SwapJournal, STATE_KEYS
+from .wear_counters import WearCounters, COUNTER_KEYS
 
 class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
                       octoprint.plugin.TemplatePlugin,
                       octoprint.plugin.AssetPlugin,
                       octoprint.plugin.BlueprintPlugin,
                       octoprint.plugin.SettingsPlugin,
+                      octoprint.plugin.ShutdownPlugin,
                       octoprint.plugin.EventHandlerPlugin):  # added EventHandlerPlugin
 
     def __init__(self):
         super().__init__()
         self.serial_conn = None  # to hold our serial connection
+        self.serial_engine = None  # owns serial_conn once connected, all Swapper3D commands go through it
+        self.message_channel = MessageChannel(self)  # coalesces the messages to the UI, see message_channel.py
+        self.log = SwapperLog(self)  # leveled log to the UI and octoprint.log, level from the logLevel setting
+        self.settings_snapshot = None  # typed settings, rebuilt on every settings save, see settings_snapshot.py
+        self.motion_model = None  # how long the printer takes for the swap moves, see motion_model.py
+        self.motion_clock = MotionClock()  # when the moves queued by the swap steps are done
+        self.swap_programs = {}  # swap recipes compiled with the current settings, see swap_recipes.py
+        self.swap_tracer = SwapTracer() #phases and steps of the last swaps, see swap_trace.py and the /trace route
+        self.device_executor = DeviceExecutor(self) #runs the operations started by printer echoes, see device_executor.py
+        self.swap_journal = None #insert in the hotend etc. across restarts, see swap_journal.py
+        self.wear_counters = None #swaps and actuations for maintenance, see wear_counters.py and the /counters route
+        self.connect_lock = threading.Lock()  # held while a handshake is running so connects don't overlap
+        self.link_watchdog = LinkWatchdog(self)  # notices a dead Swapper3D link and reconnects it in the background
         self.serial_thread = None  # to hold our thread
         self.initial_tool_load = False
         self.tool_change_occurred = False
@@ -36,7 +68,23 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
         self.InitialLoadComplete = False #because the currently loaded insert is zero(0) we need this value to know if the first initial tool load has been done
         self.currentTargetTemp = 0 #used to remember any temp that is set before a swap so that it can be returned to that temp after the swap completes
         self.current_fan_speed = 0 #used to remember if the fan was on and to turn it off while swapping and restore it after swap is complete
-        self.extrusionSinceLastSwap = 0 #used to prevent a swap unless the extusion is at least the min from settings. reset in Swap_utils.swap()
+        self.printer_state = PrinterStateTracker() #position, E mode, temperatures and fan as streamed to the printer, see hook_gcode_queuing
+        self.extrusionSinceLastSwap = 0 #used to prevent a swap unless the extusion is at least the min from settings. reset in Swapper3D_utils.Stow_Wiper()
+        self.swap_plan_cursor = None #position in the swap plan of the file that is printing, see swap_plan.py
+        self.swap_plan_swaps = 0 #number of swaps in the swap plan of the file that is printing
+        self.swap_cost_model = None #measured duration of the swap phases, see swap_time_estimator.py
+        self.echo_waiter = EchoWaiter() #motion-complete echoes of the swap steps
+        self._queuing_handlers = self._build_queuing_handlers() #first token of a queued line -> (state update, handler), see hook_gcode_queuing
+        self._received_handlers = self._build_received_handlers() #echo in a received line -> handler, see on_gcode_received
+
+    #the extrusion is counted by the printer state tracker, which knows about M82/M83 and G92 E resets
+    @property
+    def extrusionSinceLastSwap(self):
+        return self.printer_state.extrusion_since_swap
+
+    @extrusionSinceLastSwap.setter
+    def extrusionSinceLastSwap(self, value):
+        self.printer_state.extrusion_since_swap = value
 
 
     def on_event(self, event, payload):
@@ -51,6 +99,26 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
             self.isPrintStarted = True
             self.is_print_done = False
 
+            # the swap plan is loaded (or worked out) while the printer heats up
+            self.swap_plan_cursor = None
+            self.swap_plan_swaps = 0
+            self.swap_cost_model.begin_print()
+            if payload.get("origin") == "local":
+                threading.Thread(target=self.start_swap_plan, args=(payload.get("path"),), daemon=True).start()
+
+        if event in ("PrintDone", "PrintFailed", "PrintCancelled"):
+            self.journal_swap_state()
+            self.swap_plan_cursor = None
+            self.swap_plan_swaps = 0
+            try:
+                self.swap_cost_model.save()
+            except OSError as e:
+                self.log.error("Could not save the swap cost model: %s", e)
+
+        if event == "FileAdded" and payload.get("storage") == "local" and "gcode" in payload.get("type", []):
+            # work the swap plan out right after the upload, so it is ready when the file is printed
+            threading.Thread(target=self.analyze_swap_plan, args=(payload.get("path"),), daemon=True).start()
+
         if event == "PrintDone":
             # The print has finished
             self._logger.info("The print job has finished")
@@ -63,30 +131,110 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
             # Take other actions as necessary
             self.runStartGcode();
             
+    def get_swap_plan_folder(self):
+        return os.path.join(self.get_plugin_data_folder(), "swap_plans")
+
+    def analyze_swap_plan(self, path):
+        try:
+            gcode_path = self._file_manager.path_on_disk("local", path)
+            plan, _ = get_swap_plan(self.get_swap_plan_folder(), gcode_path, self.settings_snapshot.MinExtrusionBeforeSwap)
+        except Exception as e:
+            self.log.error("Could not work out the swap plan of %s: %s", path, e)
+            return None
+
+        skipped = len(plan["tool_changes"]) - plan["swaps"]
+        self.log.info("Swap plan of %s: %s tool changes, %s swaps, %s skipped", path, len(plan["tool_changes"]), plan["swaps"], skipped)
+        for problem in plan["problems"]:
+            self.log.error("%s: %s", path, problem)
+        return plan
+
+    def start_swap_plan(self, path):
+        plan = self.analyze_swap_plan(path)
+        if plan is None:
+            return
+        if plan["problems"] and self.settings_snapshot.RejectBadSwapFiles:
+            self.log.error("Print of %s cancelled, the Swapper3D cannot print this file", path)
+            self._printer.cancel_print()
+            return
+        self.swap_plan_swaps = plan["swaps"]
+        self.swap_plan_cursor = SwapPlanCursor(plan)
+
     #revised on Sept 18th 2024 to handle swapper connection failure
-    def on_after_startup(self):
-        self._logger.info("Swapper3D plugin has started!")
-        success, error = try_handshake(self)
-        if not success:
-            self._logger.error(f"Handshake failed: {error}")
+    #the handshake runs in the background so that OctoPrint's startup is never held up by the Swapper3D
+    def initialize(self):
+        self.refresh_settings_snapshot()
+        self.swap_cost_model = SwapCostModel(os.path.join(self.get_plugin_data_folder(), "swap_cost_model.json"))
+        self.swap_tracer.swap_listeners.append(self.swap_cost_model.add_swap)
+        self.swap_journal = SwapJournal(os.path.join(self.get_plugin_data_folder(), "swap_journal.log"))
+        self.restore_swap_state()
+        self.swap_journal.start()
+        self.device_executor.start()
+        self.wear_counters = WearCounters(os.path.join(self.get_plugin_data_folder(), "wear_counters.json"))
+        self.wear_counters.load(seed={key: getattr(self.settings_snapshot, key) for key in COUNTER_KEYS})
+        self.wear_counters.start()
+
+    #the swap state is journaled on every change so it survives a restart, see swap_journal.py
+    def journal_swap_state(self):
+        if self.swap_journal is None:
             return
-            
-        self.serial_conn = success
+        try:
+            self.swap_journal.record({key: getattr(self, key) for key in STATE_KEYS})
+        except OSError as e:
+            self.log.error("Could not write the swap journal: %s", e)
 
-        if self.serial_conn:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Ready to swap"))
-            perform_command(self, "hometoolrotate", True)
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Homed ToolRotate - __init__.py"))
+    def restore_swap_state(self):
+        state = self.swap_journal.replay()
+        if state is None:
+            return
+        for key in STATE_KEYS:
+            if key in state:
+                setattr(self, key, state[key])
+        if self.insertLoaded and self.current_extruder is not None:
+            self.log.info("Restored swap state: insert %s is loaded", int(self.current_extruder) + 1)
+        else:
+            self.log.info("Restored swap state: no insert loaded")
+
+    #the swap state and the counters are saved first, stopping the executor does not wait for a running operation
+    def on_shutdown(self):
+        self.journal_swap_state()
+        self.swap_journal.close()
+        try:
+            self.wear_counters.stop()
+        except OSError as e:
+            self.log.error("Could not save the wear counters: %s", e)
+        self.device_executor.stop()
+
+    def refresh_settings_snapshot(self):
+        self.settings_snapshot, errors = build_settings_snapshot(self._settings)
+        self.log.update_level()
+        self.motion_model = MotionModel(self.settings_snapshot)
+        for error in errors:
+            self.log.error("Invalid setting %s", error)
+
+        self.swap_programs, errors = compile_recipes(self.settings_snapshot, self.get_recipe_folder())
+        for error in errors:
+            self.log.error("Swap recipe not used, %s", error)
+        for program in self.swap_programs.values():
+            program.timing_hooks.append(self.swap_tracer.on_step_done)
+
+    #swap recipes in this folder replace the built-in ones, see swap_recipes.py
+    def get_recipe_folder(self):
+        return os.path.join(self.get_plugin_data_folder(), "recipes")
+
+    def on_after_startup(self):
+        self._logger.info("Swapper3D plugin has started!")
+        connect_swapper_in_background(self)
+        self.link_watchdog.start()
 
 
     def runStartGcode(self):
         # If the print has not started yet,
         if not self.hasStartGcodeRun:
             # Get the motor current setting 
-            z_motor_current = self._settings.get(["zMotorCurrent"])
+            z_motor_current = self.settings_snapshot.zMotorCurrent
 
             # Log the setting value
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Setting motor current to {z_motor_current}"))
+            self.log.info("Setting motor current to %s", z_motor_current)
 
             # Set the motor current on the printer
             gcode_commands = [f"M906 {z_motor_current}"]
@@ -97,206 +245,53 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
             
             
     def get_e_value_from_cmd(self, cmd):
+        return param_float(cmd, "E")
+
+    #Z the printer will be at once everything queued so far has been executed
+    #from the printer state tracker, OctoPrint is only asked when the stream has not set Z yet
+    def get_streamed_z(self):
+        current_z = self.printer_state.z
+        if current_z is not None:
+            return current_z
+
+        current_z = 0
         try:
-            parts = cmd.split(" ")
-            for part in parts:
-                if part.startswith("E"):
-                    return float(part[1:])
-        except ValueError:
-            pass
-        return None
+            # Get the current Z position of the printer
+            current_z = self._printer.get_current_data()["currentZ"]
+            
+            # If obtained Z position is None, set it to 0
+            if current_z is None:
+                current_z = 0
+        except Exception as e:
+            # Handle or log any exceptions that occurred while getting current_z
+            self.log.error("Exception occurred while getting current Z position: %s", e)
+        return current_z
 
     #this is gcode placed into the queue BEFORE sending to the printer
     #perhaps should be "return cmd," ??
     #cmd contains the entire line BUT we can't intercept comments, BUT we can send any text and it will output on the cmd as long as there is no semi-colon in front of the text
     #don't send commands to the printer in here. It will get stuck and freeze the whole plugin
+    #this runs for every queued line, so it only looks up the command OctoPrint already parsed (gcode, e.g. "G1", "M104", "T")
+    #in a table; every line the plugin does not care about returns right away without touching cmd
+    #each entry is (update of the printer state tracker, plugin handler), either can be None
     def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):        
+        entry = self._queuing_handlers.get(gcode)
+        if entry is None:
+            return
+        state_update, handler = entry
+
         #show all queued commands
-        # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"hook_gcode_queuing.cmd:{cmd}"))
-        # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"hook_gcode_queuing.SwapInProcess:{self.SwapInProcess}"))
-        
-        try:        
-            #sum all extrusion
-            #extrusionSinceLastSwap
-            if (cmd.startswith("G1") or cmd.startswith("G0")):
-                e_value = self.get_e_value_from_cmd(cmd)
-                if e_value is not None:
-                    self.extrusionSinceLastSwap += e_value
-                    # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"hook_gcode_queuing.E value increased:{self.extrusionSinceLastSwap}"))
-            
-            #remember the current hotend temperature
-            if ((cmd.startswith("M109")
-                or cmd.startswith("M104"))
-                and not self.SwapInProcess):
-                self.currentTargetTemp = cmd.split("S")[1]
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Temp recorded:{self.currentTargetTemp}"))
-                
-            #remember the current fan speed
-            if (cmd.startswith("M106")
-                and not self.SwapInProcess):
-                self.current_fan_speed = cmd.split("S")[1]
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Fan speed recorded:{self.current_fan_speed}"))
-                
-            #remember if the fan is turned off
-            if (cmd.startswith("M107")
-                and not self.SwapInProcess):
-                self.current_fan_speed = "0"
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Fan turned off (recorded)"))
-                
-            #we're looking at cmd not gcode now, and if there isn't anything there then a tool change cannot be triggered
-            # #if there is no gcode then return
-            # if not gcode: 
-                # # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"not gcode"))
-                # return
-
-            #Do we care if it's not printing? NO 
-            # if not comm_instance.isPrinting():
-                # return
-                
-            #if a tool change is received 
-            #but we are in the middle of a SWAP
-            #then end the Swap and issue the T command to the printer so that it can switch the filament
-            #also start a wipe to catch the ooze
-            if (cmd.startswith("T") 
-                and self.SwapInProcess):
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Tool change command sent while in Swap"))
-                
-                NozzleWipe = self._settings.get(["NozzleWipe"])
-                #if NozzleWipe == False then resume here
-                #otherwise swap is resumed in Swapper3D_utils.Stow_Wiper()
-                if not NozzleWipe:
-                    self.SwapInProcess = False
-                    self._printer.commands("@resume")
-                                
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"*****Swap_utils.swap().Swap complete - self.SwapInProcess{self.SwapInProcess}*****"))
-                
-                return
-                
-            if (cmd.startswith("M702") 
-                and self.SwapInProcess):
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Filament unload command sent while in Swap"))
-                self.SwapInProcess = False
-                self._printer.commands("@resume")
-                return
-            
-            # If the command is a tool change command (starts with "T")
-            #and not during a Swap
-            #then begin the Swap process
-            if (cmd.startswith("T") 
-            and not self.SwapInProcess):
-                if not comm_instance.isOperational():
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Printer is not connected"))
-                    return
-                
-                if self.serial_conn is None:
-                    # self._logger.info("Swapper3D is disconnected")
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Swapper3D is disconnected"))
-                    return
-            
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"hook_gcode_queuing.Processing tool change cmd:{cmd}"))
-                # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"gcode: {gcode}"))
-                # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"cmd: {cmd}"))
-                # self._logger.info("Processing tool change command")
-                          
-
-                # Update the next extruder based on the command
-                self.next_extruder = cmd[1:]
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"queue.Current extruder: {self.current_extruder}"))
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"queue.Next extruder: {self.next_extruder}"))
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"hasStartGcodeRun: {self.hasStartGcodeRun}"))
-
-
-                # If the current and next extruders are the same
-                # if the initial load is not complete and the current ext is not none then skip this guard
-                #, log the corresponding message and return
-                if (self.InitialLoadComplete 
-                and self.current_extruder is not None 
-                and self.current_extruder == self.next_extruder):
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Current and next Tools are the same AND the initial load is complete. Skipping swap."))
-                    return None #make sure that the tool change doesn't happen. If it did the filament would be pulled, uncut, from the quickswap insert
-
-                #Stop the Swap if the filament extuded 
-                #since the last swap is less than the minimum
-                MinExtrusionBeforeSwap = int(self._settings.get(["MinExtrusionBeforeSwap"]))
-                if (self.InitialLoadComplete 
-                and self.current_extruder is not None 
-                and self.extrusionSinceLastSwap < MinExtrusionBeforeSwap):
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Prevented swap because of too short extusion: {self.extrusionSinceLastSwap}"))
-                    return None #not enough extrusion to get the filament into the insert, so prevent this tool change, otherwise the filament will get pulled out and jam the print head
-
-
-                # Initialize current_z outside the try block
-                current_z = 0
-                
-                #if the printer is printing then assume that it's already been homed
-                #otherwise it's probably a manually issued T command and then the printer should be homed Just to be safe
-                if comm_instance.isPrinting():
-                    HomeAxis = False
-                    
-                    #only try to get the current Z during a print
-                    #otherwise the Tool command was sent manually
-                    #and the printer will be homed
-                    #which means that the Z will be zero(0) and the Z needs to be moved up to 95
-                    try:
-                        # Get the current Z position of the printer
-                        current_z = self._printer.get_current_data()["currentZ"]
-                        
-                        # If obtained Z position is None, set it to 0
-                        if current_z is None:
-                            current_z = 0
-                    except Exception as e:
-                        # Handle or log any exceptions that occurred while getting current_z
-                        self._plugin_manager.send_plugin_message(f"Exception occurred while getting current Z position: {e}")
-                else:
-                    #should ALWAYS be true becuase the users could have moved the Z position manually between the load and subsequent load/unloads
-                    HomeAxis = True
-                
-
-
-                # Send the current Z position to the plugin manager
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="current_z", message=str(current_z)))
-
-                # Prepare the printer for the swap
-                self.SwapInProcess = True
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Enqueue Paused"))
-                self._printer.commands("@pause")
-                # self._printer.pause_print() #don't need this
-                
-                thread = threading.Thread(target=PreparePrinterForSwap, args=(self, current_z, HomeAxis, "readyForSwap")) 
-                thread.start()
-                
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"T{self.next_extruder} command intercepted"))
-                return None #prevent the T command from being issued to the printer. It will be sent from the swap method
-                
-            if  (not self.SwapInProcess
-                and ("M73 Q100" in cmd
-                    or cmd.startswith("M702"))):
-                            
-                HomeAxis = False #set to False for production
-                current_z = 0
-                try:
-                    # Get the current Z position of the printer
-                    current_z = self._printer.get_current_data()["currentZ"]
-                    
-                    # If obtained Z position is None, set it to 0
-                    if current_z is None:
-                        current_z = 0
-                except Exception as e:
-                    # Handle or log any exceptions that occurred while getting current_z
-                    self._plugin_manager.send_plugin_message(f"Exception occurred while getting current Z position: {e}")
-            
-                #send command "unload" to commands.py handle_command
-                self.SwapInProcess = True
-                self._printer.commands("@pause")
-                
-                thread = threading.Thread(target=PreparePrinterForSwap, args=(self, current_z, HomeAxis, "readyForFilamentUnload")) 
-                thread.start()
-                return None #"Filament Unload command intercepted" #prevent the unload command from being sent to the printer. It will be sent from the unload command
-                
+        # self.log.debug("hook_gcode_queuing.cmd:%s", cmd)
+        # self.log.debug("hook_gcode_queuing.SwapInProcess:%s", self.SwapInProcess)
 
+        try:
+            if state_update is not None:
+                state_update(cmd)
+            if handler is not None:
+                return handler(comm_instance, cmd)
         except Exception as e:
             # If an error occurs, log the error message
-            self._logger.error(f"An error occurred in hook_gcode_queuing: {str(e)}")
+            self._logger.error("An error occurred in hook_gcode_queuing: %s", e)
             
             # Also log the stack trace of the error
             self._logger.error(traceback.format_exc())
@@ -304,89 +299,278 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
         # Returns the command unmodified
         return
 
-    #this is gcode FROM THE PRINTER
-    def on_gcode_received(self, comm, line, *args, **kwargs):
-        #show all received commands
-        # if (not line.startswith("T:")
-            # and not line == ""):
-            # self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"on_gcode_received.line:{line}"))
+    def _build_queuing_handlers(self):
+        state = self.printer_state
+        return {
+            "G0": (state.on_move, None),
+            "G1": (state.on_move, None),
+            "G2": (state.on_move, None),
+            "G3": (state.on_move, None),
+            "G28": (state.on_home, None),
+            "G90": (state.on_absolute, None),
+            "G91": (state.on_relative, None),
+            "G92": (state.on_set_position, None),
+            "M82": (state.on_e_absolute, None),
+            "M83": (state.on_e_relative, None),
+            "M104": (state.on_hotend_temperature, self._queued_set_temperature),
+            "M109": (state.on_hotend_temperature, self._queued_set_temperature),
+            "M140": (state.on_bed_temperature, None),
+            "M190": (state.on_bed_temperature, None),
+            "M106": (state.on_fan_on, self._queued_fan_on),
+            "M107": (state.on_fan_off, self._queued_fan_off),
+            "M73": (None, self._queued_progress),
+            "M702": (None, self._queued_filament_unload),
+            "T": (None, self._queued_tool_change),
+        }
+
+    #remember the current hotend temperature
+    def _queued_set_temperature(self, comm_instance, cmd):
+        if self.SwapInProcess:
+            return
+        target_temp = param_str(cmd, "S")
+        if target_temp is not None:
+            self.currentTargetTemp = target_temp
+            self.log.debug("Temp recorded:%s", self.currentTargetTemp)
+
+    #remember the current fan speed
+    def _queued_fan_on(self, comm_instance, cmd):
+        if self.SwapInProcess:
+            return
+        fan_speed = param_str(cmd, "S")
+        if fan_speed is not None:
+            self.current_fan_speed = fan_speed
+            self.log.debug("Fan speed recorded:%s", self.current_fan_speed)
+
+    #remember if the fan is turned off
+    def _queued_fan_off(self, comm_instance, cmd):
+        if self.SwapInProcess:
+            return
+        self.current_fan_speed = "0"
+        self.log.debug("Fan turned off (recorded)")
+
+    #M73 Q100 is the end of the print, unload the filament like for M702
+    def _queued_progress(self, comm_instance, cmd):
+        if param_str(cmd, "Q") == "100":
+            return self._queued_filament_unload(comm_instance, cmd)
+
+    def _queued_filament_unload(self, comm_instance, cmd):
+        if self.SwapInProcess:
+            #the M702 sent by unload_filament, it resumes the print once the insert is stowed
+            if cmd.startswith("M702"):
+                self.log.debug("Filament unload command sent while in Swap")
+            return
 
-        #this prevents Octoprint from automatically reverting the tool when it sends a T0 command
-        if "Invalid extruder" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Tool reversion stopped"))
-            return None
+        HomeAxis = False #set to False for production
+        current_z = self.get_streamed_z()
+    
+        #send command "unload" to commands.py handle_command
+        self.SwapInProcess = True
+        self._printer.commands("@pause")
+        
+        thread = threading.Thread(target=PreparePrinterForSwap, args=(self, current_z, HomeAxis, "readyForFilamentUnload")) 
+        thread.start()
+        return None #"Filament Unload command intercepted" #prevent the unload command from being sent to the printer. It will be sent from the unload command
+
+    def _queued_tool_change(self, comm_instance, cmd):
+        #if a tool change is received 
+        #but we are in the middle of a SWAP
+        #then end the Swap and issue the T command to the printer so that it can switch the filament
+        #also start a wipe to catch the ooze
+        if self.SwapInProcess:
+            self.log.debug("Tool change command sent while in Swap")
             
-        # Check if the line contains our echo (case insensitive)
-        if "readyForBoreAlignment" in line:
-            # Finally, turn on bore alignment
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: borealignon"))
-            try:            
-                success, error = bore_align_on(self)
-                
-                # self._printer.commands("@resume")
-
-                if not success:
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Bore alignment on failed: {error}"))
-            except Exception as e:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Exception during bore alignment on: {str(e)}"))
+            NozzleWipe = self.settings_snapshot.NozzleWipe
+            #if NozzleWipe == False then resume here
+            #otherwise swap is resumed in Swapper3D_utils.Stow_Wiper()
+            if not NozzleWipe:
+                self.SwapInProcess = False
+                self._printer.commands("@resume")
+                self.swap_tracer.end_swap()
+                            
+            self.log.debug("*****Swap_utils.swap().Swap complete - self.SwapInProcess%s*****", self.SwapInProcess)
             
-            return line
+            return
 
-        if "readyForSwap" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: readyforswap"))
-            
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"on_gcode_received.Current extruder: {self.current_extruder}"))
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"on_gcode_received.Next extruder: {self.next_extruder}"))
+        # If the command is a tool change command (starts with "T")
+        #and not during a Swap
+        #then begin the Swap process
+        #the tool changes of a file that is printing are looked up in its swap plan
+        planned = None
+        if self.swap_plan_cursor is not None:
+            planned = self.swap_plan_cursor.next_tool_change(cmd[1:])
+
+        if not comm_instance.isOperational():
+            self.log.warning("Printer is not connected")
+            return
+        
+        if self.serial_conn is None:
+            # self._logger.info("Swapper3D is disconnected")
+            self.log.warning("Swapper3D is disconnected")
+            return
+    
+        self.log.debug("hook_gcode_queuing.Processing tool change cmd:%s", cmd)
+
+        # Update the next extruder based on the command
+        self.next_extruder = cmd[1:]
+        self.log.debug("queue.Current extruder: %s", self.current_extruder)
+        self.log.debug("queue.Next extruder: %s", self.next_extruder)
+        self.log.debug("hasStartGcodeRun: %s", self.hasStartGcodeRun)
+
+
+        # If the current and next extruders are the same
+        # if the initial load is not complete and the current ext is not none then skip this guard
+        #, log the corresponding message and return
+        if (self.InitialLoadComplete 
+        and self.current_extruder is not None 
+        and self.current_extruder == self.next_extruder):
+            self.log.warning("Current and next Tools are the same AND the initial load is complete. Skipping swap.")
+            return None #make sure that the tool change doesn't happen. If it did the filament would be pulled, uncut, from the quickswap insert
+
+        #Stop the Swap if the filament extuded 
+        #since the last swap is less than the minimum
+        #the plan already knows, otherwise it is worked out from the streamed extrusion
+        if planned is not None:
+            if planned.skip == SKIP_MIN_EXTRUSION:
+                self.log.warning("Prevented swap at line %s (layer %s) because of too short extusion: %s", planned.line, planned.layer, planned.extrusion)
+                return None
+        else:
+            MinExtrusionBeforeSwap = self.settings_snapshot.MinExtrusionBeforeSwap
+            if (self.InitialLoadComplete 
+            and self.current_extruder is not None 
+            and self.extrusionSinceLastSwap < MinExtrusionBeforeSwap):
+                self.log.warning("Prevented swap because of too short extusion: %s", self.extrusionSinceLastSwap)
+                return None #not enough extrusion to get the filament into the insert, so prevent this tool change, otherwise the filament will get pulled out and jam the print head
+
+
+        # Initialize current_z outside the try block
+        current_z = 0
+        
+        #if the printer is printing then assume that it's already been homed
+        #otherwise it's probably a manually issued T command and then the printer should be homed Just to be safe
+        if comm_instance.isPrinting():
+            HomeAxis = False
             
-            if self.next_extruder is not None: # Add a pre-check for next_extruder
-                try:                    
-                
-                    thread = threading.Thread(target=swap, args=(self,)) 
-                    thread.start()                    
+            #only try to get the current Z during a print
+            #otherwise the Tool command was sent manually
+            #and the printer will be homed
+            #which means that the Z will be zero(0) and the Z needs to be moved up to 95
+            #the tracker knows the exact Z of the stream at this T command
+            current_z = self.get_streamed_z()
+        else:
+            #should ALWAYS be true becuase the users could have moved the Z position manually between the load and subsequent load/unloads
+            HomeAxis = True
+        
 
-                except Exception as e:
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Exception during Swap: {str(e)}"))
-            else:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Next extruder not set. Swap operation not executed."))
 
+        # Send the current Z position to the plugin manager
+        self.message_channel.send_plugin_message(self._identifier, dict(type="current_z", message=str(current_z)))
+
+        # Prepare the printer for the swap
+        self.SwapInProcess = True
+        self.swap_tracer.begin_swap(self.next_extruder)
+        self.log.debug("Enqueue Paused")
+        self._printer.commands("@pause")
+        # self._printer.pause_print() #don't need this
+        
+        thread = threading.Thread(target=PreparePrinterForSwap, args=(self, current_z, HomeAxis, "readyForSwap")) 
+        thread.start()
+        
+        self.log.debug("T%s command intercepted", self.next_extruder)
+        return None #prevent the T command from being issued to the printer. It will be sent from the swap method
+
+    #this is gcode FROM THE PRINTER
+    #runs on the comm thread for every received line, match_received_line rejects temperature reports and oks
+    #by their first characters and finds any echo with one precompiled pattern, see printer_echoes.py
+    def on_gcode_received(self, comm, line, *args, **kwargs):
+        echo = match_received_line(line)
+        if echo is None:
             return line
-                
-        if "readyForLoadInsert" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: readyForLoad Insert"))
-            
-            thread = threading.Thread(target=load_insert, args=(self, self.loadThisInsert)) 
-            thread.start()
-            
-            # load_insert(self, self.loadThisInsert)
-            return line
-            
-        if "readyForUnload" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: readyForUnload"))
-            
-            thread = threading.Thread(target=unload_insert, args=(self,)) 
-            thread.start()
-            
-            # unload_insert(self)
-            return line
-                
-        if "readyForFilamentUnload" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: readyForUnloadFilament"))
-                        
-            thread = threading.Thread(target=unload_filament, args=(self,)) 
-            thread.start()
-            
-            return line
-            
-        if "StowWiper" in line:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="command echo from printer: readyForUnloadFilament"))
-                        
-            thread = threading.Thread(target=Stow_Wiper, args=(self,)) 
-            thread.start()
-            
+
+        #show all received echoes
+        # self.log.debug("on_gcode_received.line:%s", line)
+
+        handler = self._received_handlers.get(echo)
+        if handler is None:
+            #motion-complete echo of a swap step, see step_scheduler.py
+            self.echo_waiter.resolve(echo)
             return line
-            
+        return handler(line)
+
+    def _build_received_handlers(self):
+        return {
+            "Invalid extruder": self._received_invalid_extruder,
+            "readyForBoreAlignment": self._received_ready_for_bore_alignment,
+            "readyForSwap": self._received_ready_for_swap,
+            "readyForLoadInsert": self._received_ready_for_load_insert,
+            "readyForUnload": self._received_ready_for_unload,
+            "readyForFilamentUnload": self._received_ready_for_filament_unload,
+            "StowWiper": self._received_stow_wiper,
+        }
+
+    def _received_invalid_extruder(self, line):
+        #this prevents Octoprint from automatically reverting the tool when it sends a T0 command
+        self.log.debug("Tool reversion stopped")
+        return None
+
+    #the operations started by echoes run one after the other on the device executor, a repeated echo (M118 and
+    #M117 both reported) is rejected while its operation is queued or running, see device_executor.py
+    def _submit_device_operation(self, key, function, *args):
+        accepted, error = self.device_executor.submit(key, function, *args)
+        if accepted:
+            self.log.debug("%s queued, %s operation(s) waiting", key, self.device_executor.queue_depth())
+        else:
+            self.log.warning("%s not started: %s", key, error)
+        return accepted
+
+    def _received_ready_for_bore_alignment(self, line):
+        # Finally, turn on bore alignment
+        self.log.debug("command echo from printer: borealignon")
+        self._submit_device_operation("bore_align_on", self._bore_align_on)
         return line
-            
+
+    def _bore_align_on(self):
+        success, error = bore_align_on(self)
+
+        # self._printer.commands("@resume")
+
+        if not success:
+            self.log.error("Bore alignment on failed: %s", error)
+
+    def _received_ready_for_swap(self, line):
+        self.log.debug("command echo from printer: readyforswap")
+
+        self.log.debug("on_gcode_received.Current extruder: %s", self.current_extruder)
+        self.log.debug("on_gcode_received.Next extruder: %s", self.next_extruder)
+
+        if self.next_extruder is not None: # Add a pre-check for next_extruder
+            #the travel ends with the first echo, a repeated echo neither ends it again nor starts a second swap
+            if self._submit_device_operation("swap", swap, self):
+                self.swap_tracer.mark("travel")
+        else:
+            self.log.warning("Next extruder not set. Swap operation not executed.")
+
+        return line
+
+    def _received_ready_for_load_insert(self, line):
+        self.log.debug("command echo from printer: readyForLoad Insert")
+        self._submit_device_operation("load_insert", load_insert, self, self.loadThisInsert)
+        return line
+
+    def _received_ready_for_unload(self, line):
+        self.log.debug("command echo from printer: readyForUnload")
+        self._submit_device_operation("unload_insert", unload_insert, self)
+        return line
+
+    def _received_ready_for_filament_unload(self, line):
+        self.log.debug("command echo from printer: readyForUnloadFilament")
+        self._submit_device_operation("unload_filament", unload_filament, self)
+        return line
+
+    def _received_stow_wiper(self, line):
+        self.log.debug("command echo from printer: StowWiper")
+        self._submit_device_operation("stow_wiper", Stow_Wiper, self)
+        return line
+
     def get_template_configs(self):
         return [
             {"type": "settings", "custom_bindings": False}
@@ -395,6 +579,10 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
     def get_assets(self):
         return {"js": ["js/Swapper3D_ViewModel.js"]}
         
+    #OctoPrint's print time estimate plus the swaps still to come, see swap_time_estimator.py
+    def get_print_time_estimator_factory(self, *args, **kwargs):
+        return create_estimator_factory(self)
+
     @octoprint.plugin.BlueprintPlugin.route("/command", methods=["POST"])
     def handle_blueprint_command(self):
         result = handle_command(self)
@@ -402,14 +590,37 @@ class Swapper3DPlugin(octoprint.plugin.StartupPlugin,
             return "No response", 400  # Return a 400 Bad Request if no response
         return result  # Ensure that you return whatever handle_command returns
 
+    #phases and steps of the last swaps with their p50/p95/p99, see swap_trace.py
+    @octoprint.plugin.BlueprintPlugin.route("/trace", methods=["GET"])
+    def handle_blueprint_trace(self):
+        return jsonify(self.swap_tracer.summary())
+
+    #the operation the device executor is running, queue depth and rejected operations
+    @octoprint.plugin.BlueprintPlugin.route("/executor", methods=["GET"])
+    def handle_blueprint_executor(self):
+        return jsonify(self.device_executor.status())
+
+    #swap and actuation counters, see wear_counters.py
+    @octoprint.plugin.BlueprintPlugin.route("/counters", methods=["GET"])
+    def handle_blueprint_counters(self):
+        return jsonify(self.wear_counters.snapshot())
+
     def is_blueprint_csrf_protected(self):
         return True
         
     def get_settings_defaults(self):
         default_settings = get_default_settings()
-        self._logger.debug(f"Default settings: {default_settings}")
+        self._logger.debug("Default settings: %s", default_settings)
         return default_settings
 
+    #invalid values are refused here, so a swap never runs into a setting it cannot use
+    def on_settings_save(self, data):
+        errors = validate_settings_update(data)
+        for error in errors:
+            self.log.error("Setting not saved, %s", error)
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.refresh_settings_snapshot()
+
     def get_update_information(self):
         return dict(
             Swapper3D=dict(
@@ -439,6 +650,7 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.comm.protocol.gcode.received": __plugin_implementation__.on_gcode_received,
         "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.hook_gcode_queuing,
+        "octoprint.printer.estimation.factory": __plugin_implementation__.get_print_time_estimator_factory,
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.event.EventHandler": __plugin_implementation__.on_event
     }
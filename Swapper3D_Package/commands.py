@@ -3,6 +3,7 @@
 from flask import request, jsonify
 from .Swapper3D_utils import * #import all methods
 from .Swap_utils import *
+from .serial_engine import detach_serial_engine
 import time
 
 def handle_command(self):
@@ -11,42 +12,27 @@ def handle_command(self):
 
     if command == "connect":
         if self.serial_conn is not None:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Already connected."))
+            self.log.warning("Already connected.")
             return jsonify(result="False"), 500
 
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Received command: " + command))
-        success, error = try_handshake(self)
-        self.serial_conn = success #added manually
-        if not success:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Handshake failed: {error}"))
-            return jsonify(result="False", error=str(error)), 500
+        self.log.debug("Received command: %s", command)
 
-        if self.serial_conn is None:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Connection lost after handshake."))
-            return jsonify(result="False", error="Connection lost after handshake"), 500
-
-
-        #connection was successful
-        #Home the TR servo on the Swapper3D
-        #rehome the ToolRotate servo #added Sep 3rd 2024 to try and address the repeatability issue of the TR servo
-        perform_command(self, "hometoolrotate", False)
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Homed ToolRotate - after connect from try handshake"))
-
-
-        # self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Connected"))
-        # time.sleep(3)
-        # self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Ready to Swap!"))
-        return jsonify(result=str(success))
+        #the handshake, homing of the TR servo and the connection state updates happen in the background
+        #the UI follows them through the connectionState messages
+        connect_swapper_in_background(self)
+        return jsonify(result="True")
 
     elif command == "send":
         message = data.get("message")
 
         try:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Sending message: {message}"))
-            self.serial_conn.write(message.encode())
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Message sent."))
+            self.log.debug("Sending message: %s", message)
+            success, error = self.serial_engine.write_raw(message.encode()).result()
+            if not success:
+                raise Exception(error)
+            self.log.debug("Message sent.")
         except Exception as e:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Failed to send message: {str(e)}"))
+            self.log.error("Failed to send message: %s", e)
             return jsonify(result="False", error=str(e)), 500
 
         return jsonify(result="True")
@@ -54,16 +40,18 @@ def handle_command(self):
     elif command == "disconnect":
         if self.serial_conn is not None:
             try:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Disconnecting."))
+                self.log.info("Disconnecting.")
+                self.link_watchdog.link_down_by_user()
+                detach_serial_engine(self)
                 self.serial_conn.close()
                 self.serial_conn = None
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Disconnected."))
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Disconnected"))
+                self.log.info("Disconnected.")
+                self.message_channel.send_plugin_message(self._identifier, dict(type="connectionState", message="Disconnected"))
             except Exception as e:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Failed to disconnect: {str(e)}"))
+                self.log.error("Failed to disconnect: %s", e)
                 return jsonify(result="False", error=str(e)), 500
         else:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="No connection to close."))
+            self.log.warning("No connection to close.")
             return jsonify(result="False", error="No connection to close."), 500
 
         return jsonify(result="True")
@@ -71,20 +59,26 @@ def handle_command(self):
     elif command == "retrieveFirmwareVersion":
         if self.serial_conn is not None:
             try:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Retrieving Firmware Version."))
+                self.log.info("Retrieving Firmware Version.")
                 retrieveFirmwareVersion(self)
             except Exception as e:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Failed to retrieveFirmwareVersion: {str(e)}"))
+                self.log.error("Failed to retrieveFirmwareVersion: %s", e)
                 return jsonify(result="False", error=str(e)), 500
         else:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Must be connected to Swapper3D to retrieve the firmware version."))
+            self.log.warning("Must be connected to Swapper3D to retrieve the firmware version.")
             return jsonify(result="False", error="Must be connected to Swapper3D to retrieve the firmware version."), 500
 
         return jsonify(result="True")
 
+    elif command == "latencyStats":
+        #write to ok latency in seconds for every Swapper3D command since connecting
+        if self.serial_engine is None:
+            return jsonify(result="False", error="Swapper3D is disconnected"), 500
+        return jsonify(result="True", latency=self.serial_engine.get_latency_stats())
+
     elif command == "load_insert":
         if self.insertLoaded:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Insert is already loaded; Must unload first."))
+            self.log.warning("Insert is already loaded; Must unload first.")
             return
 
         try:
@@ -92,7 +86,7 @@ def handle_command(self):
             data = request.json
             command = data.get("command")
             insert_number = data.get("insert_number")
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"on_gcode_received.->Insert number:{insert_number}"))
+            self.log.debug("on_gcode_received.->Insert number:%s", insert_number)
             self.loadThisInsert = insert_number
                        
             HomeAxis = True 
@@ -102,31 +96,31 @@ def handle_command(self):
         # Ensure 'insert_number' is an integer
         except ValueError:
             # If 'insert_number' cannot be converted to an integer, log an error and return
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Invalid insert_number: cannot convert to integer"))
+            self.log.warning("Invalid insert_number: cannot convert to integer")
             return jsonify(result="False", error="Invalid insert_number: cannot convert to integer"), 400
             
         return jsonify(result="True")
         
     elif command == "unload":
         if not self.insertLoaded:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Insert is not already loaded; Must load first."))
+            self.log.warning("Insert is not already loaded; Must load first.")
             return   
 
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Received command: " + command))
+        self.log.debug("Received command: %s", command)
         try:
             HomeAxis = True 
             current_z = 0 
             PreparePrinterForSwap(self, current_z, HomeAxis, "readyForUnload")
         except Exception as e:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Exception during unload: {str(e)}"))
+            self.log.error("Exception during unload: %s", e)
             return jsonify(result="False", error=str(e)), 500
 
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Unload successful"))
+        self.log.info("Unload successful")
         return jsonify(result="True")
 
     elif command == "borealignon":
         try:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Received command: " + command))
+            self.log.debug("Received command: %s", command)
             #The bore alignment and swaps can only occur after the printer is in position. 
             #The only way to check if the printer is in position is to send a G1 -> G4 -> M118 "Message", 
             #then listen for incoming messages from the printer, When the "Message" is received then all the movement 
@@ -136,28 +130,28 @@ def handle_command(self):
             current_z = 0  # Assuming the Z-position is 0 at this point
             PreparePrinterForSwap(self, current_z, HomeAxis, "readyForBoreAlignment")
             
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Bore alignment ON"))
+            self.message_channel.send_plugin_message(self._identifier, dict(type="connectionState", message="Bore alignment ON"))
             return jsonify(result="True")
         except Exception as e:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Exception during bore alignment on: {str(e)}"))
+            self.log.error("Exception during bore alignment on: %s", e)
             return jsonify(result="False", error=str(e)), 500
         
     elif command == "borealignoff":
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Received command: " + command))
+        self.log.debug("Received command: %s", command)
         try:
             success, error = bore_align_off(self)
             if not success:
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Bore alignment off failed: {error}"))
+                self.log.error("Bore alignment off failed: %s", error)
                 return jsonify(result="False", error=str(error)), 500
         except Exception as e:
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Exception during bore alignment off: {str(e)}"))
+            self.log.error("Exception during bore alignment off: %s", e)
             return jsonify(result="False", error=str(e)), 500
 
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message="Bore alignment off successful"))
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="connectionState", message="Ready to Swap!"))
+        self.log.info("Bore alignment off successful")
+        self.message_channel.send_plugin_message(self._identifier, dict(type="connectionState", message="Ready to Swap!"))
     
         return jsonify(result="True")
 
     else:
-        self._plugin_manager.send_plugin_message(self._identifier, dict(type="log", message=f"Command not recognized: {command}"))
+        self.log.warning("Command not recognized: %s", command)
         return jsonify(result="False", error="Command not recognized."), 500
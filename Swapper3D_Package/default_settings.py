@@ -9,15 +9,28 @@ def get_default_settings():
         BreakString = 1,
         xMinPositionForWipe="215",
         xMaxPositionForWipe="230",
-        DelayAfterExtruderMovedToWipeLocationBeforeDeployingWiper="200",
         MinExtrusionBeforeSwap="10",
+        RejectBadSwapFiles = 0,
         zHeight = "95",
         ExtraExtrusionAfterSwap = "0.0",
+        RetractionDistanceAfterSwap = "0.0",
         StockExtruderMaxFeedrate = "120.0",
         SwapExtruderMaxFeedrate = "500.0",
         StockExtruderMaxAcceleration = "5000",
         SwapExtruderMaxAcceleration = "15000",
+        PrinterMaxAcceleration = "1250",
+        PrinterMaxFeedrateZ = "12",
         zMotorCurrent = "900",
+        serialPort = None,
+        serialPortOverride = "",
+        baudrate = "9600",
+        maxBaudrate = "115200",
+        commandTimeout = "60",
+        BatchSwapperCommands = 0,
+        heartbeatInterval = "5",
+        heartbeatTimeout = "2",
+        messageInterval = "250",
+        logLevel = "WARNING",
         extrudeSpeedPulldown = "12000",
         retractSpeed= "10000",
         extrudeLengthLockingHeight="18.2",
@@ -29,7 +42,6 @@ def get_default_settings():
         extrudeSpeedPaletteCuts = "12000",
         numPaletteCuts = "3",
         lengthAdditionalCut = "15",
-        delayAfterCut = "100",
         motorType = "Standard",
         totalNumberSwaps = "0",
         actuations = "0",
@@ -114,7 +126,7 @@ def get_default_settings():
     M702 C ; Unload filament with MMU
     ;***************End SWAPPER3D gcode**********************
     """,
-        FilamentSwitcherType = "parallel",
+        filamentSwitcherType = "MMU",
         extraFilamentCutLength = "60",
         lengthEachCut = "15",
     )
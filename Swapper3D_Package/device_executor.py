@@ -0,0 +1,91 @@
+# Octoprint plugin name: Swapper3D, File: device_executor.py, Author: BigBrain3D, License: AGPLv3
+# One long-lived worker for the Swapper3D operations started by printer echoes (swap, load, unload, wiper stow, ...).
+# They used to start a new thread per echo. The printer is sent every echo as M118 and M117, printers that report
+# both deliver readyForSwap twice, and two swaps then ran at the same time on the same Swapper3D.
+# Every operation has a key; while an operation with that key is queued or running, the same key is rejected, so a
+# repeated echo maps onto the operation that is already pending. The queue is bounded: the Swapper3D executes one
+# thing at a time anyway, more than a few waiting operations means something is stuck.
+# stop() never waits for room in the queue: the worker checks the stop event after every operation, the None that
+# wakes an idle worker is only put when there is room.
+import queue
+import threading
+
+MAX_QUEUED_OPERATIONS = 4
+
+
+class DeviceExecutor:
+    def __init__(self, plugin, max_queued=MAX_QUEUED_OPERATIONS):
+        self._plugin = plugin
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._keys = set()  # queued or running
+        self.running = None  # key of the running operation
+        self.completed = 0
+        self.rejected_duplicates = 0
+        self.rejected_full = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, name="Swapper3D-device", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            try:
+                self._queue.put_nowait(None)  # wakes the worker if it waits for an operation
+            except queue.Full:
+                pass  # the worker is busy and stops after the running operation
+            self._thread = None
+
+    def submit(self, key, function, *args):
+        """
+        Queue function(*args) unless an operation with the same key is queued or running.
+
+        :return: (accepted, error)
+        """
+        with self._lock:
+            if self._stop.is_set():
+                return False, "Stopped"
+            if key in self._keys:
+                self.rejected_duplicates += 1
+                return False, f"'{key}' is already queued or running"
+            try:
+                self._queue.put_nowait((key, function, args))
+            except queue.Full:
+                self.rejected_full += 1
+                return False, f"Too many operations queued ({self._queue.maxsize})"
+            self._keys.add(key)
+        self.start()
+        return True, None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def status(self):
+        with self._lock:
+            return dict(running=self.running,
+                        queued=self._queue.qsize(),
+                        max_queued=self._queue.maxsize,
+                        completed=self.completed,
+                        rejected_duplicates=self.rejected_duplicates,
+                        rejected_full=self.rejected_full)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None or self._stop.is_set():
+                return
+            key, function, args = item
+            self.running = key
+            try:
+                function(*args)
+            except Exception as e:
+                self._plugin.log.error("Exception during %s: %s", key, e)
+            finally:
+                with self._lock:
+                    self._keys.discard(key)
+                    self.running = None
+                    self.completed += 1
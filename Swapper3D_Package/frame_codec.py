@@ -0,0 +1,97 @@
+# Octoprint plugin name: Swapper3D, File: frame_codec.py, Author: BigBrain3D, License: AGPLv3
+# Framing for the Swapper3D serial protocol.
+# A frame is the ASCII message, one parity digit and a newline, e.g. b"cutter_open1\n".
+# The parity digit is 1 when the message has an even number of set bits and 0 when it is odd.
+# This runs on the Raspberry Pi next to OctoPrint's own comm thread, so the parity is looked up in a
+# 256 entry table with bytes.translate() (done in C) instead of counting bits character by character,
+# and received bytes go into one reusable bytearray instead of a new string per readline().
+import functools
+
+# PARITY_TABLE[byte] is 1 when the byte has an odd number of set bits
+PARITY_TABLE = bytes(bin(value).count("1") & 1 for value in range(256))
+
+
+def parity_bit(data):
+    """
+    Parity digit for a message.
+
+    :param data: bytes/bytearray of the message without parity digit
+    :return: 1 for an even number of set bits, 0 for odd (same as Swapper3D_utils.parity_of)
+    """
+    return (data.translate(PARITY_TABLE).count(1) & 1) ^ 1
+
+
+@functools.lru_cache(maxsize=256)
+def encode_frame(command):
+    """
+    Encode a command into a ready to write frame. The swap code sends the same few commands over and over,
+    so the encoded frames are cached.
+
+    :param command: command name without parity digit, e.g. "cutter_open"
+    :return: bytes frame including parity digit and newline
+    """
+    message = command.encode("ascii")
+    return message + (b"1\n" if parity_bit(message) else b"0\n")
+
+
+def decode_frame(frame):
+    """
+    Check the parity of a received frame.
+
+    :param frame: bytes of one frame without the newline
+    :return: (True, message) when the parity matches, (False, None) when it does not
+    """
+    if len(frame) < 2:
+        return False, None
+    digit = frame[-1]
+    if digit not in (0x30, 0x31):  # b"0", b"1"
+        return False, None
+    message = frame[:-1]
+    if parity_bit(message) != digit - 0x30:
+        return False, None
+    return True, message.decode("ascii", "replace")
+
+
+def debug_repr(message):
+    # the [ord] dump used when a reply does not look like what we expected, only build it when debug is on
+    return ' '.join(f"[{ord(c)}]" for c in message)
+
+
+class FrameReader:
+    """
+    Splits the received byte stream into frames. A single read() can contain several frames, or only part of one,
+    the rest is kept in the buffer until its newline arrives.
+    """
+
+    def __init__(self, max_frame_length=256):
+        self._buffer = bytearray()
+        self._max_frame_length = max_frame_length
+
+    def feed(self, data):
+        """
+        Add received bytes and return the complete frames in them.
+
+        :param data: bytes as returned by serial.read()
+        :return: list of frames (bytes, newline and surrounding whitespace removed, empty lines skipped)
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            frame = bytes(buffer[start:end]).strip()
+            if frame:
+                frames.append(frame)
+            start = end + 1
+        if start:
+            del buffer[:start]
+        if len(buffer) > self._max_frame_length:
+            # line noise without a newline, don't let it grow forever
+            buffer.clear()
+        return frames
+
+    def clear(self):
+        self._buffer.clear()
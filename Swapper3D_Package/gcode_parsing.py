@@ -0,0 +1,41 @@
+# Octoprint plugin name: Swapper3D, File: gcode_parsing.py, Author: BigBrain3D, License: AGPLv3
+# Small parsers for the few G-code parameters the plugin reads from queued lines.
+# They run for every move that OctoPrint queues, so they look the parameter up with str.find() and
+# only slice out the one number they need instead of splitting the whole line into a list.
+
+# " E", " S", ... built once instead of on every call
+_PARAM_KEYS = {letter: " " + letter for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+
+
+def find_param(cmd, letter):
+    """
+    Position of the value of a parameter, e.g. find_param("G1 X10 E0.5", "E") -> 8.
+    Parameters are separated by spaces, the first word (the command itself) is never matched.
+
+    :return: index of the first character after the letter, or -1 when the parameter is not there
+    """
+    index = cmd.find(_PARAM_KEYS[letter])
+    if index < 0:
+        return -1
+    return index + 2
+
+
+def param_str(cmd, letter):
+    """Raw text of a parameter value, e.g. param_str("M104 S215 T0", "S") -> "215", or None when missing."""
+    start = find_param(cmd, letter)
+    if start < 0:
+        return None
+    end = cmd.find(" ", start)
+    return cmd[start:] if end < 0 else cmd[start:end]
+
+
+def param_float(cmd, letter):
+    """Value of a parameter as float, or None when it is missing or not a number."""
+    start = find_param(cmd, letter)
+    if start < 0:
+        return None
+    end = cmd.find(" ", start)
+    try:
+        return float(cmd[start:] if end < 0 else cmd[start:end])
+    except ValueError:
+        return None
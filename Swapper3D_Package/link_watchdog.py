@@ -0,0 +1,127 @@
+# Octoprint plugin name: Swapper3D, File: link_watchdog.py, Author: BigBrain3D, License: AGPLv3
+# Watches the serial link to the Swapper3D so a dead or re-enumerated USB connection is noticed within seconds,
+# not when the next swap hangs in perform_command.
+# Every heartbeatInterval seconds it checks, in order of cost:
+#   1) the serial engine's reader is still running (it stops on any read error, e.g. USB unplugged)
+#   2) the port device still exists (re-enumerated USB ports get a new name)
+#   3) when the link is idle, a heartbeat (the handshake message) is answered within heartbeatTimeout
+# When the link is unhealthy it is closed, the connectionState in the UI is updated and it is reconnected through
+# the normal handshake path (which also re-homes ToolRotate), all in the background.
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from .serial_engine import detach_serial_engine
+from .Swapper3D_utils import connect_swapper
+
+
+class LinkWatchdog:
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.healthy = False
+        self.auto_reconnect = False  # only reconnect links that were lost, never after a user disconnect
+
+    def _set_connection_state(self, message):
+        self._plugin.message_channel.send_plugin_message(self._plugin._identifier, dict(type="connectionState", message=message))
+
+    def _get_float_setting(self, key, default):
+        if self._plugin.settings_snapshot is None:
+            return default
+        return getattr(self._plugin.settings_snapshot, key)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="Swapper3D-link-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+
+    def link_up(self):
+        self.healthy = True
+        self.auto_reconnect = True
+
+    def link_down_by_user(self):
+        self.healthy = False
+        self.auto_reconnect = False
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            interval = self._get_float_setting("heartbeatInterval", 5.0)
+            if interval <= 0:
+                # watchdog switched off in the settings, look again later in case it is switched back on
+                self._stop_event.wait(5.0)
+                continue
+
+            self._stop_event.wait(interval)
+            if self._stop_event.is_set():
+                break
+
+            try:
+                self.check()
+            except Exception as e:
+                self._plugin.log.error("Swapper3D link watchdog failed: %s", e)
+
+    def check(self):
+        plugin = self._plugin
+        engine = plugin.serial_engine
+
+        if engine is None:
+            if self.auto_reconnect and not plugin.connect_lock.locked():
+                self._reconnect()
+            return
+
+        problem = self._find_problem(engine)
+        if problem is None:
+            if not self.healthy:
+                self.healthy = True
+            return
+
+        self.healthy = False
+        self._plugin.log.error("Swapper3D link lost: %s", problem)
+        self._set_connection_state("Link lost - reconnecting...")
+        detach_serial_engine(plugin, f"Swapper3D link lost: {problem}")
+        try:
+            plugin.serial_conn.close()
+        except Exception:
+            pass
+        plugin.serial_conn = None
+        self._reconnect()
+
+    def _find_problem(self, engine):
+        if not engine.is_running:
+            return "serial reader stopped"
+
+        port = self._plugin.serial_conn.port if self._plugin.serial_conn is not None else None
+        if port and not os.path.exists(port):
+            return f"port {port} disappeared"
+
+        # only ping an idle link, a busy link proves it is alive with its acks and we never want to
+        # put a heartbeat between the steps of a swap
+        if self._plugin.SwapInProcess or engine.has_pending():
+            return None
+        interval = self._get_float_setting("heartbeatInterval", 5.0)
+        if time.monotonic() - engine.last_rx < interval:
+            return None
+
+        timeout = self._get_float_setting("heartbeatTimeout", 2.0)
+        future = engine.ping()
+        try:
+            success, error = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            engine.cancel(future, "Heartbeat timed out")
+            return f"no heartbeat reply within {timeout}s"
+        if not success:
+            return f"heartbeat failed: {error}"
+        return None
+
+    def _reconnect(self):
+        if connect_swapper(self._plugin):
+            self._plugin.log.info("Swapper3D link restored")
+        else:
+            self._set_connection_state("Link lost - retrying")
@@ -0,0 +1,90 @@
+# Octoprint plugin name: Swapper3D, File: message_channel.py, Author: BigBrain3D, License: AGPLv3
+# Outbound messages to the browser.
+# Every send_plugin_message is a websocket push to every connected browser, and a swap sends a lot of them.
+# The channel has the same send_plugin_message(identifier, data) call as OctoPrint's plugin manager, but instead
+# of pushing each message it collects them and pushes one "batch" frame at most every messageInterval ms:
+#   - "log" lines are queued in order (bounded, the oldest are dropped when a browser can't keep up)
+#   - every other type (connectionState, currentlyLoadedInsert, current_z, ...) is a state, only the latest value
+#     of each is sent
+# Swapper3D_ViewModel.js unpacks the batch.
+import collections
+import threading
+
+MAX_BUFFERED_LOG_LINES = 2000
+MAX_LOG_LINES_PER_FRAME = 200
+
+
+class MessageChannel:
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self._lock = threading.Lock()
+        self._logs = collections.deque()
+        self._dropped_logs = 0
+        self._states = {}  # type -> latest message, in the order the types were last updated
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def send_plugin_message(self, identifier, data):
+        message_type = data.get("type")
+        with self._lock:
+            if message_type == "log":
+                if len(self._logs) >= MAX_BUFFERED_LOG_LINES:
+                    self._logs.popleft()
+                    self._dropped_logs += 1
+                self._logs.append(data.get("message"))
+            else:
+                self._states.pop(message_type, None)
+                self._states[message_type] = data.get("message")
+            if self._thread is None:
+                self._start()
+        self._wakeup.set()
+
+    def _start(self):
+        # called with _lock held, the flusher is started by the first message
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="Swapper3D-messages", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup.set()
+        self.flush()
+
+    def _get_interval(self):
+        if self._plugin.settings_snapshot is None:
+            return 0.25
+        return self._plugin.settings_snapshot.messageInterval / 1000
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+            # wait a moment so that whatever else is sent in this interval goes out in the same frame, stop() ends it early
+            self._stop_event.wait(self._get_interval())
+            more = self.flush()
+            if more:
+                self._wakeup.set()
+
+    def flush(self):
+        """Push everything collected so far in one frame. Returns True when log lines are left for the next frame."""
+        with self._lock:
+            if not self._logs and not self._states and not self._dropped_logs:
+                return False
+            logs = []
+            if self._dropped_logs:
+                logs.append(f"... {self._dropped_logs} log lines dropped")
+                self._dropped_logs = 0
+            while self._logs and len(logs) < MAX_LOG_LINES_PER_FRAME:
+                logs.append(self._logs.popleft())
+            states = [dict(type=message_type, message=message) for message_type, message in self._states.items()]
+            self._states.clear()
+            more = bool(self._logs)
+
+        try:
+            self._plugin._plugin_manager.send_plugin_message(self._plugin._identifier, dict(type="batch", logs=logs, states=states))
+        except Exception as e:
+            self._plugin.log.error("Failed to send Swapper3D messages: %s", e)
+        return more
@@ -0,0 +1,162 @@
+# Octoprint plugin name: Swapper3D, File: motion_model.py, Author: BigBrain3D, License: AGPLv3
+# How long the printer takes for a block of G-code the plugin sends, from feedrate, acceleration and distance.
+# Every move is a trapezoid: accelerate to the feedrate, cruise, decelerate to a stop (a triangle when the move is
+# too short to reach the feedrate). The printer blends moves and is faster than that, so the estimate is an upper
+# bound of the motion itself.
+#
+# The limits are the ones the printer uses during a swap:
+#   E     M203/M201 E values of the settings; M203 E/M201 E lines in the block change them, like on the printer
+#   X/Y   PrinterMaxAcceleration, the feedrate of the move
+#   Z     PrinterMaxFeedrateZ and PrinterMaxAcceleration
+# The position starts at the printer state tracker, which has seen every line queued before the block.
+#
+# MotionClock keeps when the blocks the swap steps queued are done: the printer runs them one after the other, a block
+# starts when the one before it is done or, when the printer was idle, once it is queued.
+import math
+import threading
+import time
+from .gcode_parsing import param_float
+
+
+def move_time(distance, feedrate, acceleration):
+    """
+    Seconds of one move that starts and ends at rest.
+
+    :param distance: mm
+    :param feedrate: mm/s
+    :param acceleration: mm/s2, 0 or less for none
+    """
+    distance = abs(distance)
+    if distance == 0 or feedrate <= 0:
+        return 0.0
+    if acceleration <= 0:
+        return distance / feedrate
+    # distance to accelerate to the feedrate and to brake from it again
+    ramp_distance = feedrate * feedrate / acceleration
+    if distance >= ramp_distance:
+        return distance / feedrate + feedrate / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+class MotionModel:
+    def __init__(self, settings, swap_limits=True):
+        extruder_prefix = "Swap" if swap_limits else "Stock"
+        self.max_feedrate = {
+            "X": None,
+            "Y": None,
+            "Z": settings.PrinterMaxFeedrateZ,
+            "E": getattr(settings, f"{extruder_prefix}ExtruderMaxFeedrate"),
+        }
+        self.max_acceleration = {
+            "X": settings.PrinterMaxAcceleration,
+            "Y": settings.PrinterMaxAcceleration,
+            "Z": settings.PrinterMaxAcceleration,
+            "E": getattr(settings, f"{extruder_prefix}ExtruderMaxAcceleration"),
+        }
+
+    def block_time(self, gcode_commands, state):
+        """
+        Seconds the printer needs to execute gcode_commands.
+
+        :param state: PrinterStateTracker with the state before the block, it is not changed
+        """
+        max_feedrate = dict(self.max_feedrate)
+        max_acceleration = dict(self.max_acceleration)
+        position = {"X": state.x, "Y": state.y, "Z": state.z, "E": state.e}
+        axes_relative = state.axes_relative
+        e_relative = state.e_relative
+        feedrate = state.feedrate  # mm/min, as in the G-code
+        total = 0.0
+
+        for line in gcode_commands:
+            comment = line.find(";")
+            cmd = (line if comment < 0 else line[:comment]).strip()
+            gcode = cmd.split(" ", 1)[0]
+
+            if gcode in ("G0", "G1"):
+                value = param_float(cmd, "F")
+                if value is not None:
+                    feedrate = value
+                deltas = {}
+                for axis in "XYZE":
+                    value = param_float(cmd, axis)
+                    if value is None:
+                        continue
+                    relative = e_relative if axis == "E" else axes_relative
+                    if relative:
+                        deltas[axis] = value
+                        if position[axis] is not None:
+                            position[axis] += value
+                    else:
+                        # an axis that was never set or homed, assume it does not move
+                        start = position[axis]
+                        deltas[axis] = 0.0 if start is None else value - start
+                        position[axis] = value
+                total += _move_time(deltas, feedrate, max_feedrate, max_acceleration)
+            elif gcode == "G4":
+                value = param_float(cmd, "P")
+                if value is not None:
+                    total += value / 1000
+                value = param_float(cmd, "S")
+                if value is not None:
+                    total += value
+            elif gcode == "G92":
+                values = {axis: param_float(cmd, axis) for axis in "XYZE"}
+                if all(value is None for value in values.values()):
+                    values = dict.fromkeys("XYZE", 0.0)
+                for axis, value in values.items():
+                    if value is not None:
+                        position[axis] = value
+            elif gcode == "G90":
+                axes_relative = e_relative = False
+            elif gcode == "G91":
+                axes_relative = e_relative = True
+            elif gcode == "M82":
+                e_relative = False
+            elif gcode == "M83":
+                e_relative = True
+            elif gcode in ("M203", "M201"):
+                value = param_float(cmd, "E")
+                if value is not None:
+                    limits = max_feedrate if gcode == "M203" else max_acceleration
+                    limits["E"] = value
+
+        return total
+
+
+class MotionClock:
+    def __init__(self, time_scale=1.0):
+        """:param time_scale: factor on the block times, for a stand-in printer that runs faster (benchmarks)"""
+        self._lock = threading.Lock()
+        self.time_scale = time_scale
+        self.done_at = 0.0  # time.monotonic() when the queued blocks are done
+
+    def queue(self, seconds):
+        """A block of seconds was queued. :return: time.monotonic() when it is done"""
+        with self._lock:
+            self.done_at = max(time.monotonic(), self.done_at) + seconds * self.time_scale
+            return self.done_at
+
+
+def _move_time(deltas, feedrate, max_feedrate, max_acceleration):
+    squared = sum(deltas.get(axis, 0.0) ** 2 for axis in "XYZ")
+    # an extruder-only move runs at the feedrate on E
+    length = math.sqrt(squared) if squared else abs(deltas.get("E", 0.0))
+    if length == 0 or not feedrate:
+        return 0.0
+
+    # every axis stays within its limits, the printer slows the whole move down for the slowest axis
+    speed = feedrate / 60
+    acceleration = None
+    for axis, delta in deltas.items():
+        if not delta:
+            continue
+        share = length / abs(delta)
+        axis_feedrate = max_feedrate[axis]
+        if axis_feedrate:
+            speed = min(speed, axis_feedrate * share)
+        limit = max_acceleration[axis]
+        if limit:
+            axis_acceleration = limit * share
+            acceleration = axis_acceleration if acceleration is None else min(acceleration, axis_acceleration)
+    return move_time(length, speed, acceleration or 0)
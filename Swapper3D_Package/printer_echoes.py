@@ -0,0 +1,31 @@
+# Octoprint plugin name: Swapper3D, File: printer_echoes.py, Author: BigBrain3D, License: AGPLv3
+# Finds the echoes the plugin waits for in the lines received from the printer.
+# on_gcode_received runs on OctoPrint's comm thread for every received line and most of them are temperature
+# reports and oks, so those are rejected by their first characters and everything else is scanned once with a
+# single precompiled pattern instead of one substring search per echo.
+import re
+from .step_scheduler import ECHO_PREFIX
+
+# the echoes, their order is the order on_gcode_received used to check them in
+ECHOES = (
+    "Invalid extruder",  # OctoPrint reverting the tool, not an echo of the plugin
+    "readyForBoreAlignment",
+    "readyForSwap",
+    "readyForLoadInsert",
+    "readyForUnload",
+    "readyForFilamentUnload",
+    "StowWiper",
+)
+
+_ECHO_PATTERN = re.compile("|".join([re.escape(echo) for echo in ECHOES] + [re.escape(ECHO_PREFIX) + r"\S+"]))
+
+# temperature reports (" T:" with Marlin's leading space when autoreporting) and oks
+_REJECT_PREFIXES = ("T:", " T:", "ok", "B:")
+
+
+def match_received_line(line):
+    """:return: the echo found in a received line (one of ECHOES or a step echo token), or None"""
+    if line.startswith(_REJECT_PREFIXES):
+        return None
+    match = _ECHO_PATTERN.search(line)
+    return None if match is None else match.group(0)
@@ -0,0 +1,145 @@
+# Octoprint plugin name: Swapper3D, File: printer_state.py, Author: BigBrain3D, License: AGPLv3
+# Model of the printer state as it is streamed, updated line by line from hook_gcode_queuing.
+# Because every queued line passes through the hook, the model knows the exact state the printer will be in
+# when a queued T command is executed, without asking OctoPrint (get_current_data) at swap time.
+# It knows absolute/relative extrusion (M82/M83, G90/G91) and G92 resets, so the extrusion since the last swap
+# is the real filament length pushed through the nozzle and not the sum of raw E values.
+from .gcode_parsing import param_float
+
+
+class PrinterStateTracker:
+    __slots__ = ("axes_relative", "e_relative", "x", "y", "z", "e", "feedrate",
+                 "target_hotend", "target_bed", "fan_speed", "extrusion_since_swap")
+
+    def __init__(self):
+        self.axes_relative = False
+        self.e_relative = False
+        self.x = None  # None until the stream has set or homed the axis
+        self.y = None
+        self.z = None
+        self.e = 0.0  # logical E position, as in the G-code
+        self.feedrate = None
+        self.target_hotend = None
+        self.target_bed = None
+        self.fan_speed = 0
+        self.extrusion_since_swap = 0.0  # net filament length extruded since reset_extrusion()
+
+    def reset_extrusion(self):
+        self.extrusion_since_swap = 0.0
+
+    # G0/G1/G2/G3
+    def on_move(self, cmd):
+        if self.axes_relative:
+            value = param_float(cmd, "X")
+            if value is not None and self.x is not None:
+                self.x += value
+            value = param_float(cmd, "Y")
+            if value is not None and self.y is not None:
+                self.y += value
+        else:
+            value = param_float(cmd, "X")
+            if value is not None:
+                self.x = value
+            value = param_float(cmd, "Y")
+            if value is not None:
+                self.y = value
+
+        value = param_float(cmd, "F")
+        if value is not None:
+            self.feedrate = value
+
+        self.on_z_e_move(cmd)
+
+    # G0/G1/G2/G3 for Z and E only, used by the swap plan analyzer which does not need X, Y and the feedrate
+    def on_z_e_move(self, cmd):
+        value = param_float(cmd, "Z")
+        if value is not None:
+            if not self.axes_relative:
+                self.z = value
+            elif self.z is not None:
+                self.z += value
+
+        value = param_float(cmd, "E")
+        if value is not None:
+            if self.e_relative:
+                self.extrusion_since_swap += value
+                self.e += value
+            else:
+                self.extrusion_since_swap += value - self.e
+                self.e = value
+
+    # G90
+    def on_absolute(self, cmd):
+        self.axes_relative = False
+        self.e_relative = False
+
+    # G91
+    def on_relative(self, cmd):
+        self.axes_relative = True
+        self.e_relative = True
+
+    # M82
+    def on_e_absolute(self, cmd):
+        self.e_relative = False
+
+    # M83
+    def on_e_relative(self, cmd):
+        self.e_relative = True
+
+    # G92, sets the logical position without moving; without parameters every axis is set to 0
+    def on_set_position(self, cmd):
+        x = param_float(cmd, "X")
+        y = param_float(cmd, "Y")
+        z = param_float(cmd, "Z")
+        e = param_float(cmd, "E")
+        if x is None and y is None and z is None and e is None:
+            self.x = self.y = self.z = 0.0
+            self.e = 0.0
+            return
+        if x is not None:
+            self.x = x
+        if y is not None:
+            self.y = y
+        if z is not None:
+            self.z = z
+        if e is not None:
+            self.e = e
+
+    # G28, homed axes are at 0; without axis letters (e.g. "G28" or "G28 W") every axis is homed
+    def on_home(self, cmd):
+        axes = cmd[3:]  # also covers the combined form "G28 XYZ"
+        home_x = "X" in axes
+        home_y = "Y" in axes
+        home_z = "Z" in axes
+        if not (home_x or home_y or home_z):
+            home_x = home_y = home_z = True
+        if home_x:
+            self.x = 0.0
+        if home_y:
+            self.y = 0.0
+        if home_z:
+            self.z = 0.0
+
+    # M104/M109
+    def on_hotend_temperature(self, cmd):
+        value = param_float(cmd, "S")
+        if value is not None:
+            self.target_hotend = value
+
+    # M140/M190
+    def on_bed_temperature(self, cmd):
+        value = param_float(cmd, "S")
+        if value is not None:
+            self.target_bed = value
+
+    # M106
+    def on_fan_on(self, cmd):
+        value = param_float(cmd, "S")
+        self.fan_speed = 255 if value is None else value
+
+    # M107
+    def on_fan_off(self, cmd):
+        self.fan_speed = 0
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.__slots__}
@@ -0,0 +1,311 @@
+# Octoprint plugin name: Swapper3D, File: serial_engine.py, Author: BigBrain3D, License: AGPLv3
+# Single owner of the Swapper3D serial port.
+# Every thread that wants to talk to the Swapper3D (swap, unload, load, wiper, REST commands) goes through
+# one SerialEngine instead of writing to plugin.serial_conn and blocking on readline() itself.
+# The engine has one writer thread fed by a queue and one reader thread that never stops reading.
+# Each submitted command gets a Future that is resolved when its matching "<command>_ok" arrives,
+# so replies can no longer be picked up by the wrong thread ("OK in the wrong spot").
+# Acks are resolved the moment they are read, and the time from write to ack is recorded per command.
+# Framing and parity are done by frame_codec, debug dumps of the traffic are only built when debug logging is on.
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from .frame_codec import FrameReader, encode_frame, decode_frame, debug_repr
+
+
+class _PendingCommand:
+    __slots__ = ("command", "expected", "future", "written_at")
+
+    def __init__(self, command, future):
+        self.command = command
+        self.expected = f"{command}_ok"
+        self.future = future  # None for fire-and-forget commands whose ack is only swallowed
+        self.written_at = None
+
+
+class SerialEngine:
+    def __init__(self, plugin, serial_conn):
+        self._plugin = plugin
+        self.serial_conn = serial_conn
+        self._write_queue = queue.Queue()
+        self._pending = collections.deque()  # (expected response, future) in the order the commands were written
+        self._pending_lock = threading.Lock()
+        self._unsolicited = queue.Queue(maxsize=32)  # valid frames that did not match a pending command (e.g. firmware version parts)
+        self.latency_stats = {}  # command -> dict(count, total, min, max, last) in seconds, write to ack
+        self.last_rx = time.monotonic()  # when the last valid frame was read, used by the link watchdog
+        self.swallowed_ack_listeners = []  # called with the command when the ack of a fire-and-forget command arrives
+        self._running = False
+        self._writer_thread = None
+        self._reader_thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        # short read timeout so that the reader notices stop() quickly; the data itself is never lost because
+        # partial lines are kept until the newline arrives
+        self.serial_conn.timeout = 0.5
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="Swapper3D-serial-writer", daemon=True)
+        self._reader_thread = threading.Thread(target=self._reader_loop, name="Swapper3D-serial-reader", daemon=True)
+        self._writer_thread.start()
+        self._reader_thread.start()
+
+    def stop(self, reason="Serial engine stopped"):
+        if not self._running:
+            return
+        self._running = False
+        self._write_queue.put(None)  # wake the writer up
+        self._fail_all_pending(reason)
+
+    @property
+    def is_running(self):
+        return self._running
+
+    def submit(self, command, WaitForOk=True):
+        """
+        Queue a command for the Swapper3D.
+
+        :param command: command name without parity bit, e.g. "cutter_open"
+        :param WaitForOk: when True the future resolves once "<command>_ok" is received,
+                          otherwise it resolves as soon as the command has been written
+        :return: concurrent.futures.Future resolving to (success, error)
+        """
+        future = Future()
+        if not self._running:
+            future.set_result((False, "Swapper3D is disconnected"))
+            return future
+        self._write_queue.put(([command], WaitForOk, [future]))
+        return future
+
+    def submit_batch(self, commands):
+        """
+        Queue several commands that are written to the Swapper3D in a single framed write.
+        The firmware executes them one after the other from its receive buffer and acks each one,
+        so the per-step turnaround of the link is only paid once for the whole batch.
+
+        :param commands: list of command names without parity bit
+        :return: list of concurrent.futures.Future, one per command, each resolving to (success, error)
+        """
+        futures = [Future() for _ in commands]
+        if not self._running:
+            for future in futures:
+                future.set_result((False, "Swapper3D is disconnected"))
+            return futures
+        self._write_queue.put((list(commands), True, futures))
+        return futures
+
+    def write_raw(self, data):
+        """Queue raw bytes (already framed by the caller) for writing, e.g. the 'send' REST command."""
+        future = Future()
+        if not self._running:
+            future.set_result((False, "Swapper3D is disconnected"))
+            return future
+        self._write_queue.put((data, None, [future]))
+        return future
+
+    def ping(self):
+        """
+        Heartbeat for the link watchdog: send the handshake message, the future resolves with its octoprint_ok.
+        Other frames (e.g. firmware version parts someone reads with read_unsolicited) are left alone.
+        """
+        return self.submit("octoprint")
+
+    def has_pending(self):
+        """
+        True while a command is queued or its ack has not arrived, the link watchdog only pings an idle link.
+        A fire-and-forget command counts too, the firmware may still be moving for it.
+        """
+        self._expire_fire_and_forget()
+        with self._pending_lock:
+            waiting = bool(self._pending)
+        return waiting or not self._write_queue.empty()
+
+    def _expire_fire_and_forget(self):
+        # a fire-and-forget command whose ok never comes would otherwise stay pending for the rest of the session
+        deadline = time.monotonic() - self._plugin.settings_snapshot.commandTimeout
+        with self._pending_lock:
+            for entry in list(self._pending):
+                if entry.future is None and entry.written_at is not None and entry.written_at < deadline:
+                    self._pending.remove(entry)
+
+    def cancel(self, future, reason="Cancelled"):
+        """Stop waiting for the ack of a command, e.g. after its deadline passed."""
+        self._discard_pending(future)
+        if not future.done():
+            future.set_result((False, reason))
+
+    def get_latency_stats(self):
+        with self._pending_lock:
+            return {command: dict(stats) for command, stats in self.latency_stats.items()}
+
+    def _record_latency(self, command, latency):
+        # called with _pending_lock held
+        stats = self.latency_stats.get(command)
+        if stats is None:
+            self.latency_stats[command] = dict(count=1, total=latency, min=latency, max=latency, last=latency)
+            return
+        stats["count"] += 1
+        stats["total"] += latency
+        stats["last"] = latency
+        if latency < stats["min"]:
+            stats["min"] = latency
+        if latency > stats["max"]:
+            stats["max"] = latency
+
+    def read_unsolicited(self, timeout=None):
+        """Return the next valid frame that was not an ack for a pending command, or None on timeout."""
+        try:
+            return self._unsolicited.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _writer_loop(self):
+        while self._running:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            payload, WaitForOk, futures = item
+            try:
+                if WaitForOk is None:
+                    self.serial_conn.write(payload)
+                    futures[0].set_result((True, None))
+                    continue
+
+                # register before writing so that a very fast reply can never arrive before we are listening for it
+                # fire-and-forget commands are registered too so that their late ok is swallowed here
+                pending_commands = [_PendingCommand(command, future if WaitForOk else None)
+                                    for command, future in zip(payload, futures)]
+                data = b"".join([encode_frame(command) for command in payload])
+                with self._pending_lock:
+                    self._pending.extend(pending_commands)
+
+                self._plugin.log.debug("Swapper3D write: %r", data)
+
+                written_at = time.monotonic()
+                for pending in pending_commands:
+                    pending.written_at = written_at
+                self.serial_conn.write(data)
+
+                if not WaitForOk:
+                    futures[0].set_result((True, None))
+            except Exception as e:
+                for future in futures:
+                    self._discard_pending(future)
+                    if not future.done():
+                        future.set_result((False, f"Failed to write to Swapper3D: {e}"))
+
+        # drain anything still queued after stop()
+        while True:
+            try:
+                item = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                continue
+            for future in item[2]:
+                if not future.done():
+                    future.set_result((False, "Serial engine stopped"))
+
+    def _reader_loop(self):
+        reader = FrameReader()
+        serial_conn = self.serial_conn
+        while self._running:
+            try:
+                # block for the first byte (up to the read timeout) then take everything that is already waiting
+                data = serial_conn.read(serial_conn.in_waiting or 1)
+            except Exception as e:
+                self._plugin.log.error("Swapper3D serial read failed: %s", e)
+                self._running = False
+                self._write_queue.put(None)
+                self._fail_all_pending(f"Swapper3D serial read failed: {e}")
+                return
+
+            if not data:
+                continue
+
+            # incomplete frames stay in the reader until their newline arrives
+            for frame in reader.feed(data):
+                self._handle_frame(frame)
+
+    def _handle_frame(self, frame):
+        valid, message_without_parity_bit = decode_frame(frame)
+
+        if not valid:
+            self._plugin.log.error("Parity check failed for message: %s", frame.decode('ascii', 'replace'))
+            # a corrupted frame belongs to the oldest command still waiting, fail that one
+            future = self._pop_oldest_pending()
+            if future is not None and not future.done():
+                future.set_result((False, "Parity check did not pass."))
+            return
+
+        if self._plugin.log.is_enabled(logging.DEBUG):
+            self._plugin.log.debug("Swapper3D read: %s %s", message_without_parity_bit, debug_repr(message_without_parity_bit))
+
+        received_at = time.monotonic()
+        self.last_rx = received_at
+        pending = None
+        with self._pending_lock:
+            for entry in self._pending:
+                if entry.expected == message_without_parity_bit:
+                    pending = entry
+                    break
+            if pending is not None:
+                self._pending.remove(pending)
+            if pending is not None and pending.written_at is not None:
+                self._record_latency(pending.command, received_at - pending.written_at)
+
+        if pending is None:
+            try:
+                self._unsolicited.put_nowait(message_without_parity_bit)
+            except queue.Full:
+                self._plugin.log.warning("Dropped unexpected response: %s", message_without_parity_bit)
+        elif pending.future is None:
+            for listener in self.swallowed_ack_listeners:
+                listener(pending.command)
+        elif not pending.future.done():
+            pending.future.latency = received_at - pending.written_at
+            pending.future.set_result((True, None))
+
+    def _pop_oldest_pending(self):
+        with self._pending_lock:
+            for entry in self._pending:
+                if entry.future is not None:
+                    self._pending.remove(entry)
+                    return entry.future
+        return None
+
+    def _discard_pending(self, future):
+        with self._pending_lock:
+            for entry in self._pending:
+                if entry.future is future:
+                    self._pending.remove(entry)
+                    break
+
+    def _fail_all_pending(self, reason):
+        with self._pending_lock:
+            pending = [entry.future for entry in self._pending]
+            self._pending.clear()
+        for future in pending:
+            if future is not None and not future.done():
+                future.set_result((False, reason))
+
+
+def attach_serial_engine(plugin, serial_conn):
+    # start an engine for a freshly handshaken port and make it the plugin's only way to talk to the Swapper3D
+    detach_serial_engine(plugin)
+    plugin.serial_conn = serial_conn
+    plugin.serial_engine = SerialEngine(plugin, serial_conn)
+    # commands sent without waiting for their ok are counted when the ok arrives, like the awaited ones
+    plugin.serial_engine.swallowed_ack_listeners.append(plugin.wear_counters.count_command)
+    plugin.serial_engine.start()
+    return plugin.serial_engine
+
+
+def detach_serial_engine(plugin, reason="Swapper3D disconnected"):
+    engine = getattr(plugin, "serial_engine", None)
+    if engine is not None:
+        engine.stop(reason)
+    plugin.serial_engine = None
@@ -0,0 +1,176 @@
+# Octoprint plugin name: Swapper3D, File: settings_snapshot.py, Author: BigBrain3D, License: AGPLv3
+# Typed copy of the plugin settings.
+# OctoPrint stores the settings as entered on the settings page, mostly as strings. Reading them with
+# _settings.get() and converting them with int()/float() in the middle of a swap costs time on every swap
+# and a bad value (e.g. "1OO" as msDelayAfterExtrude) only shows up as an exception halfway through the swap.
+# Instead all the settings in get_default_settings() are read and converted once into a SettingsSnapshot:
+#   - at startup (initialize) and after every settings save (on_settings_save)
+#   - bad values are refused when the settings are saved, the previous value is kept
+# Swap code reads plugin.settings_snapshot.<key>, which is a plain attribute.
+from .default_settings import get_default_settings
+
+
+def _to_int(value):
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError("must be a whole number")
+    return int(number)
+
+
+def _to_float(value):
+    return float(value)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ("1", "true", "yes", "on"):
+            return True
+        if value in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError("must be on or off")
+    return bool(value)
+
+
+def _to_str(value):
+    return value if value is None else str(value)
+
+
+# keys not listed here are kept as text (G-code templates, serial port, ...)
+SETTING_TYPES = {
+    "xPos": _to_float,
+    "yPos": _to_float,
+    "yBreakStringPosition": _to_float,
+    "yBreakStringSpeed": _to_int,
+    "xPositionAfterWipe": _to_int,
+    "BreakString": _to_bool,
+    "xMinPositionForWipe": _to_int,
+    "xMaxPositionForWipe": _to_int,
+    "MinExtrusionBeforeSwap": _to_float,
+    "RejectBadSwapFiles": _to_bool,
+    "zHeight": _to_float,
+    "ExtraExtrusionAfterSwap": _to_float,
+    "RetractionDistanceAfterSwap": _to_float,
+    "StockExtruderMaxFeedrate": _to_float,
+    "SwapExtruderMaxFeedrate": _to_float,
+    "StockExtruderMaxAcceleration": _to_int,
+    "SwapExtruderMaxAcceleration": _to_int,
+    "PrinterMaxAcceleration": _to_int,
+    "PrinterMaxFeedrateZ": _to_float,
+    "zMotorCurrent": _to_int,
+    "baudrate": _to_int,
+    "maxBaudrate": _to_int,
+    "commandTimeout": _to_float,
+    "BatchSwapperCommands": _to_bool,
+    "heartbeatInterval": _to_float,
+    "heartbeatTimeout": _to_float,
+    "messageInterval": _to_int,
+    "extrudeSpeedPulldown": _to_int,
+    "retractSpeed": _to_int,
+    "extrudeLengthLockingHeight": _to_float,
+    "extrudeLengthCuttingHeight": _to_float,
+    "retractLengthAfterCut": _to_float,
+    "msDelayAfterExtrude": _to_float,
+    "msDelayPerDegreeMovedDuringSwapPulldown": _to_int,
+    "NozzleWipe": _to_bool,
+    "extrudeSpeedPaletteCuts": _to_int,
+    "numPaletteCuts": _to_int,
+    "lengthAdditionalCut": _to_float,
+    "totalNumberSwaps": _to_int,
+    "actuations": _to_int,
+    "TR": _to_int,
+    "TH": _to_int,
+    "TL": _to_int,
+    "QL": _to_int,
+    "HR": _to_int,
+    "CR": _to_int,
+    "CA": _to_int,
+    "WA": _to_int,
+    "extraFilamentCutLength": _to_float,
+    "lengthEachCut": _to_float,
+}
+
+# lower bounds, e.g. a negative delay or cut count is never meant
+SETTING_MINIMUMS = {
+    "MinExtrusionBeforeSwap": 0,
+    "commandTimeout": 1,
+    "PrinterMaxAcceleration": 1,
+    "PrinterMaxFeedrateZ": 0.1,
+    "heartbeatInterval": 0,
+    "heartbeatTimeout": 0.1,
+    "messageInterval": 50,
+    "msDelayAfterExtrude": 0,
+    "msDelayPerDegreeMovedDuringSwapPulldown": 0,
+    "numPaletteCuts": 0,
+}
+
+
+def convert_setting(key, value):
+    """
+    Convert one setting to its type.
+
+    :return: (value, error), error is None when the value is valid
+    """
+    converter = SETTING_TYPES.get(key, _to_str)
+    try:
+        converted = converter(value)
+    except (TypeError, ValueError) as e:
+        return None, f"{key}: '{value}' is not valid ({e})"
+    minimum = SETTING_MINIMUMS.get(key)
+    if minimum is not None and converted < minimum:
+        return None, f"{key}: '{value}' must be at least {minimum}"
+    return converted, None
+
+
+def validate_settings_update(data):
+    """
+    Check the settings sent by the settings page before they are saved.
+    Invalid values are removed from data, so the previously saved value stays in place.
+
+    :return: list of errors, empty when all values are valid
+    """
+    errors = []
+    for key in list(data):
+        if key not in SETTING_TYPES:
+            continue
+        _, error = convert_setting(key, data[key])
+        if error is not None:
+            errors.append(error)
+            del data[key]
+
+    if "xMinPositionForWipe" in data and "xMaxPositionForWipe" in data:
+        x_min, _ = convert_setting("xMinPositionForWipe", data["xMinPositionForWipe"])
+        x_max, _ = convert_setting("xMaxPositionForWipe", data["xMaxPositionForWipe"])
+        if x_min > x_max:
+            errors.append("xMinPositionForWipe must not be larger than xMaxPositionForWipe")
+            del data["xMinPositionForWipe"]
+            del data["xMaxPositionForWipe"]
+    return errors
+
+
+class SettingsSnapshot:
+    __slots__ = tuple(get_default_settings())
+
+
+def build_settings_snapshot(settings):
+    """
+    Read every setting from OctoPrint's settings and convert it.
+    A stored value that cannot be converted (e.g. edited by hand in config.yaml) is replaced by its default.
+
+    :return: (snapshot, errors)
+    """
+    defaults = get_default_settings()
+    snapshot = SettingsSnapshot()
+    errors = []
+    for key, default in defaults.items():
+        value, error = convert_setting(key, settings.get([key]))
+        if error is not None:
+            errors.append(f"{error}, using the default '{default}'")
+            value, _ = convert_setting(key, default)
+        setattr(snapshot, key, value)
+
+    if snapshot.xMinPositionForWipe > snapshot.xMaxPositionForWipe:
+        errors.append("xMinPositionForWipe is larger than xMaxPositionForWipe, using the defaults")
+        snapshot.xMinPositionForWipe, _ = convert_setting("xMinPositionForWipe", defaults["xMinPositionForWipe"])
+        snapshot.xMaxPositionForWipe, _ = convert_setting("xMaxPositionForWipe", defaults["xMaxPositionForWipe"])
+    return snapshot, errors
@@ -0,0 +1,280 @@
+# Octoprint plugin name: Swapper3D, File: simulator.py, Author: BigBrain3D, License: AGPLv3
+# Simulator of the Arduino side of the Swapper3D serial protocol on a Linux pseudo-terminal.
+# Lets the serial code be exercised without the hardware, e.g. in CI or under load:
+#
+#   sim = Swapper3DSimulator(command_times={"load_insert": 2.5}, jitter=0.1)
+#   sim.start()
+#   # point the plugin at sim.port (serialPortOverride setting or try_handshake(plugin, ports=[sim.port]))
+#   ...
+#   sim.stop()
+#
+# or from a shell: python -m Swapper3D_Package.simulator --time load_insert=2.5 --jitter 0.1
+#
+# Like the firmware, commands are executed one after the other in the order they were received and
+# every command is answered with "<command>_ok" plus parity digit once its (simulated) execution time has passed.
+# Faults can be injected: dropped bytes and wrong parity digits in the replies.
+import argparse
+import os
+import queue
+import random
+import termios
+import threading
+import time
+import tty
+from .frame_codec import FrameReader, decode_frame, encode_frame
+
+# seconds a command takes on the real Swapper3D, roughly; matched by prefix so "load_insert" covers load_insert0..24
+DEFAULT_COMMAND_TIMES = {
+    "octoprint": 0.0,
+    "load_insert": 3.0,
+    "unload_connect": 0.5,
+    "unload_pulldown_lockingheight": 1.0,
+    "unload_pulldown_cuttingheight": 1.0,
+    "unload_deploycutter": 0.5,
+    "unload_AvoidBin": 0.2,
+    "unload_stowCutter": 0.5,
+    "unload_stowInsert": 1.0,
+    "unload_dumpWaste": 0.5,
+    "unloaded_message": 0.0,
+    "cutter_open": 0.2,
+    "cutter_cut": 0.3,
+    "wiper_deploy": 0.4,
+    "wiper_stow": 0.4,
+    "InsertNumber": 0.0,
+    "hometoolrotate": 1.0,
+    "borealignon": 0.5,
+    "borealignoff": 0.5,
+    "readmajor": 0.0,
+    "readminor": 0.0,
+    "readpatch": 0.0,
+    "RetrieveCurrentFirmwareVersion": 0.0,
+    "setbaud": 0.0,
+}
+
+
+class Swapper3DSimulator:
+    def __init__(self, command_times=None, time_scale=1.0, jitter=0.0, drop_rate=0.0, parity_fault_rate=0.0,
+                 boot_time=0.0, firmware_version=(1, 0, 0), max_baudrate=115200, seed=None):
+        """
+        :param command_times: dict of command prefix -> execution time in seconds, merged over DEFAULT_COMMAND_TIMES
+        :param time_scale: multiplier for all execution times, 0 answers immediately
+        :param jitter: +/- seconds of uniform random jitter added to each execution time
+        :param drop_rate: probability that one byte of a reply frame is lost
+        :param parity_fault_rate: probability that a reply frame is sent with the wrong parity digit
+        :param boot_time: seconds after start() during which received commands are ignored, like the Arduino bootloader
+        :param firmware_version: (major, minor, patch) sent after readmajor/readminor/readpatch
+        :param max_baudrate: fastest rate accepted by setbaud, None simulates old firmware without setbaud
+        :param seed: random seed so that fault injection is reproducible
+        """
+        self.command_times = dict(DEFAULT_COMMAND_TIMES)
+        if command_times:
+            self.command_times.update(command_times)
+        self.time_scale = time_scale
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.parity_fault_rate = parity_fault_rate
+        self.boot_time = boot_time
+        self.firmware_version = firmware_version
+        self.max_baudrate = max_baudrate
+        self.baudrate = 9600  # like the EEPROM of the firmware this survives stop()/start()
+        self._baudrate_confirmed = threading.Event()
+        self._random = random.Random(seed)
+
+        self.port = None
+        self._master_fd = None
+        self._slave_fd = None
+        self._commands = queue.Queue()
+        self._running = False
+        self._threads = []
+        self._booted_at = 0.0
+
+        # what the device has done, for tests and benchmarks
+        self.received_commands = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.loaded_insert = None
+        self.tool_rotate_position = None
+
+    def start(self):
+        self._master_fd, self._slave_fd = os.openpty()
+        # raw mode so the pty does not echo or translate anything, like a real USB serial port
+        tty.setraw(self._slave_fd)
+        tty.setraw(self._master_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._running = True
+        self._booted_at = time.monotonic() + self.boot_time
+        self._threads = [threading.Thread(target=self._read_loop, name="Swapper3D-simulator-read", daemon=True),
+                         threading.Thread(target=self._execute_loop, name="Swapper3D-simulator-execute", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        self._commands.put(None)
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master_fd = self._slave_fd = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_command_time(self, command):
+        base = 0.0
+        for prefix, seconds in self.command_times.items():
+            if command.startswith(prefix):
+                base = seconds
+                break
+        if self.jitter:
+            base += self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, base * self.time_scale)
+
+    def _read_loop(self):
+        reader = FrameReader()
+        while self._running:
+            try:
+                data = os.read(self._master_fd, 256)
+            except OSError:
+                break
+            if not data:
+                continue
+            self.bytes_received += len(data)
+            if time.monotonic() < self._booted_at:
+                continue  # still in the bootloader, the bytes are lost
+            if self._link_baudrate() not in (None, self.baudrate):
+                reader.clear()
+                continue  # the host talks at a different rate, for the firmware that is just noise
+            for frame in reader.feed(data):
+                valid, command = decode_frame(frame)
+                if valid:
+                    self._baudrate_confirmed.set()
+                    self._commands.put(command)
+                # frames with a bad parity are ignored, like the firmware does
+
+    def _execute_loop(self):
+        while self._running:
+            command = self._commands.get()
+            if command is None:
+                break
+            self.received_commands.append(command)
+            reply = self._execute(command)
+            if reply is None:
+                continue
+            duration = self.get_command_time(command)
+            if duration:
+                time.sleep(duration)
+            for message in reply:
+                self._send(message)
+            if command.startswith("setbaud"):
+                self._switch_baudrate(int(command[len("setbaud"):]))
+
+    def _link_baudrate(self):
+        # the rate the host set on its end of the pty; None when it cannot be told
+        try:
+            speed = termios.tcgetattr(self._slave_fd)[4]
+        except (termios.error, TypeError):
+            return None
+        for baudrate in (115200, 57600, 38400, 19200, 9600):
+            if speed == getattr(termios, f"B{baudrate}", None):
+                return baudrate
+        return None
+
+    def _switch_baudrate(self, baudrate):
+        # called after the ok for setbaud has been sent; switch back if nothing valid arrives within a second
+        previous = self.baudrate
+        self._baudrate_confirmed.clear()
+        self.baudrate = baudrate
+
+        def confirm():
+            if not self._baudrate_confirmed.wait(1.0):
+                self.baudrate = previous
+
+        threading.Thread(target=confirm, name="Swapper3D-simulator-baud", daemon=True).start()
+
+    def _execute(self, command):
+        # returns the frames to answer with, or None for unknown commands (the firmware ignores those)
+        if command == "octoprint":
+            return ["octoprint_ok"]
+        if command.startswith("setbaud"):
+            try:
+                baudrate = int(command[len("setbaud"):])
+            except ValueError:
+                return None
+            if self.max_baudrate is None or baudrate > self.max_baudrate:
+                return None
+            return [f"{command}_ok"]
+        if command.startswith("load_insert"):
+            self.loaded_insert = command[len("load_insert"):]
+            self.tool_rotate_position = self.loaded_insert
+            return [f"{command}_ok"]
+        if command == "unload_stowInsert":
+            # the wheel turns to the slot of the insert to put it back
+            self.tool_rotate_position = self.loaded_insert
+            self.loaded_insert = None
+        if command == "hometoolrotate":
+            self.tool_rotate_position = None
+        if command in ("readmajor", "readminor", "readpatch"):
+            part = self.firmware_version[("readmajor", "readminor", "readpatch").index(command)]
+            return [f"{command}_ok", str(part)]
+        for prefix in DEFAULT_COMMAND_TIMES:
+            if command.startswith(prefix):
+                return [f"{command}_ok"]
+        if command in self.command_times:
+            return [f"{command}_ok"]
+        return None
+
+    def _send(self, message):
+        frame = bytearray(encode_frame(message))
+        if self.parity_fault_rate and self._random.random() < self.parity_fault_rate:
+            frame[-2] ^= 1  # flip "0" <-> "1"
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            del frame[self._random.randrange(len(frame))]
+        try:
+            os.write(self._master_fd, bytes(frame))
+            self.bytes_sent += len(frame)
+        except (OSError, TypeError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Swapper3D device simulator on a pseudo-terminal")
+    parser.add_argument("--time", action="append", default=[], metavar="PREFIX=SECONDS",
+                        help="execution time of commands starting with PREFIX, can be repeated")
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--parity-fault-rate", type=float, default=0.0)
+    parser.add_argument("--boot-time", type=float, default=0.0)
+    parser.add_argument("--max-baudrate", type=int, default=115200, help="0 simulates firmware without setbaud")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    command_times = {}
+    for item in args.time:
+        prefix, seconds = item.split("=", 1)
+        command_times[prefix] = float(seconds)
+
+    simulator = Swapper3DSimulator(command_times=command_times, time_scale=args.time_scale, jitter=args.jitter,
+                                   drop_rate=args.drop_rate, parity_fault_rate=args.parity_fault_rate,
+                                   boot_time=args.boot_time, max_baudrate=args.max_baudrate or None, seed=args.seed)
+    port = simulator.start()
+    print(f"Swapper3D simulator listening on {port} (set it as serialPortOverride in the plugin settings)", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,15 @@ function Swapper3DViewModel(parameters) {
 
     self.onDataUpdaterPluginMessage = function(plugin, data) {
         if (plugin === "Swapper3D") {
-            if (data.type === "log") {
+            if (data.type === "batch") {
+                // the plugin sends its log lines and state updates bundled, see message_channel.py
+                if (data.logs.length > 0) {
+                    self.logToSwapper3D(data.logs.join("\n"));
+                }
+                data.states.forEach(function(state) {
+                    self.onDataUpdaterPluginMessage(plugin, state);
+                });
+            } else if (data.type === "log") {
                 self.logToSwapper3D(data.message);
             } else if (data.type === "connectionState") {
                 $("#connectionState").val(data.message);
@@ -102,6 +110,24 @@ function Swapper3DViewModel(parameters) {
         });
     };
 
+    // the Statistics in the settings are the wear counters of the plugin, they are read-only, see wear_counters.py
+    self.refreshCounters = function() {
+        $.ajax({
+            url: "/plugin/Swapper3D/counters",
+            type: "GET",
+            dataType: "json",
+            success: function(response) {
+                $(".swapper3d-counter").each(function() {
+                    $(this).val(response.counters[$(this).data("counter")]);
+                });
+            }
+        });
+    };
+
+    self.onSettingsShown = function() {
+        self.refreshCounters();
+    };
+
     self.onStartupComplete = function() {
         $('#connectSwapper3D').click(self.connectSwapper3D);
         $('#disconnectSwapper3D').click(self.disconnectSwapper3D);
@@ -0,0 +1,252 @@
+# Octoprint plugin name: Swapper3D, File: step_scheduler.py, Author: BigBrain3D, License: AGPLv3
+# Runs the steps of an unload/load/wipe sequence as a dependency graph instead of a hand-sequenced script.
+# Every step names the steps it has to wait for (after=[...]) and is done when:
+#   PrinterStep  the G-code was queued, or with wait_for_motion:
+#                True     when the printer has finished the moves (M400 followed by an M118 echo token that
+#                         on_gcode_received hands to the EchoWaiter, see printer_echoes.py); the motion model
+#                         (motion_model.py) says how long that takes, the step times out after MOTION_TIMEOUT_MARGIN
+#                         times that plus MOTION_TIMEOUT_SLACK, so a printer that stopped (paused on its display,
+#                         stalled, disconnected) fails the swap within seconds instead of after commandTimeout
+#                "model"  when the motion model says the moves are done, counted from when the printer is done with
+#                         the blocks queued before (MotionClock) plus MODEL_WAIT_SLACK; no echo round trip, used
+#                         where the next step only needs the head or the filament in place (wipe, Palette cuts)
+#   SwapperStep  the Swapper3D acked the command(s), see perform_command
+#   DelayStep    the time has passed
+# run_steps() starts every step as soon as the steps it depends on are done, so independent branches (e.g. the
+# retract on the printer and cutter_open on the Swapper3D) run at the same time and only the real ordering
+# constraints are serialized.
+#
+#   run_steps(plugin, [
+#       SwapperStep("cut", ["cutter_open", "unload_deploycutter120", "cutter_cut"]),
+#       PrinterStep("retract", ["G92 E0", "G1 E-70 F10000"], after=["cut"], wait_for_motion=True),
+#       SwapperStep("open", "cutter_open", after=["cut"]),
+#       SwapperStep("stow", ["unload_stowCutter", "unload_stowInsert"], after=["retract", "open"]),
+#   ])
+#
+# Like the script it replaces, a failed step is logged and its dependents still run; the caller gets the
+# (success, error) of every step.
+import abc
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+# Swapper3D_utils builds its sequences with this module, so it is imported as a module and used at run time
+from . import Swapper3D_utils
+
+ECHO_PREFIX = "S3D_done_"
+# the model is an upper bound of the motion itself; the slack covers sending the block and the echo
+MOTION_TIMEOUT_MARGIN = 2.0
+MOTION_TIMEOUT_SLACK = 5.0  # seconds
+# sending the block to the printer until its planner starts it, the model itself is an upper bound of the motion
+MODEL_WAIT_SLACK = 0.05  # seconds
+
+
+class EchoWaiter:
+    """Futures for the echo tokens the printer sends back once it has executed everything queued before them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = itertools.count(1)
+        self._waiting = {}
+
+    def expect(self):
+        """:return: (token, future), the future resolves to (True, None) when the token is echoed"""
+        token = f"{ECHO_PREFIX}{next(self._tokens)}"
+        future = Future()
+        with self._lock:
+            self._waiting[token] = future
+        return token, future
+
+    def forget(self, token):
+        with self._lock:
+            self._waiting.pop(token, None)
+
+    def resolve(self, token):
+        """Called with every echo token received from the printer."""
+        with self._lock:
+            future = self._waiting.pop(token, None)
+        # the token is also sent with M117 for the virtual printer, the second echo finds no future
+        if future is not None and not future.done():
+            future.set_result((True, None))
+
+
+class Step(abc.ABC):
+    def __init__(self, name, after=(), timeout=None):
+        self.name = name
+        self.after = tuple(after)
+        self.timeout = timeout  # seconds, None uses the commandTimeout setting
+
+    def get_timeout(self, command_timeout):
+        return self.timeout if self.timeout is not None else command_timeout
+
+    @abc.abstractmethod
+    def start(self, plugin, executor):
+        """Start the step. :return: Future resolving to (success, error)"""
+
+
+class PrinterStep(Step):
+    def __init__(self, name, gcode_commands, after=(), wait_for_motion=False, timeout=None):
+        Step.__init__(self, name, after, timeout)
+        self.gcode_commands = list(gcode_commands)
+        self.wait_for_motion = wait_for_motion
+        self.token = None
+        self.motion_time = 0.0  # seconds the motion model expects, worked out when the step starts
+        self.wait_time = 0.0  # seconds until the moves are done, including the blocks queued before
+
+    def get_timeout(self, command_timeout):
+        if self.timeout is not None:
+            return self.timeout
+        if not self.wait_for_motion:
+            return command_timeout
+        if self.wait_for_motion == "model":
+            return self.wait_time + command_timeout
+        return self.motion_time * MOTION_TIMEOUT_MARGIN + MOTION_TIMEOUT_SLACK
+
+    def start(self, plugin, executor):
+        gcode_commands = self.gcode_commands
+        # every block is on the clock, also the ones nobody waits for, a later block starts after them
+        self.motion_time = plugin.motion_model.block_time(gcode_commands, plugin.printer_state)
+        self.wait_time = plugin.motion_clock.queue(self.motion_time) - time.monotonic() + MODEL_WAIT_SLACK
+
+        if self.wait_for_motion == "model":
+            plugin._printer.commands(gcode_commands)
+            return _timer_future(self.wait_time)
+
+        if not self.wait_for_motion:
+            plugin._printer.commands(gcode_commands)
+            future = Future()
+            future.set_result((True, None))
+            return future
+
+        self.token, future = plugin.echo_waiter.expect()
+        plugin._printer.commands(gcode_commands + ["M400",  # wait until the moves are finished
+                                                   f"M118 E1 {self.token}",
+                                                   f"M117 E1 {self.token}"])  # works with virtual printer
+        return future
+
+    def abandon(self, plugin):
+        if self.token is not None:
+            plugin.echo_waiter.forget(self.token)
+
+
+class SwapperStep(Step):
+    def __init__(self, name, command, after=(), wait_for_ok=True, timeout=None):
+        Step.__init__(self, name, after, timeout)
+        # a list is sent with perform_command_batch, which always waits for every ok
+        if not wait_for_ok and isinstance(command, (list, tuple)):
+            raise ValueError(f"Step '{name}': only a single command can be sent without waiting for its ok")
+        self.command = command  # a command or a list of commands that may be batched
+        self.wait_for_ok = wait_for_ok
+
+    def get_timeout(self, command_timeout):
+        # every command of a batch has its own timeout in perform_command
+        if self.timeout is not None:
+            return self.timeout
+        count = len(self.command) if isinstance(self.command, (list, tuple)) else 1
+        return command_timeout * count + 1
+
+    def start(self, plugin, executor):
+        # perform_command blocks until the ok (and applies the per-command timeout), so it runs on a worker
+        return executor.submit(Swapper3D_utils.perform_command, plugin, self.command, self.wait_for_ok)
+
+
+class DelayStep(Step):
+    def __init__(self, name, milliseconds, after=()):
+        Step.__init__(self, name, after)
+        self.seconds = max(0.0, milliseconds / 1000)
+
+    def get_timeout(self, command_timeout):
+        return self.seconds + command_timeout
+
+    def start(self, plugin, executor):
+        return _timer_future(self.seconds)
+
+
+def _timer_future(seconds):
+    future = Future()
+    timer = threading.Timer(seconds, future.set_result, args=((True, None),))
+    timer.daemon = True
+    timer.start()
+    return future
+
+
+def check_steps(steps):
+    """:return: error message when a step depends on an unknown step or the steps depend on each other in a circle"""
+    names = {step.name for step in steps}
+    for step in steps:
+        for name in step.after:
+            if name not in names:
+                return f"Step '{step.name}' waits for unknown step '{name}'"
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if all(name in done for name in step.after)]
+        if not ready:
+            return f"Steps wait for each other: {[step.name for step in remaining]}"
+        for step in ready:
+            done.add(step.name)
+            remaining.remove(step)
+    return None
+
+
+def run_steps(plugin, steps, on_step_done=None):
+    """
+    Run the steps, each one as soon as the steps it waits for are done.
+
+    :param on_step_done: optional, called with (step, seconds, success) when a step is done, failed or timed out
+    :return: dict of step name -> (success, error)
+    """
+    error = check_steps(steps)
+    if error is not None:
+        raise ValueError(error)
+
+    command_timeout = Swapper3D_utils.get_command_timeout(plugin)
+    results = {}
+    pending = list(steps)
+    running = {}  # future -> (step, started at, deadline)
+
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix="Swapper3D-step") as executor:
+        while pending or running:
+            ready = [step for step in pending if all(name in results for name in step.after)]
+            for step in ready:
+                pending.remove(step)
+                plugin.log.debug("Step %s started", step.name)
+                started_at = time.monotonic()
+                future = step.start(plugin, executor)
+                running[future] = (step, started_at, started_at + step.get_timeout(command_timeout))
+
+            nearest_deadline = min(deadline for _, _, deadline in running.values())
+            done, _ = wait(list(running), timeout=max(0.0, nearest_deadline - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                step, started_at, _ = running.pop(future)
+                try:
+                    success, error = future.result()
+                except Exception as e:
+                    success, error = False, str(e)
+                results[step.name] = (success, error)
+                if success and isinstance(step, PrinterStep) and step.wait_for_motion:
+                    plugin.log.debug("Step %s done, the motion model expected %.2f s", step.name, step.motion_time)
+                elif success:
+                    plugin.log.debug("Step %s done", step.name)
+                else:
+                    plugin.log.error("Step %s failed: %s", step.name, error)
+                if on_step_done is not None:
+                    on_step_done(step, time.monotonic() - started_at, success)
+
+            now = time.monotonic()
+            for future, (step, started_at, deadline) in list(running.items()):
+                if now >= deadline and not future.done():
+                    del running[future]
+                    error = f"Timed out after {now - started_at:.1f} s"
+                    if isinstance(step, PrinterStep):
+                        step.abandon(plugin)
+                        if step.wait_for_motion:
+                            error += f", the printer should have finished the moves in {step.motion_time:.1f} s"
+                    results[step.name] = (False, error)
+                    plugin.log.error("Step %s failed: %s", step.name, error)
+                    if on_step_done is not None:
+                        on_step_done(step, now - started_at, False)
+
+    return results
@@ -0,0 +1,136 @@
+# Octoprint plugin name: Swapper3D, File: swap_journal.py, Author: BigBrain3D, License: AGPLv3
+# Journal of the swap state (current_extruder, insertLoaded, InitialLoadComplete, extrusionSinceLastSwap), so after
+# a restart of OctoPrint the plugin knows which insert is in the hotend instead of it being unloaded and reloaded
+# by hand.
+#
+# Every change of the state appends one line with the whole state to swap_journal.log in the plugin data folder:
+#   <crc32 of the JSON, 8 hex digits> <JSON>
+# The line is written to the file right away, so it survives OctoPrint crashing; a flusher thread fsyncs at most
+# every FSYNC_INTERVAL seconds, so the swap never waits for the disk and a power loss loses at most that much.
+# On startup the journal is replayed: the last line with a correct checksum is the state, a line torn by a crash
+# is skipped. Once the journal has MAX_RECORDS lines it is rewritten with only the last state.
+import json
+import os
+import threading
+import zlib
+
+FSYNC_INTERVAL = 0.5  # seconds
+MAX_RECORDS = 1000
+STATE_KEYS = ("current_extruder", "insertLoaded", "InitialLoadComplete", "extrusionSinceLastSwap")
+
+
+def encode_record(state):
+    payload = json.dumps(state, separators=(",", ":"), sort_keys=True)
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+
+def decode_record(line):
+    """:return: the state of a journal line, or None when the line is torn or corrupt"""
+    checksum, _, payload = line.rstrip("\n").partition(" ")
+    if len(checksum) != 8 or not payload:
+        return None
+    try:
+        if int(checksum, 16) != zlib.crc32(payload.encode("utf-8")):
+            return None
+        state = json.loads(payload)
+    except ValueError:
+        return None
+    return state if isinstance(state, dict) else None
+
+
+class SwapJournal:
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL, max_records=MAX_RECORDS):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._file = None
+        self._records = 0
+        self._last_state = None
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def replay(self):
+        """:return: the last consistent state in the journal, or None when there is none"""
+        state = None
+        records = 0
+        try:
+            with open(self.path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    records += 1
+                    decoded = decode_record(line)
+                    if decoded is not None:
+                        state = decoded
+        except OSError:
+            return None
+        with self._lock:
+            self._records = records
+            self._last_state = state
+        return state
+
+    def record(self, state):
+        """Append the state. Returns without waiting for the disk, the flusher fsyncs."""
+        line = encode_record(state)
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self._records += 1
+            self._last_state = state
+        self._dirty.set()
+        self.start()
+
+    def close(self):
+        """Stop the flusher and fsync what is left, called at shutdown."""
+        self._stop.set()
+        self._dirty.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=5)
+        self._sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="Swapper3D-journal", daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            self._dirty.clear()
+            self._sync()
+            if self._records >= self.max_records:
+                self._compact()
+            # changes in the meantime are written but wait for the next fsync
+            self._stop.wait(self.fsync_interval)
+
+    def _sync(self):
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                os.fsync(self._file.fileno())
+            except OSError:
+                pass
+
+    def _compact(self):
+        with self._lock:
+            if self._last_state is None:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(encode_record(self._last_state))
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+            os.replace(temp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._records = 1
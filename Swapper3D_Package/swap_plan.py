@@ -0,0 +1,188 @@
+# Octoprint plugin name: Swapper3D, File: swap_plan.py, Author: BigBrain3D, License: AGPLv3
+# Swap plan of a G-code file, worked out once when the file is uploaded instead of line by line during the print.
+# analyze_gcode() streams the file through the same PrinterStateTracker that hook_gcode_queuing uses and records
+# every tool change:
+#   line number, tool, layer, Z, filament extruded since the previous swap and, when the runtime guards would not
+#   swap, why (same tool as loaded or less than MinExtrusionBeforeSwap extruded)
+# Problems that would stop a print halfway (a tool the Swapper3D has no insert for, "Tc"/"Tx"/"T?" style tool changes)
+# are found before the print starts. Like OctoPrint, only T followed by a number is a tool change; other commands that
+# start with T (e.g. the Klipper macro TIMELAPSE_TAKE_FRAME) are not.
+#
+# The plan is stored as a small JSON sidecar in the plugin data folder, named by the SHA-256 of the file,
+# so printing the same file again (also after renaming it) loads the plan instead of analyzing the file again.
+# SwapPlanCursor walks the plan during the print; hook_gcode_queuing takes the guard decision from the plan
+# as long as the queued tool changes match it.
+import collections
+import hashlib
+import json
+import os
+import re
+from .printer_state import PrinterStateTracker
+
+PLAN_VERSION = 2  # 2: only T<number> is a tool change
+MAX_TOOL = 24  # the Swapper3D holds 25 inserts, T0..T24
+
+# why a tool change is not swapped, same as the guards in hook_gcode_queuing
+SKIP_SAME_TOOL = "same_tool"
+SKIP_MIN_EXTRUSION = "min_extrusion"
+
+# a planned tool change; skip is None when it is swapped, otherwise why not
+# stored in the JSON sidecar as a list in this order
+ToolChange = collections.namedtuple("ToolChange", ("line", "tool", "layer", "z", "extrusion", "skip"))
+
+# T<number>, and the Prusa MMU tool changes that let the printer choose (Tc, Tx, T?)
+_TOOL_CHANGE = re.compile(r"T(\d+|[cx?])$")
+
+# comments slicers put at the start of a layer
+_LAYER_COMMENTS = (";LAYER_CHANGE", ";LAYER:", "; layer ")
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def analyze_gcode(lines, min_extrusion):
+    """
+    Work out the swap plan of a G-code file.
+
+    :param lines: iterable of G-code lines, e.g. an open text file
+    :param min_extrusion: the MinExtrusionBeforeSwap setting
+    :return: plan dict, see SwapPlanCursor for how it is used
+    """
+    state = PrinterStateTracker()
+    state_updates = {
+        "G0": state.on_z_e_move, "G1": state.on_z_e_move, "G2": state.on_z_e_move, "G3": state.on_z_e_move,
+        "G28": state.on_home,
+        "G90": state.on_absolute, "G91": state.on_relative, "G92": state.on_set_position,
+        "M82": state.on_e_absolute, "M83": state.on_e_relative,
+    }
+
+    tool_changes = []  # ToolChange
+    problems = []
+    layer = 0
+    current_tool = None
+    initial_load_complete = False
+
+    for line_number, raw_line in enumerate(lines, 1):
+        if raw_line.startswith(";"):
+            if raw_line.startswith(_LAYER_COMMENTS):
+                layer += 1
+            continue
+
+        comment = raw_line.find(";")
+        cmd = (raw_line if comment < 0 else raw_line[:comment]).strip()
+        if not cmd:
+            continue
+        space = cmd.find(" ")
+        gcode = cmd if space < 0 else cmd[:space]
+
+        update = state_updates.get(gcode)
+        if update is not None:
+            update(cmd)
+            continue
+        match = _TOOL_CHANGE.match(gcode)
+        if match is None:
+            continue
+
+        tool = match.group(1)
+        if not tool.isdigit():
+            problems.append(f"line {line_number}: tool change '{cmd}' is not supported by the Swapper3D")
+            continue
+        if int(tool) > MAX_TOOL:
+            problems.append(f"line {line_number}: T{tool} has no insert, the Swapper3D holds T0 to T{MAX_TOOL}")
+            continue
+
+        extrusion = round(state.extrusion_since_swap, 3)
+        skip = None
+        if initial_load_complete and current_tool is not None:
+            if current_tool == tool:
+                skip = SKIP_SAME_TOOL
+            elif extrusion < min_extrusion:
+                skip = SKIP_MIN_EXTRUSION
+        tool_changes.append(ToolChange(line_number, tool, layer, state.z, extrusion, skip))
+
+        if skip is None:
+            current_tool = tool
+            initial_load_complete = True
+            state.reset_extrusion()
+
+    return dict(version=PLAN_VERSION,
+                min_extrusion=min_extrusion,
+                tool_changes=tool_changes,
+                swaps=sum(1 for change in tool_changes if change.skip is None),
+                problems=problems)
+
+
+def _plan_path(folder, file_hash):
+    return os.path.join(folder, f"{file_hash}.json")
+
+
+def load_swap_plan(folder, file_hash, min_extrusion):
+    """The stored plan of a file, or None when there is none or it was made with other settings."""
+    try:
+        with open(_plan_path(folder, file_hash), "r") as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if plan.get("version") != PLAN_VERSION or plan.get("min_extrusion") != min_extrusion:
+        return None
+    try:
+        plan["tool_changes"] = [ToolChange(*change) for change in plan["tool_changes"]]
+    except (KeyError, TypeError):
+        return None
+    return plan
+
+
+def save_swap_plan(folder, file_hash, plan):
+    os.makedirs(folder, exist_ok=True)
+    path = _plan_path(folder, file_hash)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(plan, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def get_swap_plan(folder, gcode_path, min_extrusion):
+    """
+    Plan of a G-code file, from its sidecar when there is one, otherwise analyzed and stored.
+
+    :return: (plan, file_hash)
+    """
+    file_hash = hash_file(gcode_path)
+    plan = load_swap_plan(folder, file_hash, min_extrusion)
+    if plan is None:
+        with open(gcode_path, "r", encoding="utf-8", errors="replace") as f:
+            plan = analyze_gcode(f, min_extrusion)
+        save_swap_plan(folder, file_hash, plan)
+    return plan, file_hash
+
+
+class SwapPlanCursor:
+    """Position in the plan of the file that is printing, advanced by every tool change queued from the file."""
+
+    def __init__(self, plan):
+        self._tool_changes = plan["tool_changes"]
+        self._index = 0
+        self.in_sync = True
+
+    def next_tool_change(self, tool):
+        """
+        The planned ToolChange for the queued T<tool>.
+        Returns None, and stops following the plan, as soon as the print does something the plan did not expect.
+        """
+        if not self.in_sync:
+            return None
+        if self._index >= len(self._tool_changes) or self._tool_changes[self._index].tool != tool:
+            self.in_sync = False
+            return None
+        change = self._tool_changes[self._index]
+        self._index += 1
+        return change
+
+    def remaining_swaps(self):
+        """Swaps planned after the last queued tool change."""
+        return sum(1 for change in self._tool_changes[self._index:] if change.skip is None)
@@ -0,0 +1,411 @@
+# Octoprint plugin name: Swapper3D, File: swap_recipes.py, Author: BigBrain3D, License: AGPLv3
+# The swap sequences as versioned recipe data, compiled into step programs (see step_scheduler.py) once per
+# settings change instead of building the G-code and command strings on every swap.
+#
+# A recipe is a list of steps, each a dict with one of the keys printer / swapper / delay naming the step:
+#   {"printer": "retract", "gcode": ["G1 E{retractLengthAfterCut} F{retractSpeed}"], "wait_for_motion": True}
+#                                                          or "model", see PrinterStep in step_scheduler.py
+#   {"swapper": "cut", "command": ["cutter_open", "cutter_cut"]}            also "wait_for_ok": False
+#   {"delay": "head_start", "ms": "msDelayAfterExtrude"}                    a setting or a number
+# and optionally:
+#   "after"    steps this one waits for; "@alias" is the step that last took the alias with "as"
+#   "as"       alias this step takes from here on, e.g. the last printer step so printer moves stay in order
+#   "timeout"  seconds, instead of the commandTimeout setting
+#   "when"     [[setting, "==" | "!=" | ">" | "<", value], ...], the step is left out unless all hold
+# {"repeat": "numPaletteCuts", "steps": [...]} repeats its steps as often as the setting says, "{i}" in their names
+# is the repetition; "command_last" replaces "command" in the last repetition.
+#
+# {setting} in G-code and commands is filled in when the recipe is compiled, [name] at run time (values that change
+# every swap, e.g. [next_extruder]).
+#
+# Recipes in the "recipes" folder of the plugin data folder (<name>.json, same format) replace the built-in ones,
+# so the sequences can be tuned for a setup without changing the plugin. A recipe of another version than
+# RECIPE_VERSION, or one that does not compile, is reported and the built-in recipe is used.
+import json
+import os
+import time
+from .step_scheduler import PrinterStep, SwapperStep, DelayStep, check_steps, run_steps
+
+RECIPE_VERSION = 1
+
+UNLOAD_RECIPE = {
+    "name": "unload",
+    "version": RECIPE_VERSION,
+    # the unload failed when one of these failed
+    "required": ["cut", "stow"],
+    "steps": [
+        {"printer": "swap_limits", "as": "printer",
+         "gcode": ["M302 P1 ;allow cold extrusion",
+                   "M203 E{SwapExtruderMaxFeedrate}",
+                   "M201 E{SwapExtruderMaxAcceleration}"]},
+        {"swapper": "connect", "as": "swapper", "command": "unload_connect"},
+
+        # pulldown to locking height, then to cutting height, extruding at the same time
+        # the extrude waits msDelayAfterExtrude after the pulldown started, which gives the Swapper3D a head start
+        {"delay": "head_start_lockingheight", "after": ["@swapper"], "ms": "msDelayAfterExtrude"},
+        {"swapper": "pulldown_lockingheight", "after": ["@swapper"], "as": "swapper",
+         "command": "unload_pulldown_lockingheight{msDelayPerDegreeMovedDuringSwapPulldown}"},
+        {"printer": "extrude_lockingheight", "after": ["@printer", "head_start_lockingheight"], "as": "printer",
+         "gcode": ["G92 E0 ;reset extrusion distance",
+                   "G1 E{extrudeLengthLockingHeight} F{extrudeSpeedPulldown}"]},
+        {"delay": "head_start_cuttingheight", "after": ["@swapper"], "ms": "msDelayAfterExtrude"},
+        {"swapper": "pulldown_cuttingheight", "after": ["@swapper"], "as": "swapper",
+         "command": "unload_pulldown_cuttingheight{msDelayPerDegreeMovedDuringSwapPulldown}"},
+        {"printer": "extrude_cuttingheight", "after": ["@printer", "head_start_cuttingheight"], "as": "printer",
+         "gcode": ["G92 E0 ;reset extrusion distance",
+                   "G1 E{extrudeLengthCuttingHeight} F{extrudeSpeedPulldown}"]},
+
+        # whether it's Palette or MMU it always needs to cut and stow the insert
+        {"swapper": "cut", "after": ["@swapper"], "as": "swapper",
+         "command": ["cutter_open", "unload_deploycutter120", "cutter_cut"]},
+
+        # palette multi cuts, move the tool arm out of the way a little, the open for the first cut goes with it
+        {"swapper": "avoid_bin", "after": ["@swapper"], "as": "swapper",
+         "when": [["filamentSwitcherType", "==", "Palette"], ["numPaletteCuts", ">", 0]],
+         "command": ["unload_AvoidBin", "cutter_open"]},
+        {"swapper": "avoid_bin", "after": ["@swapper"], "as": "swapper",
+         "when": [["filamentSwitcherType", "==", "Palette"], ["numPaletteCuts", "==", 0]],
+         "command": "unload_AvoidBin"},
+        {"repeat": "numPaletteCuts",
+         "when": [["filamentSwitcherType", "==", "Palette"]],
+         "steps": [
+             # the cut follows as soon as the motion model says the extrusion is done
+             {"printer": "palette_extrude{i}", "after": ["@swapper", "@printer"], "as": "printer",
+              "wait_for_motion": "model",
+              "gcode": ["G92 E0 ;reset extrusion distance",
+                        "G1 E{lengthAdditionalCut} F{extrudeSpeedPaletteCuts}"]},
+             # nothing happens on the printer between a cut and the open for the next cut so they are batched
+             {"swapper": "palette_cut{i}", "after": ["palette_extrude{i}"], "as": "swapper",
+              "command": ["cutter_cut", "cutter_open"], "command_last": "cutter_cut"},
+         ]},
+
+        # retract filament, the first move breaks any string connection between insert and main filament strand
+        # the stow waits until the printer reports the retract complete, the cutter opens meanwhile
+        {"printer": "retract", "after": ["@swapper", "@printer"], "wait_for_motion": True,
+         "gcode": ["G92 E0 ;reset extrusion distance",
+                   "G1 E-10 F300",
+                   "G92 E0 ;reset extrusion distance",
+                   "G1 E{retractLengthAfterCut} F{retractSpeed}"]},
+        {"swapper": "open", "after": ["@swapper"], "command": "cutter_open"},
+
+        # the cutter guard is under the hotend until it is stowed, there is concern it could melt, so stow it first
+        {"swapper": "stow", "after": ["retract", "open"],
+         "when": [["filamentSwitcherType", "!=", "Palette"]],
+         "command": ["unload_stowCutter", "unload_stowInsert"]},
+        {"swapper": "stow", "after": ["retract", "open"],
+         "when": [["filamentSwitcherType", "==", "Palette"]],
+         "command": ["unload_stowCutter", "unload_stowInsert", "unload_dumpWaste"]},
+        # set the feedrate and acceleration back to Stock
+        {"printer": "stock_limits", "after": ["retract"],
+         "gcode": ["M302 S170 ;disable cold extrusion",
+                   "M203 E{StockExtruderMaxFeedrate}",
+                   "M201 E{StockExtruderMaxAcceleration}"]},
+        # reset the LCD message to "Ready to Swap!" and Insert "EMPTY"
+        {"swapper": "unloaded_message", "after": ["stow"], "wait_for_ok": False, "command": "unloaded_message"},
+    ],
+}
+
+# move the extruder to a random X over the wiper ([wipe_x]) and deploy the wiper once the motion model says it is there
+WIPE_RECIPE = {
+    "name": "wipe",
+    "version": RECIPE_VERSION,
+    "required": [],
+    "steps": [
+        {"printer": "wipe_move", "when": [["NozzleWipe", "==", True]], "wait_for_motion": "model",
+         "gcode": ["G1 X[wipe_x] F6000"]},
+        {"swapper": "deploy_wiper", "after": ["wipe_move"], "when": [["NozzleWipe", "==", True]],
+         "command": "wiper_deploy"},
+    ],
+}
+
+# change tool, wait for the heat up, prime and wipe; the StowWiper echo stows the wiper and resumes the print
+RESUME_RECIPE = {
+    "name": "resume",
+    "version": RECIPE_VERSION,
+    "required": [],
+    "steps": [
+        {"printer": "resume",
+         "gcode": ["T[next_extruder]",
+                   "M109 S[target_temperature]",  # Wait for heat to stabilize
+                   "M118 E1 [reheat_token]",  # ends the reheat phase of the swap trace
+                   "M117 E1 [reheat_token]",
+                   "G4",
+                   "G92 E0; reset the extruder position",
+                   "G4",
+                   "G1 E{ExtraExtrusionAfterSwap} F300",
+                   "G4",
+                   "G92 E0; reset the extruder position",
+                   "G4",
+                   "G1 E-{RetractionDistanceAfterSwap} F2100",
+                   "G92 E0; reset the extruder position",
+                   "G4",
+                   "G1 X{xPositionAfterWipe} F{yBreakStringSpeed}",  # move extruder off the wipe pad (the actual "wipe")
+                   "G4",
+                   "M118 E1 StowWiper",  # Echo command updated works with i3
+                   "M117 E1 StowWiper"]},  # Echo command updated works with virtual printer
+        # set the LCD display to show the currently loaded insert
+        {"swapper": "insert_number", "after": ["resume"], "command": "InsertNumber[insert_number]"},
+    ],
+}
+
+BUILT_IN_RECIPES = {recipe["name"]: recipe for recipe in (UNLOAD_RECIPE, WIPE_RECIPE, RESUME_RECIPE)}
+
+# the unload for M702 (filament unload, end of print) is the unload recipe in use plus the printer's own filament
+# unload; that only needs the retract done and the stock limits back, so it runs while the Swapper3D stows
+FILAMENT_UNLOAD_STEPS = [
+    {"printer": "filament_unload", "after": ["stock_limits"],
+     "gcode": ["M702 C ;Sent by Swapper3D_utils.unload_filament()"]},
+]
+
+_STEP_KINDS = ("printer", "swapper", "delay")
+
+_CONDITIONS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+}
+
+
+class RecipeError(Exception):
+    pass
+
+
+def _fill_settings(text, settings):
+    try:
+        return text.format_map(settings)
+    except KeyError as e:
+        raise RecipeError(f"unknown setting {e} in '{text}'")
+    except (ValueError, IndexError) as e:
+        raise RecipeError(f"'{text}': {e}")
+
+
+class _StepTemplate:
+    """A compiled step; settings are filled in, only [name] run time values are left."""
+
+    def __init__(self, kind, name, after, timeout, **values):
+        self.kind = kind
+        self.name = name
+        self.after = tuple(after)
+        self.timeout = timeout
+        self.values = values
+        # only the lines with a run time value are formatted again on every swap
+        texts = values.get("gcode") or values.get("command")
+        if isinstance(texts, str):
+            texts = [texts]
+        self.has_run_time_values = any("[" in text for text in texts or ())
+
+    def build(self, run_time_values):
+        values = self.values
+        if self.kind == "delay":
+            return DelayStep(self.name, values["ms"], after=self.after)
+
+        if self.kind == "printer":
+            gcode = values["gcode"]
+            if self.has_run_time_values:
+                gcode = [_fill_run_time_values(line, run_time_values) for line in gcode]
+            return PrinterStep(self.name, gcode, after=self.after, wait_for_motion=values["wait_for_motion"],
+                               timeout=self.timeout)
+
+        command = values["command"]
+        if self.has_run_time_values:
+            if isinstance(command, str):
+                command = _fill_run_time_values(command, run_time_values)
+            else:
+                command = [_fill_run_time_values(part, run_time_values) for part in command]
+        return SwapperStep(self.name, command, after=self.after, wait_for_ok=values["wait_for_ok"],
+                           timeout=self.timeout)
+
+
+def _fill_run_time_values(text, run_time_values):
+    if "[" not in text:
+        return text
+    for name, value in run_time_values.items():
+        text = text.replace(f"[{name}]", str(value))
+    return text
+
+
+class StepProgram:
+    """A compiled recipe, ready to run."""
+
+    def __init__(self, name, version, templates, required):
+        self.name = name
+        self.version = version
+        self._templates = templates
+        self.required = tuple(required)
+        self.timing_hooks = []  # called with (program name, step, seconds, success) when a step is done
+
+    def __len__(self):
+        return len(self._templates)
+
+    def run(self, plugin, **run_time_values):
+        """
+        Run the program, run_time_values fill in the [name] placeholders.
+
+        :return: (success, results) with results the (success, error) of every step by name
+        """
+        steps = [template.build(run_time_values) for template in self._templates]
+        if not steps:
+            return True, {}
+        started_at = time.monotonic()
+        results = run_steps(plugin, steps, on_step_done=self._on_step_done if self.timing_hooks else None)
+        plugin.log.debug("Recipe %s v%s done in %.2f s", self.name, self.version, time.monotonic() - started_at)
+        success = all(results[name][0] for name in self.required if name in results)
+        return success, results
+
+    def _on_step_done(self, step, seconds, success):
+        for hook in self.timing_hooks:
+            hook(self.name, step, seconds, success)
+
+
+def compile_recipe(recipe, settings):
+    """
+    Compile a recipe with the current settings.
+
+    :param settings: SettingsSnapshot
+    :return: StepProgram, raises RecipeError when the recipe cannot be compiled
+    """
+    if recipe.get("version") != RECIPE_VERSION:
+        raise RecipeError(f"version {recipe.get('version')} is not supported, expected {RECIPE_VERSION}")
+    values = {name: getattr(settings, name) for name in type(settings).__slots__}
+
+    templates = []
+    aliases = {}
+    _compile_steps(recipe.get("steps", []), values, templates, aliases, None)
+
+    # check the dependencies once here instead of on every run
+    error = check_steps([DelayStep(template.name, 0, after=template.after) for template in templates])
+    if error is not None:
+        raise RecipeError(error)
+    return StepProgram(recipe.get("name", "?"), recipe["version"], templates, recipe.get("required", []))
+
+
+def _condition_holds(entry, values):
+    for condition in entry.get("when", []):
+        try:
+            setting, operator, expected = condition
+            holds = _CONDITIONS[operator](values[setting], expected)
+        except KeyError as e:
+            raise RecipeError(f"unknown setting or operator {e} in condition {condition}")
+        except (TypeError, ValueError) as e:
+            raise RecipeError(f"condition {condition}: {e}")
+        if not holds:
+            return False
+    return True
+
+
+def _compile_steps(entries, values, templates, aliases, repetition):
+    for entry in entries:
+        if not _condition_holds(entry, values):
+            continue
+
+        if "repeat" in entry:
+            count = values.get(entry["repeat"])
+            if not isinstance(count, int):
+                raise RecipeError(f"repeat '{entry['repeat']}' is not a whole number setting")
+            for index in range(count):
+                _compile_steps(entry.get("steps", []), values, templates, aliases, (index, count))
+            continue
+
+        kinds = [kind for kind in _STEP_KINDS if kind in entry]
+        if len(kinds) != 1:
+            raise RecipeError(f"a step needs exactly one of {_STEP_KINDS}: {entry}")
+        kind = kinds[0]
+        name = _repeat_name(entry[kind], repetition)
+
+        after = []
+        for dependency in entry.get("after", []):
+            if dependency.startswith("@"):
+                if dependency[1:] not in aliases:
+                    raise RecipeError(f"step '{name}' waits for '{dependency}' before any step took that alias")
+                after.append(aliases[dependency[1:]])
+            else:
+                after.append(_repeat_name(dependency, repetition))
+
+        if kind == "printer":
+            wait_for_motion = entry.get("wait_for_motion", False)
+            if wait_for_motion not in (False, True, "model"):
+                raise RecipeError(f"step '{name}': wait_for_motion is true, false or \"model\", not {wait_for_motion!r}")
+            step_values = dict(gcode=[_fill_settings(line, values) for line in entry.get("gcode", [])],
+                               wait_for_motion=wait_for_motion)
+        elif kind == "swapper":
+            command = entry.get("command")
+            if repetition is not None and repetition[0] == repetition[1] - 1 and "command_last" in entry:
+                command = entry["command_last"]
+            if isinstance(command, str):
+                command = _fill_settings(command, values)
+            elif isinstance(command, list) and command:
+                command = [_fill_settings(part, values) for part in command]
+            else:
+                raise RecipeError(f"step '{name}' has no command")
+            step_values = dict(command=command, wait_for_ok=bool(entry.get("wait_for_ok", True)))
+            if not step_values["wait_for_ok"] and isinstance(command, list):
+                raise RecipeError(f"step '{name}' has several commands, they cannot be sent without waiting")
+        else:
+            ms = entry.get("ms", 0)
+            if isinstance(ms, str):
+                if ms not in values:
+                    raise RecipeError(f"unknown setting '{ms}' in step '{name}'")
+                ms = values[ms]
+            step_values = dict(ms=float(ms))
+
+        templates.append(_StepTemplate(kind, name, after, entry.get("timeout"), **step_values))
+        if "as" in entry:
+            aliases[entry["as"]] = name
+
+
+def _repeat_name(name, repetition):
+    return name if repetition is None else name.replace("{i}", str(repetition[0]))
+
+
+def load_recipe_overrides(folder):
+    """:return: (recipes by name, errors) of the recipe files in folder"""
+    recipes = {}
+    errors = []
+    if folder is None or not os.path.isdir(folder):
+        return recipes, errors
+    for name in BUILT_IN_RECIPES:
+        path = os.path.join(folder, f"{name}.json")
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "r") as f:
+                recipe = json.load(f)
+        except (OSError, ValueError) as e:
+            errors.append(f"{path}: {e}")
+            continue
+        recipe.setdefault("name", name)
+        recipes[name] = recipe
+    return recipes, errors
+
+
+def compile_recipes(settings, folder=None):
+    """
+    Compile every recipe, the ones in folder replace the built-in ones.
+
+    :return: (programs by name, errors)
+    """
+    overrides, errors = load_recipe_overrides(folder)
+    programs = {}
+    used = {}
+    for name, built_in in BUILT_IN_RECIPES.items():
+        recipe = overrides.get(name)
+        if recipe is not None:
+            try:
+                programs[name] = compile_recipe(recipe, settings)
+                used[name] = recipe
+                continue
+            except RecipeError as e:
+                errors.append(f"recipe '{name}' from {folder}: {e}, using the built-in recipe")
+        programs[name] = compile_recipe(built_in, settings)
+        used[name] = built_in
+
+    for unload in (used["unload"], UNLOAD_RECIPE):
+        recipe = dict(unload, name="unload_filament", steps=unload.get("steps", []) + FILAMENT_UNLOAD_STEPS)
+        try:
+            programs["unload_filament"] = compile_recipe(recipe, settings)
+            break
+        except RecipeError as e:
+            errors.append(f"recipe 'unload_filament' from the unload recipe in {folder}: {e}, "
+                          f"using the built-in recipe")
+    return programs, errors
@@ -0,0 +1,129 @@
+# Octoprint plugin name: Swapper3D, File: swap_time_estimator.py, Author: BigBrain3D, License: AGPLv3
+# Print time estimate that knows about swaps.
+# OctoPrint estimates the time left from the G-code analysis and the progress so far, neither of which knows that
+# every swap stops the printer for a minute or two. With hundreds of swaps the estimate is hours off.
+#
+# SwapCostModel keeps the duration of each phase of a swap, the phases of swap_trace.py:
+#   drain, travel (PreparePrinterForSwap), unload, load, wipe, reheat, resume
+# The swap tracer records the phases, every traced swap updates them here (exponential moving average), the model
+# is saved in the plugin data folder.
+#
+# SwapAwarePrintTimeEstimator is handed to OctoPrint through the octoprint.printer.estimation.factory hook.
+# It takes the time spent swapping out of the elapsed print time before OctoPrint's own estimate is made, then adds
+# the swaps still to come (from the swap plan of the file, see swap_plan.py) and what is left of a running swap.
+import json
+import os
+import threading
+from octoprint.printer.estimation import PrintTimeEstimator
+
+# seconds, until the first swaps have been measured
+DEFAULT_PHASE_TIMES = {
+    "drain": 3.0,
+    "travel": 12.0,
+    "unload": 35.0,
+    "load": 20.0,
+    "wipe": 5.0,
+    "reheat": 15.0,
+    "resume": 10.0,
+}
+LEARNING_RATE = 0.2  # weight of the newest measurement
+
+
+class SwapCostModel:
+    def __init__(self, path=None):
+        self.path = path
+        self.phase_times = dict(DEFAULT_PHASE_TIMES)
+        self.measured_swaps = 0
+        self._lock = threading.Lock()
+
+        # time spent swapping in the running print, taken out of the elapsed print time for OctoPrint's estimate
+        self.print_swap_time = 0.0
+
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        for phase, seconds in stored.get("phase_times", {}).items():
+            if phase in self.phase_times and isinstance(seconds, (int, float)) and seconds >= 0:
+                self.phase_times[phase] = float(seconds)
+        self.measured_swaps = int(stored.get("measured_swaps", 0))
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            stored = dict(phase_times=self.phase_times, measured_swaps=self.measured_swaps)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(stored, f)
+        os.replace(temp_path, self.path)
+
+    def swap_cost(self, with_unload=True):
+        """Expected seconds of one swap."""
+        total = sum(self.phase_times.values())
+        if not with_unload:
+            total -= self.phase_times["unload"]
+        return total
+
+    def begin_print(self):
+        with self._lock:
+            self.print_swap_time = 0.0
+
+    def add_swap(self, phases, duration):
+        """A swap traced by SwapTracer, see SwapTracer.swap_listeners."""
+        with self._lock:
+            self.print_swap_time += duration
+            for phase, seconds in phases.items():
+                if phase in self.phase_times:
+                    self.phase_times[phase] += LEARNING_RATE * (seconds - self.phase_times[phase])
+            self.measured_swaps += 1
+
+
+def create_estimator_factory(plugin):
+    """Factory for the octoprint.printer.estimation.factory hook."""
+    def factory(job_type):
+        return SwapAwarePrintTimeEstimator(job_type, plugin)
+    return factory
+
+
+class SwapAwarePrintTimeEstimator(PrintTimeEstimator):
+    def __init__(self, job_type, plugin):
+        PrintTimeEstimator.__init__(self, job_type)
+        self._plugin = plugin
+
+    def estimate(self, progress, printTime, cleanedTime, statisticalTotalPrintTime, statisticalTotalPrintTimeType):
+        model = self._plugin.swap_cost_model
+        if model is None:
+            return PrintTimeEstimator.estimate(self, progress, printTime, cleanedTime,
+                                               statisticalTotalPrintTime, statisticalTotalPrintTimeType)
+
+        # OctoPrint's estimate without the time spent swapping, which it would otherwise spread over the whole print
+        running = self._plugin.swap_tracer.running_swap_time()
+        swap_time = model.print_swap_time + running
+        if printTime is not None:
+            printTime = max(0.0, printTime - swap_time)
+        if cleanedTime is not None:
+            cleanedTime = max(0.0, cleanedTime - swap_time)
+        time_left, origin = PrintTimeEstimator.estimate(self, progress, printTime, cleanedTime,
+                                                        statisticalTotalPrintTime, statisticalTotalPrintTimeType)
+        if time_left is None:
+            return time_left, origin
+
+        cost = model.swap_cost()
+        cursor = self._plugin.swap_plan_cursor
+        if cursor is not None and cursor.in_sync:
+            swaps_left = cursor.remaining_swaps()
+        else:
+            plan_swaps = self._plugin.swap_plan_swaps
+            swaps_left = int(round(plan_swaps * (1.0 - (progress or 0.0)))) if plan_swaps else 0
+
+        time_left += swaps_left * cost
+        if running:
+            time_left += max(0.0, cost - running)
+        return time_left, origin
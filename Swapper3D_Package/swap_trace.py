@@ -0,0 +1,124 @@
+# Octoprint plugin name: Swapper3D, File: swap_trace.py, Author: BigBrain3D, License: AGPLv3
+# Where the time of a swap goes.
+# Every swap is traced from the intercepted T command until the print resumes:
+#   phases   drain    until the printer has finished the moves queued before the T (echo before the travel)
+#            travel   PreparePrinterForSwap travel, until the readyForSwap echo
+#            unload, load
+#            wipe     move over the wiper and deploy it
+#            reheat   tool change and M109, until the echo after the M109
+#            resume   prime, wipe and wiper stow, until the print resumes
+#   spans    every step of the swap recipes (e.g. "unload.retract") and every Swapper3D command
+#            (e.g. "command:cutter_cut", insert numbers and angles are left out of the name)
+# A phase whose mark is missing (e.g. with NozzleWipe off the print resumes before the M109 echo) is part of the
+# next phase.
+# A swap that stops halfway (failed unload or load) ends with its error, its time is kept apart as "swap:failed".
+# The last MAX_SWAPS swaps are kept in memory; GET /plugin/Swapper3D/trace returns them with p50/p95/p99 of every
+# phase and span over those swaps, so a swap that got slower shows which part grew.
+# The phases are only recorded here; swap_listeners (the swap cost model) get every swap that completed.
+import bisect
+import threading
+import time
+from collections import deque
+
+MAX_SWAPS = 200
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))  # ceil without floats
+    return sorted_values[int(rank) - 1]
+
+
+def command_span_name(command):
+    # load_insert3, InsertNumber4, unload_pulldown_lockingheight6 -> one span for all of them
+    return "command:" + command.rstrip("0123456789")
+
+
+class SwapTracer:
+    def __init__(self, max_swaps=MAX_SWAPS):
+        self._lock = threading.Lock()
+        self._swaps = deque(maxlen=max_swaps)
+        self._current = None
+        self._last_mark = None
+        self.swap_listeners = []  # called with (phases, duration) when a swap is done
+
+    def begin_swap(self, tool):
+        with self._lock:
+            now = time.monotonic()
+            self._current = dict(tool=tool, started=time.time(), duration=None, error=None, phases={}, spans=[],
+                                 _started_at=now)
+            self._last_mark = now
+
+    def mark(self, phase):
+        """The phase of the running swap that ends now."""
+        with self._lock:
+            if self._current is None:
+                return
+            now = time.monotonic()
+            self._current["phases"][phase] = now - self._last_mark
+            self._last_mark = now
+
+    def record(self, name, seconds):
+        """A span of the running swap, ignored when no swap is running."""
+        with self._lock:
+            if self._current is not None:
+                self._current["spans"].append((name, seconds))
+
+    def on_step_done(self, program_name, step, seconds, success):
+        """Timing hook of the swap recipes, see StepProgram.timing_hooks."""
+        self.record(f"{program_name}.{step.name}", seconds)
+
+    def end_swap(self, error=None):
+        """
+        The print resumed, or with error the swap stopped halfway.
+        Returns the duration of the swap, None when no swap was running.
+        """
+        if error is None:
+            self.mark("resume")
+        with self._lock:
+            swap = self._current
+            if swap is None:
+                return None
+            swap["duration"] = time.monotonic() - swap.pop("_started_at")
+            swap["error"] = error
+            self._swaps.append(swap)
+            self._current = None
+            self._last_mark = None
+        if error is not None:
+            return swap["duration"]
+        for listener in self.swap_listeners:
+            listener(dict(swap["phases"]), swap["duration"])
+        return swap["duration"]
+
+    def running_swap_time(self):
+        """Seconds the running swap has taken so far, 0 when no swap is running."""
+        with self._lock:
+            return 0.0 if self._current is None else time.monotonic() - self._current["_started_at"]
+
+    def summary(self):
+        """The kept swaps and the percentiles of their phases and spans, as JSON-ready dict."""
+        with self._lock:
+            swaps = list(self._swaps)
+
+        durations = {"swap": [], "swap:failed": []}
+        for swap in swaps:
+            bisect.insort(durations["swap" if swap["error"] is None else "swap:failed"], swap["duration"])
+            for name, seconds in swap["phases"].items():
+                bisect.insort(durations.setdefault(f"phase:{name}", []), seconds)
+            for name, seconds in swap["spans"]:
+                bisect.insort(durations.setdefault(name, []), seconds)
+
+        statistics = {}
+        for name, values in durations.items():
+            if not values:
+                continue
+            entry = dict(count=len(values), max=values[-1])
+            for percent in PERCENTILES:
+                entry[f"p{percent}"] = percentile(values, percent)
+            statistics[name] = entry
+
+        return dict(swaps=[dict(swap, spans=[list(span) for span in swap["spans"]]) for swap in swaps],
+                    statistics=statistics)
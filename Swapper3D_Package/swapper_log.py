@@ -0,0 +1,56 @@
+# Octoprint plugin name: Swapper3D, File: swapper_log.py, Author: BigBrain3D, License: AGPLv3
+# Leveled log of the plugin, shown in the Swapper3D tab and written to octoprint.log.
+# Messages take %-style arguments, like the logging module, and are only formatted when their level is enabled:
+#
+#   plugin.log.debug("queue.Next extruder: %s", plugin.next_extruder)  # costs one comparison unless logLevel is DEBUG
+#
+# The level is the logLevel setting (DEBUG, INFO, WARNING, ERROR), changeable at runtime on the settings page.
+# WARNING is the default, so a swap formats and writes nothing unless something went wrong; INFO adds what the
+# Swapper3D is doing and why, DEBUG the step by step traces that are only needed when a swap goes wrong.
+import logging
+
+LOG_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+DEFAULT_LOG_LEVEL = "WARNING"
+
+
+class SwapperLog:
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self.level = LOG_LEVELS[DEFAULT_LOG_LEVEL]
+
+    def update_level(self):
+        """Take the logLevel setting from the settings snapshot; called whenever the snapshot is rebuilt."""
+        name = str(self._plugin.settings_snapshot.logLevel or DEFAULT_LOG_LEVEL).upper()
+        self.level = LOG_LEVELS.get(name, LOG_LEVELS[DEFAULT_LOG_LEVEL])
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def debug(self, message, *args):
+        if self.level <= logging.DEBUG:
+            self._emit(logging.DEBUG, message, args)
+
+    def info(self, message, *args):
+        if self.level <= logging.INFO:
+            self._emit(logging.INFO, message, args)
+
+    def warning(self, message, *args):
+        if self.level <= logging.WARNING:
+            self._emit(logging.WARNING, message, args)
+
+    def error(self, message, *args):
+        self._emit(logging.ERROR, message, args)
+
+    def _emit(self, level, message, args):
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError) as e:
+                message = f"{message} {args!r} (log format error: {e})"
+        self._plugin._logger.log(level, message)
+        self._plugin.message_channel.send_plugin_message(self._plugin._identifier, dict(type="log", message=message))
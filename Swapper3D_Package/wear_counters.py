@@ -0,0 +1,155 @@
+# Octoprint plugin name: Swapper3D, File: wear_counters.py, Author: BigBrain3D, License: AGPLv3
+# Swap and actuation counters of the Swapper3D, to plan maintenance (servos, cutter blade, wiper).
+# The counters are kept in memory and counted when the Swapper3D acks a command (commands sent without waiting for
+# their ok are counted when the serial engine swallows the ok, see swallowed_ack_listeners), the swap itself never touches the
+# disk: a flusher thread writes wear_counters.json in the plugin data folder every FLUSH_INTERVAL seconds when
+# something changed, and once more at shutdown. A crash loses at most FLUSH_INTERVAL seconds of counts.
+# GET /plugin/Swapper3D/counters returns them, the Statistics of the settings page show them read-only.
+#
+# Counters (the names of the Statistics settings, which seed the store the first time it is created):
+#   totalNumberSwaps  completed swaps, including the initial load
+#   actuations        Swapper3D commands that move something
+#   TR TH TL QL HR CR CA WA   moves of each axis, see AXES_OF_COMMAND
+#   commands          acks per command, insert numbers and angles are left out (load_insert3 -> load_insert)
+import json
+import os
+import threading
+import time
+
+FLUSH_INTERVAL = 60  # seconds
+COUNTER_KEYS = ("totalNumberSwaps", "actuations", "TR", "TH", "TL", "QL", "HR", "CR", "CA", "WA")
+
+# axes a command moves, matched by prefix like the simulator's command times; the longest prefix wins
+# commands that are not listed (handshake, firmware version, messages) are not actuations
+# no command of this firmware is mapped to HR yet, it stays at its seeded value
+AXES_OF_COMMAND = {
+    "load_insert": ("TR", "TH", "TL", "QL"),
+    "hometoolrotate": ("TR",),
+    "unload_connect": ("TL", "QL"),
+    "unload_pulldown_lockingheight": ("TH",),
+    "unload_pulldown_cuttingheight": ("TH",),
+    "unload_deploycutter": ("CR",),
+    "unload_AvoidBin": ("CR",),
+    "unload_stowCutter": ("CR",),
+    "unload_stowInsert": ("TR", "TH"),
+    "unload_dumpWaste": ("TR",),
+    "cutter_open": ("CA",),
+    "cutter_cut": ("CA",),
+    "wiper_deploy": ("WA",),
+    "wiper_stow": ("WA",),
+    "borealignon": ("TH",),
+    "borealignoff": ("TH",),
+}
+_PREFIXES = sorted(AXES_OF_COMMAND, key=len, reverse=True)
+
+
+def axes_of(command):
+    for prefix in _PREFIXES:
+        if command.startswith(prefix):
+            return prefix, AXES_OF_COMMAND[prefix]
+    return None, ()
+
+
+class WearCounters:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self.counters = {key: 0 for key in COUNTER_KEYS}
+        self.commands = {}
+        self.saved_at = None
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self, seed=None):
+        """
+        Read the stored counters. When there is no store yet, start from seed (the Statistics settings).
+
+        :return: True when the store was read
+        """
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = None
+        with self._lock:
+            if stored is None:
+                for key in COUNTER_KEYS:
+                    value = (seed or {}).get(key)
+                    if isinstance(value, int) and value >= 0:
+                        self.counters[key] = value
+                self._dirty = seed is not None
+                return False
+            for key, value in stored.get("counters", {}).items():
+                if key in self.counters and isinstance(value, int) and value >= 0:
+                    self.counters[key] = value
+            self.commands = {name: count for name, count in stored.get("commands", {}).items()
+                             if isinstance(count, int) and count >= 0}
+            self.saved_at = stored.get("saved_at")
+        return True
+
+    def count_command(self, command):
+        """A command the Swapper3D acked."""
+        prefix, axes = axes_of(command)
+        if prefix is None:
+            return
+        with self._lock:
+            self.commands[prefix] = self.commands.get(prefix, 0) + 1
+            self.counters["actuations"] += 1
+            for axis in axes:
+                self.counters[axis] += 1
+            self._dirty = True
+
+    def count_swap(self):
+        with self._lock:
+            self.counters["totalNumberSwaps"] += 1
+            self._dirty = True
+
+    def snapshot(self):
+        """The counters as JSON-ready dict."""
+        with self._lock:
+            return dict(counters=dict(self.counters), commands=dict(self.commands), saved_at=self.saved_at)
+
+    def save(self):
+        """Write the counters if they changed since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self.saved_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            stored = dict(counters=dict(self.counters), commands=dict(self.commands), saved_at=self.saved_at)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(stored, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError:
+            with self._lock:
+                self._dirty = True  # try again with the next flush
+            raise
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._flush_loop, name="Swapper3D-counters", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and save what is left, called at shutdown."""
+        self._stop.set()
+        thread = self._thread
+        self._thread = None
+        if thread is not None:
+            thread.join(timeout=5)
+        self.save()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.save()
+            except OSError:
+                pass
@@ -0,0 +1,151 @@
+# Octoprint plugin name: Swapper3D, File: stand_ins.py, Author: BigBrain3D, License: AGPLv3
+# Stand-ins for the parts of OctoPrint the plugin talks to, so a whole swap can run without a printer:
+#   StandInPrinter        plugin._printer; every command is stripped of its comment and goes through the plugin's
+#                         queuing hook like in OctoPrint's comm layer, then a printer thread executes it in order,
+#                         taking the time the motion model gives for moves (and reheat_time for M109), and sends
+#                         M118 echoes back to on_gcode_received
+#   StandInComm           the comm_instance handed to the hooks
+#   StandInSettings       plugin._settings, backed by a dict
+#   StandInPluginManager  plugin._plugin_manager, counts the messages sent to the browser
+# The Swapper3D itself is Swapper3D_Package.simulator on a pseudo-terminal.
+import queue
+import threading
+import time
+from Swapper3D_Package.printer_state import PrinterStateTracker
+
+
+class StandInComm:
+    def __init__(self):
+        self.printing = True
+
+    def isOperational(self):
+        return True
+
+    def isPrinting(self):
+        return self.printing
+
+
+class StandInSettings:
+    def __init__(self, values):
+        self.values = dict(values)
+
+    def get(self, path, **kwargs):
+        return self.values.get(path[0])
+
+    def get_int(self, path, **kwargs):
+        return int(self.values.get(path[0]))
+
+    def get_float(self, path, **kwargs):
+        return float(self.values.get(path[0]))
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.values.get(path[0]))
+
+    def set(self, path, value, **kwargs):
+        self.values[path[0]] = value
+
+    def save(self, **kwargs):
+        pass
+
+
+class StandInPluginManager:
+    def __init__(self):
+        self.messages_sent = 0
+
+    def send_plugin_message(self, identifier, data):
+        self.messages_sent += 1
+
+
+def process_gcode_line(line):
+    """The line without its comment and surrounding whitespace, None when nothing is left; like OctoPrint's process_gcode_line."""
+    line = line.split(";", 1)[0].strip()
+    return line or None
+
+
+def gcode_of(command):
+    """The command as OctoPrint parses it for the hooks: "G1", "M104", "T" (for T0..Tn)."""
+    token = command.split(" ", 1)[0]
+    if token[:1] in ("T", "F") and token[1:].isdigit():
+        return token[:1]
+    return token
+
+
+class StandInPrinter:
+    def __init__(self, plugin, comm, time_scale=1.0, reheat_time=5.0, echo_m117=False):
+        """
+        :param time_scale: factor on the modeled motion and reheat times, e.g. 0.1 for a ten times faster printer
+        :param reheat_time: seconds an M109 waits
+        :param echo_m117: also echo M117 messages, like printers that report both M117 and M118
+        """
+        self._plugin = plugin
+        self._comm = comm
+        self.time_scale = time_scale
+        self.reheat_time = reheat_time
+        self.echo_m117 = echo_m117
+        self.state = PrinterStateTracker()  # what the printer has executed, the plugin has its own streamed state
+        self.commands_executed = 0
+        self._queue = queue.Queue()
+        self._updates = {
+            "G0": self.state.on_move, "G1": self.state.on_move, "G2": self.state.on_move, "G3": self.state.on_move,
+            "G28": self.state.on_home,
+            "G90": self.state.on_absolute, "G91": self.state.on_relative, "G92": self.state.on_set_position,
+            "M82": self.state.on_e_absolute, "M83": self.state.on_e_relative,
+        }
+        self._thread = threading.Thread(target=self._execute_loop, name="StandInPrinter", daemon=True)
+        self._thread.start()
+
+    def is_operational(self):
+        return True
+
+    def get_current_data(self):
+        return {"currentZ": self.state.z}
+
+    def commands(self, commands, tags=None, force=False):
+        if isinstance(commands, str):
+            commands = [commands]
+        for command in commands:
+            command = process_gcode_line(command)
+            if command is None:
+                continue
+            # @pause/@resume are handled by OctoPrint itself, they never reach the printer
+            if command.startswith("@"):
+                continue
+            gcode = gcode_of(command)
+            result = self._plugin.hook_gcode_queuing(self._comm, "queuing", command, None, gcode)
+            # same contract as OctoPrint: None keeps the command, (None,) drops it, a string replaces it
+            if isinstance(result, tuple):
+                if result[0] is None:
+                    continue
+                command = result[0]
+            elif isinstance(result, str):
+                command = result
+            self._queue.put(command)
+
+    def wait_until_idle(self):
+        self._queue.join()
+
+    def _execute_loop(self):
+        while True:
+            command = self._queue.get()
+            try:
+                self._execute(command)
+            finally:
+                self.commands_executed += 1
+                self._queue.task_done()
+
+    def _execute(self, command):
+        gcode = gcode_of(command)
+        if gcode in ("G0", "G1", "G4"):
+            seconds = self._plugin.motion_model.block_time([command], self.state)
+            time.sleep(seconds * self.time_scale)
+        elif gcode == "M109":
+            time.sleep(self.reheat_time * self.time_scale)
+        elif gcode == "M118" or (gcode == "M117" and self.echo_m117):
+            message = command.split(" ", 1)[1] if " " in command else ""
+            if message.startswith("E1 "):
+                message = message[3:]
+            self._plugin.on_gcode_received(self._comm, f"echo:{message}")
+
+        update = self._updates.get(gcode)
+        if update is not None:
+            update(command)
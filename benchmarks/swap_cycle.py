@@ -0,0 +1,196 @@
+# Octoprint plugin name: Swapper3D, File: swap_cycle.py, Author: BigBrain3D, License: AGPLv3
+# End-to-end benchmark of the swap cycle:
+#   T command queued -> hook_gcode_queuing -> PreparePrinterForSwap -> readyForSwap echo -> on_gcode_received
+#   -> swap (unload, load, wipe) -> StowWiper echo -> print resumed
+# The plugin runs against StandInPrinter (see stand_ins.py) and the Swapper3D simulator. For every swap it measures
+# the wall time until the print resumes, the CPU time of the process (plugin, stand-in printer and simulator),
+# the highest number of threads and the bytes on the Swapper3D serial link, and writes them as JSON so runs of
+# different versions can be compared.
+#
+# Needs the plugin's requirements (OctoPrint, pyserial) installed; Linux, for the simulator's pseudo-terminal.
+#
+#   python -m benchmarks.swap_cycle --swaps 20 --time-scale 0.05 --output swap_cycle.json
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from Swapper3D_Package import Swapper3DPlugin
+from Swapper3D_Package.default_settings import get_default_settings
+from Swapper3D_Package.motion_model import MotionClock
+from Swapper3D_Package.simulator import Swapper3DSimulator
+from Swapper3D_Package.Swapper3D_utils import connect_swapper
+from .stand_ins import StandInComm, StandInPluginManager, StandInPrinter, StandInSettings
+
+RESULT_FORMAT = 1
+EXTRUSION_BETWEEN_SWAPS = "G1 X120 Y120 E25 F1800"  # more than MinExtrusionBeforeSwap
+
+
+def get_plugin_version():
+    setup_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "setup.py")
+    try:
+        with open(setup_path, "r") as f:
+            match = re.search(r'^plugin_version = "([^"]+)"', f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+def create_plugin(data_folder, settings, time_scale, reheat_time, echo_m117):
+    plugin = Swapper3DPlugin()
+    plugin._identifier = "Swapper3D"
+    plugin._logger = logging.getLogger("benchmark.Swapper3D")
+    plugin._plugin_manager = StandInPluginManager()
+    plugin._settings = StandInSettings(settings)
+    plugin._data_folder = data_folder
+    comm = StandInComm()
+    plugin._printer = StandInPrinter(plugin, comm, time_scale=time_scale, reheat_time=reheat_time,
+                                     echo_m117=echo_m117)
+    # the moves the plugin waits for without an echo take as long as on the stand-in printer
+    plugin.motion_clock = MotionClock(time_scale=time_scale)
+    plugin.initialize()
+    return plugin, comm
+
+
+class ThreadSampler:
+    """Highest threading.active_count() while it runs."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.max_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ThreadSampler", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.max_threads = max(self.max_threads, threading.active_count())
+            self._stop.wait(self.interval)
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.002)
+    return True
+
+
+def run_swap(plugin, simulator, tool, idle_threads, timeout):
+    printer = plugin._printer
+    printer.commands(["M83", EXTRUSION_BETWEEN_SWAPS])
+    printer.wait_until_idle()
+    # the threads of the previous swap (wiper stow, ToolRotate homing) are done before the next one is measured
+    wait_for(lambda: threading.active_count() <= idle_threads, timeout)
+
+    unload = bool(plugin.insertLoaded)
+    bytes_sent, bytes_received = simulator.bytes_received, simulator.bytes_sent
+    wall_started, cpu_started = time.perf_counter(), time.process_time()
+    with ThreadSampler() as sampler:
+        printer.commands([f"T{tool}"])
+        started = plugin.SwapInProcess
+        completed = started and wait_for(lambda: not plugin.SwapInProcess, timeout)
+    wall_time, cpu_time = time.perf_counter() - wall_started, time.process_time() - cpu_started
+
+    return dict(tool=tool,
+                unload=unload,
+                completed=completed,
+                wall_time=wall_time,
+                cpu_time=cpu_time,
+                max_threads=sampler.max_threads,
+                serial_bytes_sent=simulator.bytes_received - bytes_sent,
+                serial_bytes_received=simulator.bytes_sent - bytes_received)
+
+
+def summarize(swaps):
+    measured = [swap for swap in swaps if swap["completed"] and swap["unload"]]
+    summary = dict(swaps=len(swaps), completed=sum(1 for swap in swaps if swap["completed"]))
+    for key in ("wall_time", "cpu_time", "max_threads", "serial_bytes_sent", "serial_bytes_received"):
+        values = [swap[key] for swap in measured]
+        if values:
+            summary[key] = dict(mean=statistics.mean(values), median=statistics.median(values),
+                                min=min(values), max=max(values))
+    return summary
+
+
+def run_benchmark(args):
+    settings = get_default_settings()
+    settings.update(filamentSwitcherType=args.switcher, NozzleWipe=int(args.wipe),
+                    numPaletteCuts=str(args.palette_cuts), logLevel=args.log_level)
+
+    with tempfile.TemporaryDirectory(prefix="swapper3d-benchmark-") as data_folder, \
+            Swapper3DSimulator(time_scale=args.time_scale, seed=args.seed) as simulator:
+        plugin, comm = create_plugin(data_folder, settings, args.time_scale, args.reheat_time, args.echo_m117)
+        if not connect_swapper(plugin, [simulator.port]):
+            raise SystemExit(f"Could not connect to the simulator on {simulator.port}")
+
+        idle_threads = threading.active_count()
+        swaps = []
+        # the first swap is the initial load, without an unload; it is reported but not in the summary
+        for index in range(args.swaps + 1):
+            tool = index % args.tools
+            swap = run_swap(plugin, simulator, tool, idle_threads, args.timeout)
+            swap["index"] = index
+            swaps.append(swap)
+            print(f"swap {index} T{tool}: {swap['wall_time']:.3f}s wall, {swap['cpu_time']:.3f}s cpu, "
+                  f"{swap['max_threads']} threads, {swap['serial_bytes_sent']}/{swap['serial_bytes_received']} "
+                  f"bytes{'' if swap['completed'] else ' NOT COMPLETED'}", file=sys.stderr)
+            if not swap["completed"]:
+                break
+
+        plugin.message_channel.stop()
+        plugin.link_watchdog.stop()
+
+    return dict(benchmark="swap_cycle",
+                format=RESULT_FORMAT,
+                plugin_version=get_plugin_version(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                created=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                options=vars(args),
+                summary=summarize(swaps),
+                swaps=swaps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end swap cycle benchmark of the Swapper3D plugin")
+    parser.add_argument("--swaps", type=int, default=10, help="swaps after the initial load")
+    parser.add_argument("--tools", type=int, default=4, help="tools T0..Tn-1 are swapped in turn")
+    parser.add_argument("--time-scale", type=float, default=0.05,
+                        help="factor on the Swapper3D command times and the printer motion, 1.0 is real time")
+    parser.add_argument("--reheat-time", type=float, default=5.0, help="seconds an M109 takes at time scale 1")
+    parser.add_argument("--switcher", default="MMU", help="filamentSwitcherType setting: MMU, Palette or None")
+    parser.add_argument("--palette-cuts", type=int, default=3)
+    parser.add_argument("--no-wipe", dest="wipe", action="store_false", help="NozzleWipe off")
+    parser.add_argument("--echo-m117", action="store_true", help="the printer echoes M117 as well as M118")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds a swap may take")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="JSON result file, default stdout")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Octoprint plugin name: Swapper3D, File: test_frame_codec.py, Author: BigBrain3D, License: AGPLv3
+from Swapper3D_Package.frame_codec import FrameReader, decode_frame, encode_frame, parity_bit
+
+
+def counted_parity(message):
+    # the firmware's definition: 1 for an even number of set bits
+    return 1 if sum(bin(ord(c)).count("1") for c in message) % 2 == 0 else 0
+
+
+def test_parity_matches_the_firmware_definition():
+    for message in ("", "octoprint", "cutter_open", "load_insert24", "unload_deploycutter120", "\x7f\x01"):
+        assert parity_bit(message.encode("latin-1")) == counted_parity(message)
+
+
+def test_encode_appends_parity_digit_and_newline():
+    frame = encode_frame("cutter_open")
+    assert frame == b"cutter_open" + str(counted_parity("cutter_open")).encode() + b"\n"
+
+
+def test_decode_round_trip():
+    for command in ("octoprint_ok", "hometoolrotate_ok", "1", "load_insert3_ok"):
+        assert decode_frame(encode_frame(command)[:-1]) == (True, command)
+
+
+def test_decode_rejects_wrong_parity_and_garbage():
+    frame = encode_frame("cutter_cut_ok")[:-1]
+    flipped = frame[:-1] + (b"0" if frame[-1:] == b"1" else b"1")
+    assert decode_frame(flipped) == (False, None)
+    assert decode_frame(b"cutter_cut_okX") == (False, None)
+    assert decode_frame(b"1") == (False, None)
+    assert decode_frame(b"") == (False, None)
+
+
+def test_reader_splits_frames_across_reads():
+    reader = FrameReader()
+    assert reader.feed(b"octo") == []
+    assert reader.feed(b"print_ok1\r\nwiper_") == [b"octoprint_ok1"]
+    assert reader.feed(b"stow_ok0\n\n") == [b"wiper_stow_ok0"]
+
+
+def test_reader_drops_line_noise_without_newline():
+    reader = FrameReader(max_frame_length=16)
+    assert reader.feed(b"x" * 32) == []
+    assert reader.feed(b"ok1\n") == [b"ok1"]
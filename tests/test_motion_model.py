@@ -0,0 +1,88 @@
+# Octoprint plugin name: Swapper3D, File: test_motion_model.py, Author: BigBrain3D, License: AGPLv3
+from types import SimpleNamespace
+import pytest
+from Swapper3D_Package.motion_model import MotionClock, MotionModel, move_time
+from Swapper3D_Package.printer_state import PrinterStateTracker
+
+SETTINGS = SimpleNamespace(PrinterMaxFeedrateZ=12.0, PrinterMaxAcceleration=1000,
+                           SwapExtruderMaxFeedrate=500.0, SwapExtruderMaxAcceleration=15000,
+                           StockExtruderMaxFeedrate=120.0, StockExtruderMaxAcceleration=5000)
+
+
+def homed_state():
+    state = PrinterStateTracker()
+    state.on_home("G28")
+    return state
+
+
+def test_move_time_trapezoid():
+    # 100 mm at 50 mm/s with 1000 mm/s2: 2.5 mm ramps on both ends, 2 s cruise + 0.05 s extra
+    assert move_time(100, 50, 1000) == pytest.approx(2.05)
+
+
+def test_move_time_triangle_when_feedrate_is_not_reached():
+    assert move_time(1, 100, 1000) == pytest.approx(2 * (1 / 1000) ** 0.5)
+
+
+def test_move_time_edge_cases():
+    assert move_time(0, 50, 1000) == 0.0
+    assert move_time(10, 0, 1000) == 0.0
+    assert move_time(-10, 10, 0) == 1.0
+
+
+def test_block_time_xy_move_and_dwell():
+    model = MotionModel(SETTINGS)
+    seconds = model.block_time(["G1 X100 F3000", "G4 P500", "G4 S1"], homed_state())
+    assert seconds == pytest.approx(2.05 + 1.5)
+
+
+def test_z_is_limited_to_its_max_feedrate():
+    model = MotionModel(SETTINGS)
+    seconds = model.block_time(["G1 Z12 F6000"], homed_state())
+    assert seconds == pytest.approx(move_time(12, 12, 1000))
+
+
+def test_relative_extrusion_uses_the_swap_limits_and_block_limits():
+    state = homed_state()
+    state.on_e_relative("M83")
+    swap = MotionModel(SETTINGS)
+    assert swap.block_time(["G1 E-70 F60000"], state) == pytest.approx(move_time(70, 500, 15000))
+    # a lower M203 E in the block slows the following moves down, the model itself is not changed
+    slowed = swap.block_time(["M203 E50", "G1 E-70 F60000"], state)
+    assert slowed == pytest.approx(move_time(70, 50, 15000))
+    assert swap.max_feedrate["E"] == 500.0
+
+    stock = MotionModel(SETTINGS, swap_limits=False)
+    assert stock.block_time(["G1 E-70 F60000"], state) == pytest.approx(move_time(70, 120, 5000))
+
+
+def test_absolute_positions_and_g92_in_the_block():
+    model = MotionModel(SETTINGS)
+    state = homed_state()
+    seconds = model.block_time(["G1 X50 F3000", "G92 X0", "G1 X50"], state)
+    assert seconds == pytest.approx(2 * move_time(50, 50, 1000))
+    assert state.x == 0.0  # the state before the block is not changed
+
+
+def test_g91_block_moves_relative():
+    model = MotionModel(SETTINGS)
+    state = homed_state()
+    state.on_move("G1 X100")
+    seconds = model.block_time(["G91", "G1 X-10 F600", "G1 X-10", "G90"], state)
+    assert seconds == pytest.approx(2 * move_time(10, 10, 1000))
+
+
+def test_axis_that_was_never_set_does_not_move():
+    model = MotionModel(SETTINGS)
+    assert model.block_time(["G1 X100 F3000"], PrinterStateTracker()) == 0.0
+
+
+def test_clock_queues_blocks_after_each_other(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("Swapper3D_Package.motion_model.time.monotonic", lambda: now[0])
+    clock = MotionClock()
+    assert clock.queue(2.0) == 102.0
+    now[0] = 101.0
+    assert clock.queue(1.0) == 103.0  # starts when the first block is done
+    now[0] = 110.0
+    assert clock.queue(0.5) == 110.5  # the printer was idle
@@ -0,0 +1,64 @@
+# Octoprint plugin name: Swapper3D, File: test_printer_state.py, Author: BigBrain3D, License: AGPLv3
+import pytest
+from Swapper3D_Package.printer_state import PrinterStateTracker
+
+
+def test_absolute_moves_and_extrusion():
+    state = PrinterStateTracker()
+    state.on_move("G1 X10 Y20 Z0.2 E1.5 F1800")
+    state.on_move("G1 X15 E2.5")
+    assert (state.x, state.y, state.z, state.e) == (15.0, 20.0, 0.2, 2.5)
+    assert state.feedrate == 1800.0
+    assert state.extrusion_since_swap == 2.5
+
+
+def test_relative_extrusion_with_retracts():
+    state = PrinterStateTracker()
+    state.on_e_relative("M83")
+    for cmd in ("G1 E5", "G1 E-1", "G1 E1", "G1 E3"):
+        state.on_move(cmd)
+    assert state.extrusion_since_swap == 8.0
+
+
+def test_g92_e_reset_does_not_count_as_extrusion():
+    state = PrinterStateTracker()
+    state.on_move("G1 E10")
+    state.on_set_position("G92 E0")
+    state.on_move("G1 E4")
+    assert state.e == 4.0
+    assert state.extrusion_since_swap == 14.0
+
+
+def test_g92_without_parameters_zeroes_every_axis():
+    state = PrinterStateTracker()
+    state.on_move("G1 X10 Y10 Z1 E3")
+    state.on_set_position("G92")
+    assert (state.x, state.y, state.z, state.e) == (0.0, 0.0, 0.0, 0.0)
+
+
+def test_g91_moves_relative_from_a_known_position_only():
+    state = PrinterStateTracker()
+    state.on_relative("G91")
+    state.on_move("G1 X5 Z1")
+    assert state.x is None and state.z is None  # never set or homed
+    state.on_home("G28")
+    state.on_move("G1 X5 Z1")
+    assert (state.x, state.z) == (5.0, 1.0)
+    state.on_absolute("G90")
+    assert not state.e_relative
+
+
+@pytest.mark.parametrize("cmd, homed", [("G28", "XYZ"), ("G28 X", "X"), ("G28 XY", "XY"), ("G28 Z", "Z"),
+                                        ("G28 W", "XYZ")])
+def test_home(cmd, homed):
+    state = PrinterStateTracker()
+    state.on_home(cmd)
+    assert {axis for axis in "XYZ" if getattr(state, axis.lower()) == 0.0} == set(homed)
+
+
+def test_reset_extrusion():
+    state = PrinterStateTracker()
+    state.on_move("G1 E10")
+    state.reset_extrusion()
+    state.on_move("G1 E12")
+    assert state.extrusion_since_swap == 2.0
@@ -0,0 +1,118 @@
+# Octoprint plugin name: Swapper3D, File: test_simulator.py, Author: BigBrain3D, License: AGPLv3
+# The serial engine against the Swapper3D simulator on a pseudo-terminal (Linux only).
+import sys
+import time
+from types import SimpleNamespace
+import pytest
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="the simulator needs a Linux pty")
+
+serial = pytest.importorskip("serial")
+from Swapper3D_Package.serial_engine import SerialEngine
+from Swapper3D_Package.simulator import Swapper3DSimulator
+
+
+class _Log:
+    def __init__(self):
+        self.errors = []
+
+    def is_enabled(self, level):
+        return False
+
+    def debug(self, message, *args):
+        pass
+
+    def warning(self, message, *args):
+        pass
+
+    def error(self, message, *args):
+        self.errors.append(message % args)
+
+
+@pytest.fixture
+def simulator():
+    with Swapper3DSimulator(time_scale=0, seed=1) as sim:
+        yield sim
+
+
+@pytest.fixture
+def engine(simulator):
+    plugin = SimpleNamespace(log=_Log(), settings_snapshot=SimpleNamespace(commandTimeout=5))
+    engine = SerialEngine(plugin, serial.Serial(simulator.port, 9600))
+    engine.start()
+    yield engine
+    engine.stop()
+    engine.serial_conn.close()
+
+
+def test_commands_are_acked_in_order(engine, simulator):
+    futures = [engine.submit(command) for command in ("octoprint", "unload_connect", "cutter_open", "cutter_cut")]
+    assert [future.result(timeout=5) for future in futures] == [(True, None)] * 4
+    assert simulator.received_commands == ["octoprint", "unload_connect", "cutter_open", "cutter_cut"]
+    assert all(future.latency >= 0 for future in futures)
+
+
+def test_batch_is_acked_per_command(engine, simulator):
+    futures = engine.submit_batch(["unload_stowCutter", "unload_stowInsert"])
+    assert [future.result(timeout=5) for future in futures] == [(True, None)] * 2
+    assert simulator.received_commands == ["unload_stowCutter", "unload_stowInsert"]
+
+
+def test_load_and_stow_move_tool_rotate(engine, simulator):
+    assert engine.submit("load_insert3").result(timeout=5) == (True, None)
+    assert (simulator.loaded_insert, simulator.tool_rotate_position) == ("3", "3")
+    assert engine.submit("hometoolrotate").result(timeout=5) == (True, None)
+    assert simulator.tool_rotate_position is None
+    # putting the insert back turns the wheel to its slot again
+    assert engine.submit("unload_stowInsert").result(timeout=5) == (True, None)
+    assert (simulator.loaded_insert, simulator.tool_rotate_position) == (None, "3")
+
+
+def test_fire_and_forget_ack_is_swallowed(engine):
+    swallowed = []
+    engine.swallowed_ack_listeners.append(swallowed.append)
+    assert engine.submit("hometoolrotate", WaitForOk=False).result(timeout=5) == (True, None)
+    assert engine.submit("cutter_open").result(timeout=5) == (True, None)
+    assert engine.read_unsolicited(timeout=0.2) is None
+    assert not engine.has_pending()
+    assert swallowed == ["hometoolrotate"]
+
+
+def test_ping_takes_only_its_own_reply(engine):
+    version = engine.submit("readmajor")
+    ping = engine.ping()
+    assert version.result(timeout=5) == (True, None)
+    assert ping.result(timeout=5) == (True, None)
+    # the version part after readmajor_ok is left for get_firmware_version
+    assert engine.read_unsolicited(timeout=1) == "1"
+
+
+def test_fire_and_forget_command_is_pending_until_its_ack():
+    with Swapper3DSimulator(command_times={"hometoolrotate": 0.5}, seed=1) as simulator:
+        plugin = SimpleNamespace(log=_Log(), settings_snapshot=SimpleNamespace(commandTimeout=5))
+        engine = SerialEngine(plugin, serial.Serial(simulator.port, 9600))
+        engine.start()
+        try:
+            assert engine.submit("hometoolrotate", WaitForOk=False).result(timeout=5) == (True, None)
+            # the wheel is still turning, a heartbeat now would wait behind it
+            assert engine.has_pending()
+            deadline = time.monotonic() + 5
+            while engine.has_pending() and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert not engine.has_pending()
+        finally:
+            engine.stop()
+            engine.serial_conn.close()
+
+
+def test_parity_fault_fails_the_waiting_command():
+    with Swapper3DSimulator(time_scale=0, parity_fault_rate=1.0, seed=1) as simulator:
+        plugin = SimpleNamespace(log=_Log(), settings_snapshot=SimpleNamespace(commandTimeout=5))
+        engine = SerialEngine(plugin, serial.Serial(simulator.port, 9600))
+        engine.start()
+        try:
+            assert engine.submit("cutter_open").result(timeout=5) == (False, "Parity check did not pass.")
+            assert plugin.log.errors
+        finally:
+            engine.stop()
+            engine.serial_conn.close()
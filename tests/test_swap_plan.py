@@ -0,0 +1,225 @@
+# Octoprint plugin name: Swapper3D, File: test_swap_plan.py, Author: BigBrain3D, License: AGPLv3
+# The swap plan decides whether a print is cancelled (RejectBadSwapFiles) and which tool changes are swapped,
+# so its parser is tested on the G-code shapes slicers produce.
+from Swapper3D_Package.swap_plan import (MAX_TOOL, SKIP_MIN_EXTRUSION, SKIP_SAME_TOOL, SwapPlanCursor,
+                                         analyze_gcode, get_swap_plan)
+
+
+def plan_of(text, min_extrusion=10.0):
+    return analyze_gcode(text.strip().splitlines(), min_extrusion)
+
+
+def test_tools_up_to_max_tool_are_planned():
+    plan = plan_of(f"""
+T0
+M83
+G1 E20
+T{MAX_TOOL}
+""")
+    assert plan["problems"] == []
+    assert [change.tool for change in plan["tool_changes"]] == ["0", str(MAX_TOOL)]
+    assert plan["swaps"] == 2
+
+
+def test_tool_without_insert_is_a_problem():
+    plan = plan_of(f"""
+T0
+T{MAX_TOOL + 1}
+""")
+    assert len(plan["problems"]) == 1
+    assert plan["problems"][0].startswith("line 2:")
+    assert [change.tool for change in plan["tool_changes"]] == ["0"]
+
+
+def test_tool_change_without_number_is_a_problem():
+    plan = plan_of("""
+Tc
+T?
+T1 ; comment after the tool change
+""")
+    assert len(plan["problems"]) == 2
+    assert "'Tc'" in plan["problems"][0]
+    assert "'T?'" in plan["problems"][1]
+    assert [change.tool for change in plan["tool_changes"]] == ["1"]
+
+
+def test_relative_extrusion_is_summed():
+    plan = plan_of("""
+T0
+M83
+G1 X10 E4
+G1 X20 E4
+G1 E-2 ; retract
+G1 E2 ; unretract
+G1 X30 E4
+T1
+""")
+    change = plan["tool_changes"][1]
+    assert change.extrusion == 12.0
+    assert change.skip is None
+
+
+def test_absolute_extrusion_with_g92_resets():
+    # without the G92 E0 handling the E values would add up to 19 and the swap would happen
+    plan = plan_of("""
+T0
+M82
+G1 X10 E5
+G92 E0
+G1 X20 E4
+T1
+""")
+    change = plan["tool_changes"][1]
+    assert change.extrusion == 9.0
+    assert change.skip == SKIP_MIN_EXTRUSION
+    assert plan["swaps"] == 1
+
+
+def test_m82_after_m83_counts_absolute_positions():
+    plan = plan_of("""
+T0
+M83
+G1 E6
+G92 E0
+M82
+G1 E10
+G1 E11
+T1
+""")
+    assert plan["tool_changes"][1].extrusion == 17.0
+
+
+def test_g91_makes_extrusion_relative_and_g90_absolute():
+    plan = plan_of("""
+T0
+G91
+G1 E6
+G1 E6
+G90
+G92 E0
+G1 E3
+T1
+""")
+    assert plan["tool_changes"][1].extrusion == 15.0
+
+
+def test_skipped_tool_change_keeps_counting_extrusion():
+    plan = plan_of("""
+T0
+M83
+G1 E6
+T1
+G1 E6
+T1
+""")
+    first, skipped, swapped = plan["tool_changes"]
+    assert first.skip is None
+    assert skipped.skip == SKIP_MIN_EXTRUSION
+    assert swapped.extrusion == 12.0
+    assert swapped.skip is None
+
+
+def test_same_tool_is_skipped():
+    plan = plan_of("""
+T0
+M83
+G1 E20
+T0
+""")
+    assert plan["tool_changes"][1].skip == SKIP_SAME_TOOL
+    assert plan["swaps"] == 1
+
+
+def test_layers_and_z_are_recorded():
+    plan = plan_of("""
+;LAYER_CHANGE
+G1 Z0.2
+T0
+;LAYER_CHANGE
+G1 Z0.4
+M83
+G1 E20
+T1
+""")
+    assert [(change.layer, change.z) for change in plan["tool_changes"]] == [(1, 0.2), (2, 0.4)]
+
+
+def test_cursor_follows_the_plan():
+    plan = plan_of("""
+T0
+M83
+G1 E20
+T1
+G1 E20
+T2
+""")
+    cursor = SwapPlanCursor(plan)
+    assert cursor.remaining_swaps() == 3
+    assert cursor.next_tool_change("0").tool == "0"
+    assert cursor.next_tool_change("1").tool == "1"
+    assert cursor.remaining_swaps() == 1
+    assert cursor.in_sync
+
+
+def test_cursor_desyncs_on_an_unexpected_tool_and_stays_out():
+    plan = plan_of("""
+T0
+M83
+G1 E20
+T1
+""")
+    cursor = SwapPlanCursor(plan)
+    assert cursor.next_tool_change("0") is not None
+    assert cursor.next_tool_change("2") is None
+    assert not cursor.in_sync
+    # the print no longer matches the plan, even the planned tool is not taken from it anymore
+    assert cursor.next_tool_change("1") is None
+
+
+def test_cursor_desyncs_after_the_last_planned_change():
+    cursor = SwapPlanCursor(plan_of("T0"))
+    assert cursor.next_tool_change("0") is not None
+    assert cursor.next_tool_change("0") is None
+    assert not cursor.in_sync
+
+
+def test_plan_is_stored_and_reused(tmp_path):
+    gcode_path = tmp_path / "print.gcode"
+    gcode_path.write_text("T0\nM83\nG1 E20\nT1\n")
+    folder = tmp_path / "plans"
+
+    plan, file_hash = get_swap_plan(str(folder), str(gcode_path), 10.0)
+    sidecar = folder / f"{file_hash}.json"
+    assert sidecar.exists()
+    assert plan["swaps"] == 2
+
+    # printing the file again takes the plan from the sidecar instead of analyzing the file
+    sidecar.write_text(sidecar.read_text().replace('"swaps":2', '"swaps":7'))
+    stored, same_hash = get_swap_plan(str(folder), str(gcode_path), 10.0)
+    assert same_hash == file_hash
+    assert stored["swaps"] == 7
+    assert stored["tool_changes"][1].tool == "1"
+
+
+def test_plan_of_other_min_extrusion_is_analyzed_again(tmp_path):
+    gcode_path = tmp_path / "print.gcode"
+    gcode_path.write_text("T0\nM83\nG1 E20\nT1\n")
+
+    plan, _ = get_swap_plan(str(tmp_path), str(gcode_path), 10.0)
+    assert plan["swaps"] == 2
+    plan, _ = get_swap_plan(str(tmp_path), str(gcode_path), 30.0)
+    assert plan["swaps"] == 1
+    assert plan["tool_changes"][1].skip == SKIP_MIN_EXTRUSION
+
+
+def test_commands_starting_with_t_are_not_tool_changes():
+    plan = plan_of("""
+T0
+TIMELAPSE_TAKE_FRAME
+TEMPERATURE_WAIT SENSOR=extruder MINIMUM=200
+M83
+G1 E20
+T1
+""")
+    assert plan["problems"] == []
+    assert [change.tool for change in plan["tool_changes"]] == ["0", "1"]